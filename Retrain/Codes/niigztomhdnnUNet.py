@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Convert nnU-Net .nii.gz predictions to MetaIO, in parallel and incrementally
+
+One converter for the nnU-Net 2D and 3D predictions (niigztomhdnnUNet2D.py and
+niigztomhdnnUNet3D.py call it with their folders). Every prediction
+<case>.nii.gz is written as <case>_segmentation.mhd, as before, on a pool of
+processes. A prediction is skipped when its output is newer than it, or when
+the output and the content hash of the prediction are those recorded in
+.niigztomhd.json in the output folder at the last conversion (a copied or
+touched prediction is not converted again). The output can be written
+uncompressed (.mhd/.raw, memory mapped by the extraction) or compressed
+(.mhd/.zraw). Outputs appear complete or not at all. The working directory
+is not changed, so convertFolder can be called from other code.
+
+Usage:
+    python niigztomhdnnUNet.py "Path to nnUNet_3D predictions" basePath/Data/Segmentations/nnUNet_3D --workers 4
+    python niigztomhdnnUNet.py INPUT OUTPUT --compress --force
+"""
+
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+manifest_name = '.niigztomhd.json'
+
+def fileHash(file_in):
+    digest = hashlib.blake2b(digest_size = 16)
+    with open(file_in,'rb') as f:
+        for block in iter(lambda: f.read(1024*1024),b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def stamp(file_in):
+    status = os.stat(file_in)
+    return [status.st_mtime_ns,status.st_size]
+
+# '<case>.nii.gz' -> '<case>_segmentation.mhd' with the default template
+def outputName(input_name_in,output_template_in='{case}_segmentation.mhd'):
+    case = input_name_in[:-len('.nii.gz')] if input_name_in.endswith('.nii.gz') else os.path.splitext(input_name_in)[0]
+    return output_template_in.format(case = case)
+
+# Why the output of a prediction has to be written, None when it is up to date.
+# entry_in is the record of the last conversion in the manifest.
+def staleReason(input_file_in,output_file_in,entry_in,compress_in):
+    if not os.path.exists(output_file_in):
+        return 'new'
+    if entry_in is not None and entry_in.get('compress') != compress_in:
+        return 'compression changed'
+    if os.path.getmtime(output_file_in) >= os.path.getmtime(input_file_in):
+        return None
+    if entry_in is not None and entry_in.get('output_stamp') == stamp(output_file_in) and entry_in.get('input_hash') == fileHash(input_file_in):
+        return None
+    return 'changed'
+
+# Convert one prediction in a pool worker, returns its record for the manifest
+def convertFile(input_file_in,output_file_in,entry_in=None,compress=False,force=False):
+    import SimpleITK as sitk
+    start = time.perf_counter()
+    record = {'input': input_file_in, 'output': output_file_in, 'compress': compress, 'error': None}
+    try:
+        reason = 'forced' if force else staleReason(input_file_in,output_file_in,entry_in,compress)
+        if reason is None:
+            record.update(status = 'up to date',input_hash = entry_in.get('input_hash') if entry_in else None,
+                          output_stamp = stamp(output_file_in))
+        else:
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+            input_hash = fileHash(input_file_in)
+            output_dir = os.path.dirname(output_file_in)
+            # written next to the output and moved in place, the header last
+            temp_dir = tempfile.mkdtemp(prefix = '.convert-',dir = output_dir)
+            try:
+                sitk.WriteImage(sitk.ReadImage(input_file_in),os.path.join(temp_dir,os.path.basename(output_file_in)),compress)
+                names = sorted(os.listdir(temp_dir),key = lambda name: name == os.path.basename(output_file_in))
+                for name in names:
+                    os.replace(os.path.join(temp_dir,name),os.path.join(output_dir,name))
+                # the data file of the other compression setting
+                stale_file = os.path.splitext(output_file_in)[0]+('.raw' if compress else '.zraw')
+                if os.path.splitext(output_file_in)[1].lower() == '.mhd' and os.path.exists(stale_file):
+                    os.remove(stale_file)
+            finally:
+                shutil.rmtree(temp_dir,ignore_errors = True)
+            record.update(status = 'converted',reason = reason,input_hash = input_hash,output_stamp = stamp(output_file_in))
+    except Exception as e:
+        record.update(status = 'failed',error = '%s: %s' % (type(e).__name__,e))
+    record['seconds'] = time.perf_counter()-start
+    return record
+
+def readManifest(output_dir_in):
+    try:
+        with open(os.path.join(output_dir_in,manifest_name)) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+def writeManifest(output_dir_in,manifest_in):
+    fd,temp_file = tempfile.mkstemp(suffix = '.tmp',dir = output_dir_in)
+    with os.fdopen(fd,'w') as f:
+        json.dump(manifest_in,f,indent = 1)
+    os.replace(temp_file,os.path.join(output_dir_in,manifest_name))
+
+# Convert the predictions in input_dir_in that are not up to date in output_dir_in,
+# returns the per file records and a summary
+def convertFolder(input_dir_in,output_dir_in,pattern='*.nii.gz',output_template='{case}_segmentation.mhd',compress=False,
+                  nr_workers=None,force=False,verbose=True):
+    input_dir = os.path.abspath(input_dir_in)
+    output_dir = os.path.abspath(output_dir_in)
+    os.makedirs(output_dir,exist_ok = True)
+    manifest = readManifest(output_dir)
+    input_files = sorted(glob.glob(os.path.join(glob.escape(input_dir),pattern)))
+    records = []
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(nr_workers or os.cpu_count() or 1) as pool:
+        futures = []
+        for input_file in input_files:
+            output_name = outputName(os.path.basename(input_file),output_template)
+            futures.append(pool.submit(convertFile,input_file,os.path.join(output_dir,output_name),manifest.get(output_name),compress,force))
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                record = future.result()
+                records.append(record)
+                if record['status'] != 'failed':
+                    manifest[os.path.basename(record['output'])] = {key: record[key] for key in ('input','input_hash','output_stamp','compress')}
+                if verbose and record['status'] != 'up to date':
+                    print('%s: %s%s' % (os.path.basename(record['input']),record['status'],
+                                        ' (%s)' % record['error'] if record['error'] else ''))
+                    sys.stdout.flush()
+        finally:
+            writeManifest(output_dir,manifest)
+    summary = {'files': len(records), 'seconds': time.perf_counter()-start}
+    for status in ('converted','up to date','failed'):
+        summary[status] = sum(1 for record in records if record['status'] == status)
+    return records,summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert nnU-Net .nii.gz predictions to MetaIO')
+    parser.add_argument('input',help='folder with the .nii.gz predictions')
+    parser.add_argument('output',help='folder for the MetaIO segmentations')
+    parser.add_argument('--pattern',default='*.nii.gz',help='file pattern of the predictions (default *.nii.gz)')
+    parser.add_argument('--template',default='{case}_segmentation.mhd',help='output file name (default {case}_segmentation.mhd)')
+    parser.add_argument('--compress',action='store_true',help='write compressed data (.zraw) instead of .raw')
+    parser.add_argument('--workers',type=int,help='number of worker processes (default: number of cores)')
+    parser.add_argument('--force',action='store_true',help='convert every prediction, also the ones that are up to date')
+    args = parser.parse_args()
+    records,summary = convertFolder(args.input,args.output,args.pattern,args.template,args.compress,args.workers,args.force)
+    print('%d predictions: %d converted, %d up to date, %d failed in %.1f s'
+          % (summary['files'],summary['converted'],summary['up to date'],summary['failed'],summary['seconds']))
+    sys.exit(1 if summary['failed'] else 0)
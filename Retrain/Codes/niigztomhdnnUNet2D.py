@@ -3,31 +3,19 @@
 Created on Wed Sep 12 15:45:35 2018
 
 @author: mohammed r. s. sunoqrot
+
+Converts the nnU-Net 2D predictions with niigztomhdnnUNet.py: in parallel,
+and only the predictions that changed since the last run.
 """
 
-import SimpleITK as sitk
 import os
-import glob
+
+import niigztomhdnnUNet
 
 inputdir = 'Path to nnUNet_2D predictions'
 outputdir = os.path.join('basePath','Data','Segmentations','nnUNet_2D') # change basePath with the full path to it
 
-reader = sitk.ImageFileReader()
-writer = sitk.ImageFileWriter()
-
-files = []
-os.chdir(inputdir)
-for file in glob.glob("*.gz"):
-    files.append(file)
-
-for ii in  files:
-    input_name = str(ii) 
-    print(input_name)
-    
-    imagein = os.path.join(inputdir,input_name)
-    imageout = os.path.join(outputdir,str(ii[:-7]+'_segmentation.mhd')) # [:-7] might need to be changed to fit your data naming system
-    
-    reader.SetFileName(imagein)
-    image = reader.Execute()
-    writer.SetFileName(imageout)
-    writer.Execute(image)
\ No newline at end of file
+if __name__ == '__main__':
+    # '{case}_segmentation.mhd' might need to be changed to fit your data naming system
+    records,summary = niigztomhdnnUNet.convertFolder(inputdir,outputdir,output_template='{case}_segmentation.mhd')
+    print('%d predictions: %d converted, %d up to date, %d failed' % (summary['files'],summary['converted'],summary['up to date'],summary['failed']))
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Extract the retrain features of all segmentation methods
+
+Replaces the per method scripts (Manual, UNet, VNet, nnUNet2D, nnUNet3D).
+The methods, their folders and the file naming are set in a JSON config
+(see featureExtractionConfig.json). Every (method, case) pair is scheduled on
+one shared pool of processes, so all methods are extracted at the same time.
+The features are written as <case>_<region>_<feature class>.json to the
+results folder of each method, as read by featureExtraction.m.
+For a cohort too large for one machine, --shard k/n extracts shard k of n of
+the (method, case) pairs, e.g. as array jobs on a cluster, and --merge then
+checks that every pair was extracted and merges the feature stores of the
+shards (see cohortShards.py).
+The completed (region, feature class) units are recorded in a ledger
+(Data/Features/extraction.ledger, or "ledger" in the config), so a run that is
+started again after a crash only extracts what is missing (--restart to
+extract everything again, see jobLedger.py).
+The relative folders of the config are taken from --base-path, else from
+"base_path" in the config, else from the current working directory (the
+Retrain folder, which has Data/ in it).
+
+Usage:
+    python pyradiomicsFeaturesExtractionWithRegions.py featureExtractionConfig.json --base-path C:\\Study\\Analysis
+    python pyradiomicsFeaturesExtractionWithRegions.py featureExtractionConfig.json --store Data/Store --shard $SLURM_ARRAY_TASK_ID/8
+    python pyradiomicsFeaturesExtractionWithRegions.py featureExtractionConfig.json --store Data/Store --merge --output features.csv
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+
+# the extraction modules live in the root of the repository (or are copied next to this script)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..'))
+import cohortShards
+import featureStore
+import jobLedger
+import pyradiomicsBatch
+
+# method settings that are not given fall back to the top level of the config
+method_keys = ['image_dir','image_pattern','mask_dir','mask_pattern','results_dir']
+
+def readConfig(config_file_in,base_path_in=None):
+    with open(config_file_in) as f:
+        config = json.load(f)
+    base_path = base_path_in or config.get('base_path') or os.getcwd()
+    methods = []
+    for method_in in config['methods']:
+        method = {'name': method_in['name'],
+                  'mask_dir': os.path.join('Data','Segmentations',method_in['name']),
+                  'results_dir': os.path.join('Data','Features',method_in['name'])}
+        for key in method_keys:
+            if key in method_in:
+                method[key] = method_in[key]
+            elif key in config:
+                method[key] = config[key]
+        for key in ('image_dir','mask_dir','results_dir'):
+            method[key] = os.path.join(base_path,method[key])
+        methods.append(method)
+    config['methods'] = methods
+    if config.get('store'):
+        config['store'] = os.path.join(base_path,config['store'])
+    config['ledger'] = os.path.join(base_path,config.get('ledger') or os.path.join('Data','Features','extraction.ledger'))
+    return config
+
+# '{case}_segmentation.mhd' -> regular expression that captures the case name
+def patternToRegex(pattern_in):
+    return re.compile(re.escape(pattern_in).replace(re.escape('{case}'),'(?P<case>.+)')+'$')
+
+def listJobs(method_in,region_classes_in):
+    if not os.path.isdir(method_in['mask_dir']):
+        raise FileNotFoundError('No segmentation folder for %s: %s' % (method_in['name'],method_in['mask_dir']))
+    mask_regex = patternToRegex(method_in['mask_pattern'])
+    jobs = []
+    for mask_name in sorted(os.listdir(method_in['mask_dir'])):
+        match = mask_regex.match(mask_name)
+        if match:
+            case = match.group('case')
+            jobs.append({'method': method_in['name'],
+                         'case': case,
+                         'image': os.path.join(method_in['image_dir'],method_in['image_pattern'].format(case=case)),
+                         'mask': os.path.join(method_in['mask_dir'],mask_name),
+                         'results': method_in['results_dir'],
+                         'regions': region_classes_in})
+    return jobs
+
+# Interleave the cases of the methods so that all methods progress together
+def interleaveJobs(jobs_per_method_in):
+    jobs = []
+    for ii in range(max([len(method_jobs) for method_jobs in jobs_per_method_in],default=0)):
+        jobs.extend(method_jobs[ii] for method_jobs in jobs_per_method_in if ii < len(method_jobs))
+    return jobs
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the retrain features of all segmentation methods')
+    parser.add_argument('config',help='JSON config with the segmentation methods, folders and naming patterns')
+    parser.add_argument('--base-path',help='base path the relative folders of the config are in (default: "base_path" of the config, '
+                                           'else the current working directory)')
+    parser.add_argument('--workers',type=int,help='number of worker processes (default: from the config, else number of cores)')
+    parser.add_argument('--report',help='write the per case timing and the summary to this JSON file')
+    parser.add_argument('--store',help='also upsert the features into this feature store folder (default: from the config)')
+    parser.add_argument('--prefetch',type=int,help='cases every worker reads ahead while it extracts (default: from the config, else 0)')
+    parser.add_argument('--shard',help='extract only shard k of n (k/n, k from 0) into a store of the shard')
+    parser.add_argument('--merge',action='store_true',help='merge the shard stores into the store, after all shards ran')
+    parser.add_argument('--output',help='with --merge, also write the merged features to this CSV file')
+    parser.add_argument('--restart',action='store_true',help='start the ledger anew and extract every case')
+    args = parser.parse_args()
+    config = readConfig(args.config,args.base_path)
+    region_classes = config.get('regions',['wholeprostate','apex','middle','base'])
+    jobs = interleaveJobs([listJobs(method,region_classes) for method in config['methods']])
+    store_path = args.store or config.get('store')
+    if args.merge:
+        if not store_path:
+            parser.error('--merge needs a store')
+        keys,names,values,report = cohortShards.mergeShards(jobs,store_path,region_classes)
+        cohortShards.printReport(report)
+        cohortShards.writeStore(store_path,keys,names,values)
+        if args.output:
+            cohortShards.writeTable(args.output,keys,names,values)
+        sys.exit(0 if report['complete'] else 1)
+    if args.shard:
+        if not store_path:
+            parser.error('--shard needs a store to merge the shards from')
+        shard,nr_shards = cohortShards.parseShard(args.shard)
+        nr_jobs = len(jobs)
+        try:
+            jobs,shard_voxels = cohortShards.shardJobs(jobs,shard,nr_shards)
+        except ValueError as e:
+            # no case is extracted when a task cannot compute the same shards as the others
+            sys.exit(str(e))
+        print('%s: %d of %d cases, %d voxels' % (cohortShards.shardName(shard,nr_shards),len(jobs),nr_jobs,shard_voxels))
+        store_path = cohortShards.shardStore(store_path,shard,nr_shards)
+        if args.report:
+            args.report = cohortShards.shardReport(args.report,shard,nr_shards)
+        config['ledger'] = cohortShards.shardReport(config['ledger'],shard,nr_shards)
+    nr_jobs = len(jobs)
+    jobs,nr_complete,nr_partial = pyradiomicsBatch.resumeJobs(jobs,jobLedger.JobLedger(config['ledger'],not args.restart),bool(store_path))
+    print('ledger: %d of %d cases complete, %d partly done, %d to extract' % (nr_complete,nr_jobs,nr_partial,len(jobs)-nr_partial))
+    store = featureStore.FeatureStore(store_path) if store_path else None
+    prefetch = args.prefetch if args.prefetch is not None else config.get('prefetch') or 0
+    records,summary = pyradiomicsBatch.runBatch(jobs,args.workers or config.get('workers'),store=store,prefetch=prefetch)
+    pyradiomicsBatch.printSummary(summary)
+    if args.report:
+        pyradiomicsBatch.writeReport(args.report,records,summary)
+    sys.exit(1 if summary['failed'] else 0)
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Segmentation metrics of the reference scores, vectorized
+
+The python counterpart of getMetrics.m and the metric loop of
+calculateScores.m: DSC, JSC, F1, aRVD, HD95, ASD and RMSSD of every
+segmentation method against the manual (reference) segmentation, for the
+whole prostate and its apex, middle and base thirds. The border voxels are
+found with the same 6-connected erosion, and the surface distances are read
+from Euclidean distance transforms in physical spacing instead of per point
+coordinate loops and KD-trees. The distance map of the reference border is
+computed once per case and region and reused for every method. Masks that
+are not on the grid of the reference are compared through their world
+coordinates, as getMetrics.m does.
+
+Usage:
+    python surfaceMetrics.py --base-path C:\\Study\\Analysis --output metrics.json
+    python surfaceMetrics.py --segmentations Data/Segmentations --methods UNet_2D VNet_3D nnUNet_2D nnUNet_3D --workers 4 --csv metrics.csv
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import math
+import os
+import re
+import sys
+
+import numpy as np
+import scipy.ndimage
+import scipy.spatial
+
+# the extraction modules live in the root of the repository (or are copied next to this script)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..'))
+import pyradiomicsFeatureExtraction as extraction
+
+region_classes = ['wholeprostate','apex','middle','base']
+
+seg_methods = ['UNet_2D','VNet_3D','nnUNet_2D','nnUNet_3D']
+
+# metrics of a region that is in only one of the masks, as in getMetrics.m
+worst_metrics = {'DSC': 0.0, 'JSC': 0.0, 'F1': 0.0, 'aRVD': 100.0, 'HD95': 100.0, 'ASD': 100.0, 'RMSSD': 100.0}
+
+# strel('sphere',1): the voxel and its 6 face neighbours
+sphere = scipy.ndimage.generate_binary_structure(3,1)
+
+# Slices of every region of a (z,y,x) mask: the range from its first to its
+# last slice with voxels, split in thirds as in calculateScores.m
+def regionSlices(mask_array_in):
+    filled = np.flatnonzero(mask_array_in.any(axis = (1,2)))
+    if np.size(filled) == 0:
+        return {region_class: np.zeros(0,dtype = int) for region_class in region_classes}
+    slices = np.arange(filled[0],filled[-1]+1)
+    nr_slices = np.size(slices)
+    nr_third = math.floor(nr_slices/3)
+    return {'wholeprostate': slices, 'apex': slices[:nr_third], 'middle': slices[nr_third:nr_slices-nr_third],
+            'base': slices[nr_slices-nr_third:]}
+
+# Mask of a region: the mask with the slices of the other regions set to 0
+def regionMask(mask_array_in,slices_in):
+    region = np.zeros_like(mask_array_in)
+    region[slices_in] = mask_array_in[slices_in]
+    return region
+
+# Border voxels of a mask, imerode pads with foreground so voxels on the edge
+# of the volume are only border voxels when they border background inside it
+def borderVoxels(mask_array_in):
+    return mask_array_in & ~scipy.ndimage.binary_erosion(mask_array_in,sphere,border_value = 1)
+
+# World coordinates of (z,y,x) voxel indices, one matrix product for all of them
+def worldPoints(indices_in,geometry_in):
+    direction = np.reshape(geometry_in['direction'],(3,3))
+    matrix = direction*np.asarray(geometry_in['spacing'])
+    return indices_in[:,::-1] @ matrix.T+np.asarray(geometry_in['origin'])
+
+def sameGrid(shape_in,geometry_in,other_shape_in,other_geometry_in):
+    return tuple(shape_in) == tuple(other_shape_in) and all(np.allclose(geometry_in[key],other_geometry_in[key],rtol = 1e-6,atol = 1e-6)
+                                                           for key in ('spacing','origin','direction'))
+
+# Distances from the query voxels to the nearest border voxel, from a distance
+# transform of the bounding box of both (exact, as all border voxels are in it)
+def borderDistances(border_in,query_indices_in,spacing_in):
+    border_indices = np.argwhere(border_in)
+    points = np.concatenate((border_indices,query_indices_in))
+    lower = points.min(axis = 0)
+    upper = points.max(axis = 0)+1
+    box = tuple(slice(low,high) for low,high in zip(lower,upper))
+    distance_map = scipy.ndimage.distance_transform_edt(~border_in[box],sampling = spacing_in)
+    return distance_map[tuple((query_indices_in-lower).T)]
+
+class ReferenceSurface:
+    # The reference mask as a (z,y,x) array with its geometry (see metaImage.py).
+    # margin_in voxels around the reference are covered by its distance maps.
+    def __init__(self,mask_array_in,geometry_in,margin_in=16):
+        self.mask = np.asarray(mask_array_in) == 1
+        self.geometry = geometry_in
+        self.slices = regionSlices(self.mask)
+        self.border = borderVoxels(self.mask)
+        # numpy axes are z,y,x and SimpleITK spacing x,y,z
+        self.spacing = tuple(geometry_in['spacing'][::-1])
+        filled = np.argwhere(self.mask)
+        if np.size(filled):
+            lower = np.maximum(filled.min(axis = 0)-margin_in,0)
+            upper = np.minimum(filled.max(axis = 0)+margin_in+1,self.mask.shape)
+        else:
+            lower = upper = np.zeros(3,dtype = int)
+        self.lower = lower
+        self.box = tuple(slice(low,high) for low,high in zip(lower,upper))
+        self.distance_maps = {}
+        self.trees = {}
+
+    def regionBorder(self,region_class_in):
+        return regionMask(self.border,self.slices[region_class_in])
+
+    # Distances from (z,y,x) voxel indices to the nearest reference border voxel
+    # of a region. The distance map of the region is computed on the first call
+    # and reused; indices outside it are looked up in a KD-tree of the border.
+    def distances(self,region_class_in,indices_in):
+        if region_class_in not in self.distance_maps:
+            self.distance_maps[region_class_in] = scipy.ndimage.distance_transform_edt(~self.regionBorder(region_class_in)[self.box],
+                                                                                       sampling = self.spacing)
+        distance_map = self.distance_maps[region_class_in]
+        local = indices_in-self.lower
+        inside = np.all((local >= 0) & (local < distance_map.shape),axis = 1)
+        distances = np.empty(len(indices_in))
+        distances[inside] = distance_map[tuple(local[inside].T)]
+        if not np.all(inside):
+            if region_class_in not in self.trees:
+                self.trees[region_class_in] = scipy.spatial.cKDTree(np.argwhere(self.regionBorder(region_class_in))*self.spacing)
+            distances[~inside] = self.trees[region_class_in].query(indices_in[~inside]*self.spacing)[0]
+        return distances
+
+# DSC, JSC, F1 and aRVD of two region masks
+def overlapMetrics(reference_in,estimated_in):
+    nr_reference = np.count_nonzero(reference_in)
+    nr_estimated = np.count_nonzero(estimated_in)
+    nr_both = np.count_nonzero(reference_in & estimated_in)
+    nr_either = np.count_nonzero(reference_in | estimated_in)
+    precision = nr_both/nr_estimated*100
+    recall = nr_both/nr_reference*100
+    return {'DSC': 2*nr_both/(nr_reference+nr_estimated),
+            'JSC': nr_both/nr_either,
+            'F1': 0.0 if precision == 0 and recall == 0 else 2*precision*recall/(precision+recall),
+            'aRVD': abs((nr_estimated/nr_reference-1)*100)}
+
+# HD95, ASD and RMSSD from the distances of the reference border voxels to the
+# estimated border and the other way round
+def distanceMetrics(reference_distances_in,estimated_distances_in):
+    distances = np.concatenate((reference_distances_in,estimated_distances_in))
+    # prctile in MATLAB is the 'hazen' percentile
+    return {'HD95': max(np.percentile(reference_distances_in,95,method = 'hazen'),np.percentile(estimated_distances_in,95,method = 'hazen')),
+            'ASD': float(np.mean(distances)),
+            'RMSSD': float(np.sqrt(np.sum(distances**2))*np.sqrt(1/np.size(distances)))}
+
+# Metrics of every region of an estimated mask against the reference
+def caseMetrics(reference_in,estimated_array_in,estimated_geometry_in,region_classes_in=region_classes):
+    estimated = np.asarray(estimated_array_in) == 1
+    if estimated.shape != reference_in.mask.shape:
+        raise ValueError('estimated mask of size %s, the reference is %s' % (estimated.shape,reference_in.mask.shape))
+    estimated_slices = regionSlices(estimated)
+    estimated_border = borderVoxels(estimated)
+    same_grid = sameGrid(reference_in.mask.shape,reference_in.geometry,estimated.shape,estimated_geometry_in)
+    metrics = {}
+    for region_class in region_classes_in:
+        reference_region = regionMask(reference_in.mask,reference_in.slices[region_class])
+        estimated_region = regionMask(estimated,estimated_slices[region_class])
+        in_reference = np.any(reference_region)
+        in_estimated = np.any(estimated_region)
+        if in_reference != in_estimated:
+            metrics[region_class] = dict(worst_metrics)
+            continue
+        if not in_reference:
+            metrics[region_class] = {metric: float('nan') for metric in worst_metrics}
+            continue
+        # the overlap is counted voxel by voxel, as in getMetrics.m
+        region_metrics = overlapMetrics(reference_region,estimated_region)
+        estimated_border_region = regionMask(estimated_border,estimated_slices[region_class])
+        reference_indices = np.argwhere(reference_in.regionBorder(region_class))
+        estimated_indices = np.argwhere(estimated_border_region)
+        if same_grid:
+            # reference border -> estimated border, and estimated border -> reference border from the shared map
+            reference_distances = borderDistances(estimated_border_region,reference_indices,reference_in.spacing)
+            estimated_distances = reference_in.distances(region_class,estimated_indices)
+        else:
+            reference_points = worldPoints(reference_indices,reference_in.geometry)
+            estimated_points = worldPoints(estimated_indices,estimated_geometry_in)
+            reference_distances = scipy.spatial.cKDTree(estimated_points).query(reference_points)[0]
+            estimated_distances = scipy.spatial.cKDTree(reference_points).query(estimated_points)[0]
+        region_metrics.update(distanceMetrics(reference_distances,estimated_distances))
+        metrics[region_class] = {metric: float(value) for metric,value in region_metrics.items()}
+    return metrics
+
+# '{case}_segmentation.mhd' -> regular expression that captures the case name
+def patternToRegex(pattern_in):
+    return re.compile(re.escape(pattern_in).replace(re.escape('{case}'),'(?P<case>.+)')+'$')
+
+# Metrics of every method for one case, the reference is read once
+def runCase(case_in,reference_file_in,estimated_files_in,region_classes_in=region_classes):
+    reference_array,reference_geometry = extraction.readVolume(reference_file_in)
+    reference = ReferenceSurface(reference_array,reference_geometry)
+    metrics = {}
+    for method,estimated_file in estimated_files_in.items():
+        try:
+            estimated_array,estimated_geometry = extraction.readVolume(estimated_file)
+            metrics[method] = caseMetrics(reference,estimated_array,estimated_geometry,region_classes_in)
+        except Exception as e:
+            metrics[method] = {'error': '%s: %s' % (type(e).__name__,e)}
+    return case_in,metrics
+
+# Cases with a reference and the estimated mask of every method found for them
+def listCases(segmentations_dir_in,reference_method_in,methods_in,pattern_in):
+    regex = patternToRegex(pattern_in)
+    reference_dir = os.path.join(segmentations_dir_in,reference_method_in)
+    cases = []
+    for name in sorted(os.listdir(reference_dir)):
+        match = regex.match(name)
+        if not match:
+            continue
+        case = match.group('case')
+        estimated_files = {}
+        for method in methods_in:
+            estimated_file = os.path.join(segmentations_dir_in,method,pattern_in.format(case = case))
+            if os.path.exists(estimated_file):
+                estimated_files[method] = estimated_file
+        cases.append((case,os.path.join(reference_dir,name),estimated_files))
+    return cases
+
+def runCases(cases_in,nr_workers=None,region_classes_in=region_classes,verbose=True):
+    metrics = {}
+    with concurrent.futures.ProcessPoolExecutor(nr_workers or os.cpu_count() or 1) as pool:
+        futures = [pool.submit(runCase,case,reference_file,estimated_files,region_classes_in) for case,reference_file,estimated_files in cases_in]
+        for future in concurrent.futures.as_completed(futures):
+            case,case_metrics = future.result()
+            metrics[case] = case_metrics
+            if verbose:
+                print('[%d/%d] %s' % (len(metrics),len(cases_in),case))
+                sys.stdout.flush()
+    return {case: metrics[case] for case,_,_ in cases_in}
+
+# One row per case, method and region
+def writeCsv(csv_file_in,metrics_in):
+    with open(csv_file_in,'w',newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(['case','method','region']+list(worst_metrics))
+        for case,case_metrics in metrics_in.items():
+            for method,method_metrics in case_metrics.items():
+                for region_class,region_metrics in method_metrics.items():
+                    if isinstance(region_metrics,dict):
+                        writer.writerow([case,method,region_class]+[region_metrics[metric] for metric in worst_metrics])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Segmentation metrics of every method against the manual segmentation')
+    parser.add_argument('--base-path',default='',help='base path the relative folders are in')
+    parser.add_argument('--segmentations',default=os.path.join('Data','Segmentations'),help='folder with one subfolder per method')
+    parser.add_argument('--reference',default='Manual',help='subfolder of the reference segmentations (default Manual)')
+    parser.add_argument('--methods',nargs='+',default=seg_methods,help='subfolders of the segmentation methods')
+    parser.add_argument('--pattern',default='{case}_segmentation.mhd',help='file name of the segmentations (default {case}_segmentation.mhd)')
+    parser.add_argument('--workers',type=int,help='number of worker processes (default: number of cores)')
+    parser.add_argument('--output',help='write the metrics per case, method and region to this JSON file')
+    parser.add_argument('--csv',help='write the metrics as one row per case, method and region to this CSV file')
+    args = parser.parse_args()
+    cases = listCases(os.path.join(args.base_path,args.segmentations),args.reference,args.methods,args.pattern)
+    metrics = runCases(cases,args.workers)
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(metrics,f,indent = 1)
+    if args.csv:
+        writeCsv(args.csv,metrics)
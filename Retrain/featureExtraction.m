@@ -6,17 +6,11 @@ function features = featureExtraction(basePath)
 addpath(genpath(fullfile(pwd,'Codes')));
 %% Extract features
 % Use Pyradiomics (V 2.2) package from python (3.7)
-% Make sure to adjust the python scripts paths
-%---Manual
-system(fullfile(basePath,'Codes','pyradiomicsFeaturesExtractionManualWithRegions.py'));
-%---UNet2D
-system(fullfile(basePath,'Codes','pyradiomicsFeaturesExtractionUNetWithRegions.py'));
-%---VNet2D
-system(fullfile(basePath,'Codes','pyradiomicsFeaturesExtractionVNetWithRegions.py'));
-%---nnUNet2D
-system(fullfile(basePath,'Codes','pyradiomicsFeaturesExtractionnnUNet2DWithRegions.py'));
-%---nnUNet3D
-system(fullfile(basePath,'Codes','pyradiomicsFeaturesExtractionnnUNet3DWithRegions.py'));
+% Set the segmentation methods, directories and naming patterns in
+% Codes/featureExtractionConfig.json. All methods are extracted at the same
+% time on a shared pool of python processes.
+system(['python ' fullfile(basePath,'Codes','pyradiomicsFeaturesExtractionWithRegions.py') ' ' ...
+    fullfile(basePath,'Codes','featureExtractionConfig.json') ' --base-path ' basePath]);
 
 %% Organize features
 %% settings
@@ -60,34 +60,25 @@ basePath = which('SQC.m');
 basePath = basePath(1:end-6);
 %% Add Dependency
 addpath(genpath(basePath));
-% Make temporary folders
-tempPath = fullfile(basePath,'temp');
-tempFEPath = fullfile(basePath,'tempFE');
+% Make the temporary folders of this job. tempname is unique, so several
+% SQC sessions can run at the same time on one machine
+jobPath = tempname;
+[~,jobId] = fileparts(jobPath);
+tempPath = fullfile(jobPath,'temp');
+tempFEPath = fullfile(jobPath,'tempFE');
 mkdir(tempPath)
 mkdir(tempFEPath)
 %% Give a pseudo number
-CaseNumber = ['Case' num2str(randi([100 999]))];
+CaseNumber = ['Case' jobId];
 %% Segmentation preparing
 segPath = segPrep(segPathIn,CaseNumber,tempPath);
 %% Normalize using AutoRef
 FileCaseNumberNorm = checkNormalization(scanPath,normStatus,CaseNumber,tempPath);
 %% Feature extraction
-% Wrtie paths to txt file to read in python
-FileCaseNumberPaths = fullfile(basePath,'paths.txt');
-fileID = fopen(FileCaseNumberPaths,'w');
-fprintf(fileID,'%s\n',FileCaseNumberNorm);
-fprintf(fileID,'%s\n',segPath);
-fprintf(fileID,'%s\n',tempFEPath);
-fprintf(fileID,'%s\n',CaseNumber);
-fprintf(fileID,'%s\n',tempPath);
-fclose(fileID);
 % Run Pyradiomics feature extraction script from python And organize the resulted features
-features = featureExtraction(basePath,CaseNumber);
+features = featureExtraction(basePath,FileCaseNumberNorm,segPath,tempFEPath,CaseNumber,jobId);
 % Clean after
-rmdir(tempPath,'s')
-rmdir(tempFEPath,'s')
-delete(FileCaseNumberPaths)
-rehash()
+rmdir(jobPath,'s')
 %% Get Quality Score
 qualityScore = getQS(basePath,features);
 %% Get Quality Class
@@ -191,92 +182,39 @@ end
 %% ---- Features extraction ---- %
 % 1- Extrat features usign Deep learning masks
 %    Using pyradiomics from python.
-% 2- Organize the features in tables and one strucutre.
+% 2- Load the features of the case as one table row.
 %
 % Input:
 %   basePath: The path tp the master folder where the SQC.m file located. (string)
 %
+%   scanPath: The normalized pseudonymized scan path. (string)
+%
+%   segPath: The prepared segmentation path. (string)
+%
+%   resultsPath: The folder the features are written to. (string)
+%
 %   CaseNumber: A given pseudo number. (string)
 %
+%   jobId: The unique id of the job. (string)
+%
 % Output:
 %   features: The extracted radiomics features. (table)
 %
-function features = featureExtraction(basePath,CaseNumber)
+function features = featureExtraction(basePath,scanPath,segPath,resultsPath,CaseNumber,jobId)
 %% Extract features
 % Use Pyradiomics (V 2.2) package from python (3.7)
-[~,~] = system(['python ' fullfile(basePath,'pyradiomicsFeatureExtraction.py')]);
+% The case goes to the running pyradiomicsWorker.py if there is one,
+% otherwise it is extracted in a new python process
+% The job is given on the command line, nothing is shared with other jobs
+[~,~] = system(['python "' fullfile(basePath,'pyradiomicsWorker.py') '" --submit --image "' scanPath '" --mask "' segPath ...
+    '" --results "' resultsPath '" --case ' CaseNumber ' --job-id ' jobId ' --format mat --prune']);
 
-%% Organize features
-% region classes
-region_classes = {'wholeprostate','apex','base'};
-% feature classes
-feature_classes = {'firstorder','shape','glcm','glrlm','glszm','ngtdm','gldm'};
-% Fill arrays
-for rr = 1:length(region_classes)
-    for ff = 1:length(feature_classes)
-        % create table
-        table_name = sprintf('table_%s_%s',region_classes{rr},feature_classes{ff});
-        eval([table_name ' = table;']);
-        % get jsonname
-        json_name = sprintf('%s_%s_%s.json',CaseNumber,region_classes{rr},feature_classes{ff});
-        % read in and convert
-        if exist(fullfile(basePath,'tempFE',json_name),'file')
-            data = loadjson(fullfile(basePath,'tempFE',json_name));
-            names = fieldnames(data);
-            fdata = rmfield(data,names(~contains(names,feature_classes{ff})));
-            colNames = fieldnames(fdata);
-            % preallocate cell array
-            colNamesNew = cell(numel(colNames),1);
-            % loop to get variables names array
-            for jj = 1:numel(colNames)
-                colNamesNew{jj,:} = colNames{jj}(10:end);
-            end
-            % create temp table for each case
-            tmp_table = struct2table(fdata);
-            tmp_table.Properties.RowNames = {sprintf(CaseNumber)};
-            tmp_table.Properties.VariableNames = colNamesNew;
-            % add the tables together
-            eval([table_name ' = [' table_name '; tmp_table];']);
-            clear colNames colNamesNew
-        end
-    end
-end
-
-%% Combine tables based on region classes
-% Whole prostate
-features_table_wholeprostate = [table_wholeprostate_firstorder,table_wholeprostate_shape,...
-    table_wholeprostate_glcm,table_wholeprostate_glrlm,table_wholeprostate_glszm,...
-    table_wholeprostate_ngtdm,table_wholeprostate_gldm];
-% Rename variables
-vn = cell(1,size(features_table_wholeprostate,2));
-for kk = 1:size(features_table_wholeprostate,2)
-    vn{kk} = [features_table_wholeprostate.Properties.VariableNames{kk} '_WP'];
-end
-features_table_wholeprostate.Properties.VariableNames = vn;
-% Apex
-features_table_apex = [table_apex_firstorder,table_apex_shape,...
-    table_apex_glcm,table_apex_glrlm,table_apex_glszm,...
-    table_apex_ngtdm,table_apex_gldm];
-% Rename variables
-vn = cell(1,size(features_table_apex,2));
-for kk = 1:size(features_table_apex,2)
-    vn{kk} = [features_table_apex.Properties.VariableNames{kk} '_Apex'];
-end
-features_table_apex.Properties.VariableNames = vn;
-% Base
-features_table_base = [table_base_firstorder,table_base_shape,...
-    table_base_glcm,table_base_glrlm,table_base_glszm,...
-    table_base_ngtdm,table_base_gldm];
-% Rename variables
-vn = cell(1,size(features_table_base,2));
-for kk = 1:size(features_table_base,2)
-    vn{kk} = [features_table_base.Properties.VariableNames{kk} '_Base'];
-end
-features_table_base.Properties.VariableNames = vn;
-% Combine All
-features_table_all = [features_table_wholeprostate,features_table_apex,features_table_base];
-% Assign to structure
-features = features_table_all;
+%% Load features
+% All regions and feature classes of the case are in one MAT file, with the
+% features in the column order of trainedModel.coef. Only the features with a
+% nonzero coefficient are extracted (--prune)
+ld = load(fullfile(resultsPath,[CaseNumber '_features.mat']));
+features = array2table(ld.features,'VariableNames',cellstr(ld.featureNames),'RowNames',{CaseNumber});
 end
 
 %% ---- Get Quality score ---- %
@@ -294,10 +232,12 @@ function qualityScore = getQS(basePath,features)
 % Load trained model
 ld = load(fullfile(basePath,'trainedModel.mat'));
 trainedModel = ld.trainedModel;
-% Change predictors format
-predictors = table2array(features);
+% Change predictors format, the chosen variables are the features with a
+% nonzero coefficient in the same order
+chosen = trainedModel.coef ~= 0;
+predictors = table2array(features(:,cellstr(trainedModel.chosenVariables)));
 % Predict Quality Score
-qualityScore = predictors*trainedModel.coef + trainedModel.Intercept;
+qualityScore = predictors*trainedModel.coef(chosen) + trainedModel.Intercept;
 if qualityScore < 0
     qualityScore = 0;
 elseif qualityScore > 100
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Overlapped read, extraction and write of a stream of cases
+
+Reading a case, extracting its features and writing them happen one after
+the other in a plain loop, so the CPU idles while the disk works and the
+other way round. CasePipeline reads the next prefetch cases on background
+threads (SimpleITK and the numpy copies of memory mapped data release the
+GIL), extracts in the calling thread and hands the results to a writer
+thread through a queue of at most write_depth cases. The statistics tell how
+long extraction waited for reads (raise prefetch) and for a full write queue
+(raise write_depth, or the disk is the bottleneck).
+"""
+
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+
+class CasePipeline:
+    # read_in(job) -> case, extract_in(job,case) -> results and write_in(job,results)
+    # are the stages. done_in(job,results,error,seconds) is called from the writer
+    # thread once a job is written or has failed in any stage.
+    def __init__(self,read_in,extract_in,write_in,done_in,prefetch=2,write_depth=8):
+        self.read = read_in
+        self.extract = extract_in
+        self.write = write_in
+        self.done = done_in
+        self.prefetch = max(1,prefetch)
+        self.write_depth = max(1,write_depth)
+        self.stats = {'prefetch': self.prefetch, 'write_depth': self.write_depth, 'cases': 0,
+                      'read_stalls': 0, 'read_stall_seconds': 0.0, 'ready_ahead': 0,
+                      'extract_seconds': 0.0, 'write_stall_seconds': 0.0, 'write_seconds': 0.0,
+                      'max_write_queue': 0}
+
+    # Read a job on a read-ahead thread, returns the case and the read time
+    def timedRead(self,job_in):
+        start = time.perf_counter()
+        case = self.read(job_in)
+        return case,time.perf_counter()-start
+
+    def writer(self,write_queue_in):
+        while True:
+            item = write_queue_in.get()
+            if item is None:
+                return
+            job,results,error,seconds = item
+            if error is None:
+                start = time.perf_counter()
+                try:
+                    self.write(job,results)
+                except Exception as e:
+                    error = '%s: %s' % (type(e).__name__,e)
+                write_seconds = time.perf_counter()-start
+                self.stats['write_seconds'] += write_seconds
+                seconds += write_seconds
+            try:
+                self.done(job,results,error,seconds)
+            except Exception as e:
+                # raised by run once all jobs are through, the queue keeps draining
+                self.failure = e
+
+    # Run all jobs, returns the pipeline statistics
+    def run(self,jobs_in):
+        jobs = iter(jobs_in)
+        self.failure = None
+        write_queue = queue.Queue(self.write_depth)
+        writer = threading.Thread(target=self.writer,args=(write_queue,),daemon=True)
+        writer.start()
+        with concurrent.futures.ThreadPoolExecutor(self.prefetch) as readers:
+            reads = collections.deque()
+            for job in jobs:
+                reads.append((job,readers.submit(self.timedRead,job)))
+                if len(reads) == self.prefetch:
+                    break
+            while reads:
+                job,read = reads.popleft()
+                # the cases read ahead that are ready when this one is needed
+                self.stats['ready_ahead'] += sum(1 for _,pending in reads if pending.done())
+                if not read.done():
+                    self.stats['read_stalls'] += 1
+                start = time.perf_counter()
+                try:
+                    case,read_seconds = read.result()
+                except Exception as e:
+                    case,read_seconds,error = None,0.0,'%s: %s' % (type(e).__name__,e)
+                else:
+                    error = None
+                self.stats['read_stall_seconds'] += time.perf_counter()-start
+                # keep prefetch reads in flight
+                for next_job in jobs:
+                    reads.append((next_job,readers.submit(self.timedRead,next_job)))
+                    break
+                results = None
+                start = time.perf_counter()
+                if error is None:
+                    try:
+                        results = self.extract(job,case)
+                    except Exception as e:
+                        error = '%s: %s' % (type(e).__name__,e)
+                del case
+                extract_seconds = time.perf_counter()-start
+                self.stats['extract_seconds'] += extract_seconds
+                start = time.perf_counter()
+                write_queue.put((job,results,error,read_seconds+extract_seconds))
+                self.stats['write_stall_seconds'] += time.perf_counter()-start
+                self.stats['max_write_queue'] = max(self.stats['max_write_queue'],write_queue.qsize())
+                self.stats['cases'] += 1
+        write_queue.put(None)
+        writer.join()
+        if self.failure is not None:
+            raise self.failure
+        return self.stats
+
+# Combine the statistics of several pipelines, e.g. one per worker process
+def mergeStats(stats_in):
+    stats_in = [stats for stats in stats_in if stats]
+    if not stats_in:
+        return {}
+    merged = {'prefetch': stats_in[0]['prefetch'], 'write_depth': stats_in[0]['write_depth'],
+              'max_write_queue': max(stats['max_write_queue'] for stats in stats_in)}
+    for key in ('cases','read_stalls','read_stall_seconds','ready_ahead','extract_seconds','write_stall_seconds','write_seconds'):
+        merged[key] = sum(stats[key] for stats in stats_in)
+    merged['mean_ready_ahead'] = merged['ready_ahead']/merged['cases'] if merged['cases'] else 0.0
+    return merged
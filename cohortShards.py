@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Deterministic sharding of a cohort over array jobs, and the merge of the shards
+
+Shard k of n (k = 0..n-1) gets a fixed, size balanced part of the manifest:
+the cases are weighted by the voxel count of their scan, read from the image
+header only, and assigned from the largest to the smallest to the shard with
+the least voxels so far (ties by case name and shard number). Every array
+task computes the same assignment from the same manifest, without talking to
+the others. A header that cannot be read stops the shard run before any case
+is extracted, as the tasks would not agree on the shards otherwise. Every
+shard upserts its features into a feature store of its own
+(<store>/shard-<k>-of-<n>), so the tasks never write the same file. The merge
+reads the shard stores into one feature table, checks that every case of the
+manifest is in it with all its regions, and reports the cases that are
+missing. local runs the n shards as processes on this machine, as a test of
+the setup before it goes to a cluster.
+
+Usage:
+    python pyradiomicsBatch.py manifest.csv --results FOLDER --store STORE --shard $SLURM_ARRAY_TASK_ID/8
+    python cohortShards.py merge manifest.csv --store STORE --output features.csv --into MERGED_STORE
+    python cohortShards.py plan manifest.csv --shards 8
+    python cohortShards.py local manifest.csv --shards 4 --store STORE --output features.csv -- --results FOLDER --workers 1
+"""
+
+import argparse
+import csv
+import glob
+import os
+import re
+import subprocess
+import sys
+
+import numpy as np
+
+import featureStore
+import metaImage
+
+base_path = os.path.dirname(os.path.abspath(__file__))
+
+# region classes every case has by default, as extracted by pyradiomicsBatch.py
+default_regions = ['wholeprostate','apex','base']
+
+shard_regex = re.compile(r'^shard-(?P<shard>\d+)-of-(?P<nr_shards>\d+)$')
+
+def shardName(shard_in,nr_shards_in):
+    return 'shard-%03d-of-%03d' % (shard_in,nr_shards_in)
+
+# 'k/n' -> (k,n), k counts from 0 as SLURM and PBS array indices do
+def parseShard(shard_in):
+    shard,sep,nr_shards = shard_in.partition('/')
+    if not sep or not shard.isdigit() or not nr_shards.isdigit() or int(shard) >= int(nr_shards):
+        raise ValueError('shard %r is not k/n with 0 <= k < n' % shard_in)
+    return int(shard),int(nr_shards)
+
+# Voxel count of an image from its header, without reading the voxels
+def imageVoxels(file_in):
+    if os.path.splitext(file_in)[1].lower() in ('.mhd','.mha'):
+        header,_ = metaImage.readHeader(file_in)
+        return int(np.prod([int(size) for size in header['DimSize'].split()]))
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(file_in)
+    reader.ReadImageInformation()
+    return int(np.prod(reader.GetSize()))
+
+# Voxel count of the scan of every job. An image whose header cannot be read
+# (missing, or a file system hiccup in one array task only) raises ValueError:
+# a weight of 0 in one task and the real one in another gives shards that
+# overlap and miss cases.
+def jobWeights(jobs_in):
+    weights = []
+    unreadable = []
+    for job in jobs_in:
+        try:
+            weights.append(imageVoxels(job['image']))
+        except (OSError,KeyError,ValueError,RuntimeError) as e:
+            unreadable.append('%s (%s)' % (job['image'],e))
+    if unreadable:
+        raise ValueError('cannot read the image header of %d cases, the shards need the size of every case: %s'
+                         % (len(unreadable),'; '.join(unreadable[:5])))
+    return weights
+
+# Key of a job that decides the order among cases of the same size
+def jobKey(job_in):
+    return (job_in.get('method',''),job_in['case'],job_in['image'],job_in['mask'])
+
+# Shard of every job: largest first to the lightest shard. Returns a shard
+# number per job, in the order of the jobs, and the voxels per shard.
+def assignShards(jobs_in,nr_shards_in,weights=None):
+    weights = jobWeights(jobs_in) if weights is None else list(weights)
+    order = sorted(range(len(jobs_in)),key = lambda ii: (-weights[ii],jobKey(jobs_in[ii])))
+    shard_voxels = [0]*nr_shards_in
+    shards = [0]*len(jobs_in)
+    for ii in order:
+        shard = min(range(nr_shards_in),key = lambda jj: (shard_voxels[jj],jj))
+        shards[ii] = shard
+        shard_voxels[shard] += weights[ii]
+    return shards,shard_voxels
+
+# Jobs of shard k of n, in manifest order
+def shardJobs(jobs_in,shard_in,nr_shards_in):
+    shards,shard_voxels = assignShards(jobs_in,nr_shards_in)
+    return [job for job,shard in zip(jobs_in,shards) if shard == shard_in],shard_voxels[shard_in]
+
+# Feature store of a shard, one per shard so array tasks never share a file
+def shardStore(store_path_in,shard_in,nr_shards_in):
+    return os.path.join(store_path_in,shardName(shard_in,nr_shards_in))
+
+# Report file of a shard: report.json -> report.shard-003-of-008.json
+def shardReport(report_file_in,shard_in,nr_shards_in):
+    root,ext = os.path.splitext(report_file_in)
+    return root+'.'+shardName(shard_in,nr_shards_in)+ext
+
+# Shard stores in a store folder as {shard: path}, all of the same n
+def findShards(store_path_in):
+    shards = {}
+    for path in sorted(glob.glob(os.path.join(store_path_in,'shard-*-of-*'))):
+        match = shard_regex.match(os.path.basename(path))
+        if match:
+            shards[(int(match.group('shard')),int(match.group('nr_shards')))] = path
+    counts = {nr_shards for _,nr_shards in shards}
+    if len(counts) > 1:
+        raise ValueError('%s has shards of different runs (n = %s)' % (store_path_in,', '.join(str(count) for count in sorted(counts))))
+    return {shard: path for (shard,_),path in shards.items()},(counts.pop() if counts else 0)
+
+# Merge the shard stores into one table. Returns the keys, feature names,
+# values and a report with the missing shards, cases and regions. Every
+# (case, method) of jobs_in must be there with every region of regions_in.
+def mergeShards(jobs_in,store_path_in,regions_in=default_regions):
+    shards,nr_shards = findShards(store_path_in)
+    rows = {}
+    duplicates = []
+    names = set()
+    tables = []
+    for shard,path in sorted(shards.items()):
+        keys,shard_names,values = featureStore.FeatureStore(path).table()
+        tables.append((keys,shard_names,values))
+        names.update(shard_names)
+        for key in keys:
+            if key in rows:
+                duplicates.append(key)
+            rows[key] = shard
+    names = sorted(names)
+    columns = {name: ii for ii,name in enumerate(names)}
+    keys = sorted(rows)
+    positions = {key: ii for ii,key in enumerate(keys)}
+    merged = np.full((len(keys),len(names)),np.nan)
+    # the shards in order, a key in two shards keeps the row of the last one
+    for shard_keys,shard_names,values in tables:
+        target = [columns[name] for name in shard_names]
+        for row,key in enumerate(shard_keys):
+            merged[positions[key],target] = values[row]
+    expected = sorted({(job['case'],job.get('method',''),region) for job in jobs_in for region in job.get('regions') or regions_in})
+    missing = [key for key in expected if key not in rows]
+    report = {'shards': len(shards), 'nr_shards': nr_shards,
+              'missing_shards': [shard for shard in range(nr_shards) if shard not in shards],
+              'cases': len({(job['case'],job.get('method','')) for job in jobs_in}),
+              'rows': len(keys), 'features': len(names),
+              'missing_rows': [list(key) for key in missing],
+              'missing_cases': sorted({'/'.join(filter(None,(method,case))) for case,method,_ in missing}),
+              'duplicate_rows': [list(key) for key in sorted(set(duplicates))]}
+    report['complete'] = not report['missing_rows'] and not report['missing_shards']
+    return keys,names,merged,report
+
+# One row per (case, method, region), one column per feature
+def writeTable(table_file_in,keys_in,names_in,values_in):
+    with open(table_file_in,'w',newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['case','method','region']+names_in)
+        for key,row in zip(keys_in,values_in):
+            writer.writerow(list(key)+['' if np.isnan(value) else repr(float(value)) for value in row])
+
+# Upsert the merged table into one feature store
+def writeStore(store_path_in,keys_in,names_in,values_in):
+    store = featureStore.FeatureStore(store_path_in)
+    store.upsert((case,method,region,{name: value for name,value in zip(names_in,row) if not np.isnan(value)})
+                 for (case,method,region),row in zip(keys_in,values_in))
+    store.compact()
+
+def printReport(report_in):
+    print('%d of %d shards, %d cases, %d (case, method, region) rows with %d features'
+          % (report_in['shards'],report_in['nr_shards'],report_in['cases'],report_in['rows'],report_in['features']))
+    if report_in['missing_shards']:
+        print('missing shards: %s' % ', '.join(str(shard) for shard in report_in['missing_shards']))
+    if report_in['missing_cases']:
+        print('%d cases missing or incomplete: %s' % (len(report_in['missing_cases']),', '.join(report_in['missing_cases'][:20])))
+    if report_in['duplicate_rows']:
+        print('%d rows in more than one shard, the last shard is kept' % len(report_in['duplicate_rows']))
+    print('complete' if report_in['complete'] else 'INCOMPLETE')
+
+# Run the n shards of a manifest as pyradiomicsBatch.py processes on this
+# machine, as n array tasks would. Returns the exit code of every shard.
+def runLocal(manifest_in,nr_shards_in,store_path_in,batch_args_in):
+    processes = []
+    for shard in range(nr_shards_in):
+        command = [sys.executable,os.path.join(base_path,'pyradiomicsBatch.py'),manifest_in,'--store',store_path_in,
+                   '--shard','%d/%d' % (shard,nr_shards_in)]+list(batch_args_in)
+        processes.append(subprocess.Popen(command))
+    return [process.wait() for process in processes]
+
+def readJobs(manifest_in,method_in=None):
+    import pyradiomicsBatch
+    jobs = pyradiomicsBatch.readManifest(manifest_in,'.')
+    if method_in:
+        for job in jobs:
+            job['method'] = method_in
+    return jobs
+
+def merge(args_in):
+    keys,names,values,report = mergeShards(readJobs(args_in.manifest,args_in.method),args_in.store,args_in.regions)
+    printReport(report)
+    if args_in.output:
+        writeTable(args_in.output,keys,names,values)
+    if args_in.into:
+        writeStore(args_in.into,keys,names,values)
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Deterministic size balanced shards of a cohort and the merge of their features')
+    commands = parser.add_subparsers(dest='command',required=True)
+    command = commands.add_parser('plan',help='print the shards of a manifest')
+    command.add_argument('manifest')
+    command.add_argument('--shards',type=int,required=True,help='number of shards')
+    for name,description in (('merge','merge the shard stores into one feature table and check that every case is there'),
+                             ('local','run the shards as processes on this machine, then merge them')):
+        command = commands.add_parser(name,help=description)
+        command.add_argument('manifest')
+        command.add_argument('--store',required=True,help='folder with the shard feature stores')
+        command.add_argument('--method',help='segmentation method the cases are stored under, as given to pyradiomicsBatch.py')
+        command.add_argument('--regions',nargs='+',default=default_regions,help='regions every case must have (default: %s)'
+                             % ' '.join(default_regions))
+        command.add_argument('--output',help='write the merged table to this CSV file')
+        command.add_argument('--into',help='upsert the merged table into this feature store')
+        if name == 'local':
+            command.add_argument('--shards',type=int,required=True,help='number of shards')
+    # the options after -- are passed on to pyradiomicsBatch.py by local
+    argv = sys.argv[1:]
+    batch_args = argv[argv.index('--')+1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+    if args.command == 'plan':
+        jobs = readJobs(args.manifest)
+        try:
+            weights = jobWeights(jobs)
+        except ValueError as e:
+            sys.exit(str(e))
+        shards,shard_voxels = assignShards(jobs,args.shards,weights)
+        for shard in range(args.shards):
+            print('%s: %d cases, %d voxels' % (shardName(shard,args.shards),shards.count(shard),shard_voxels[shard]))
+        print('largest shard %.1f%% above the mean' % (100*(max(shard_voxels)/(sum(shard_voxels)/args.shards)-1) if sum(shard_voxels) else 0.0))
+    else:
+        if args.command == 'local':
+            if args.method:
+                batch_args += ['--method',args.method]
+            codes = runLocal(args.manifest,args.shards,args.store,batch_args)
+            print('shard exit codes: %s' % ' '.join(str(code) for code in codes))
+        report = merge(args)
+        sys.exit(0 if report['complete'] else 1)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of feature extraction and scoring on synthetic phantoms
+
+Generates T2W-like volumes with an ellipsoidal prostate at the requested
+sizes, spacing and segmentation error levels, writes them as MetaIO files
+like SQC.m does, and times every stage of a case: read, region split,
+getSettings, every feature class of every region, the single pass
+extraction, serialization in every output format and scoring. It also
+records how the extraction time scales with the volume size and how the batch
+throughput scales with the number of workers. The results are saved as JSON;
+--compare prints the ratio of every stage to an earlier run.
+
+Usage:
+    python extractionBenchmark.py --output bench.json
+    python extractionBenchmark.py --sizes 128 256 512 --errors 0 0.1 0.3 --workers 1 2 4 --output bench.json
+    python extractionBenchmark.py --quick --compare bench.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+import featureCache
+import featureWriter
+import metaImage
+import pyradiomicsBatch
+import pyradiomicsFeatureExtraction as extraction
+
+# Box blur of a volume along the given axes, cheap smooth noise without scipy
+def boxBlur(array_in,width_in,axes_in):
+    blurred = array_in
+    for axis in axes_in:
+        padded = np.concatenate([np.take(blurred,[0]*width_in,axis=axis),blurred,np.take(blurred,[-1]*width_in,axis=axis)],axis=axis)
+        cumulative = np.cumsum(padded,axis=axis)
+        upper = np.take(cumulative,range(2*width_in,cumulative.shape[axis]),axis=axis)
+        lower = np.take(cumulative,range(0,cumulative.shape[axis]-2*width_in),axis=axis)
+        blurred = (upper-lower)/(2*width_in)
+    return blurred
+
+# Synthetic T2W-like scan with an ellipsoidal prostate.
+# size_in is (slices, rows, columns) and spacing_in (x, y, z) in mm as in
+# SimpleITK. error_in scales the distortion of the segmentation: its radii,
+# centre and boundary are perturbed by up to that fraction. Returns the image,
+# the segmentation and the Dice coefficient of the segmentation with the prostate.
+def makePhantom(size_in,spacing_in,error_in=0.0,seed=0):
+    rng = np.random.default_rng(seed)
+    nr_slices,nr_rows,nr_columns = size_in
+    zz,yy,xx = [(np.arange(n)-(n-1)/2)*spacing for n,spacing in zip(size_in,spacing_in[::-1])]
+    zz,yy,xx = zz[:,None,None],yy[None,:,None],xx[None,None,:]
+    extent = np.array([nr_slices*spacing_in[2],nr_rows*spacing_in[1],nr_columns*spacing_in[0]])
+    # a prostate of about 4 x 3.5 x 5 cm, smaller if the field of view is small
+    radii = np.minimum([20.0,17.5,25.0],0.35*extent)
+    distance = (zz/radii[0])**2+(yy/radii[1])**2+(xx/radii[2])**2
+    prostate = distance <= 1
+    # tissue texture: smoothed noise, brighter prostate with its own texture, acquisition noise
+    texture = boxBlur(rng.normal(0,1,size_in),3,(1,2))
+    image = 250+60*texture+180*prostate+40*texture*prostate+rng.normal(0,15,size_in)
+    # segmentation with an error proportional to error_in
+    seg_radii = radii*(1+error_in*rng.uniform(-1,1,3))
+    centre = error_in*radii*rng.uniform(-0.5,0.5,3)
+    seg_distance = ((zz-centre[0])/seg_radii[0])**2+((yy-centre[1])/seg_radii[1])**2+((xx-centre[2])/seg_radii[2])**2
+    boundary_noise = error_in*boxBlur(rng.normal(0,1,size_in),2,(1,2))*3
+    mask = (seg_distance+boundary_noise <= 1).astype(np.uint8)
+    dice = 2*np.count_nonzero(prostate & (mask == 1))/(np.count_nonzero(prostate)+np.count_nonzero(mask))
+    return image,mask,dice
+
+def writePhantom(folder_in,case_in,image_in,mask_in,spacing_in):
+    image_file = os.path.join(folder_in,case_in+'_normalized.mhd')
+    mask_file = os.path.join(folder_in,case_in+'_segmentation.mhd')
+    for array,file in ((image_in,image_file),(mask_in,mask_file)):
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing(spacing_in)
+        sitk.WriteImage(image,file)
+    return image_file,mask_file
+
+# Median and minimum of repeats_in runs of function_in, and its last result
+def timeStage(function_in,repeats_in):
+    seconds = []
+    for _ in range(repeats_in):
+        start = time.perf_counter()
+        result = function_in()
+        seconds.append(time.perf_counter()-start)
+    return {'median': statistics.median(seconds), 'min': min(seconds)},result
+
+# Time every stage of one phantom case
+def benchmarkCase(image_file_in,mask_file_in,results_dir_in,repeats_in):
+    stages = {}
+    stages['read'],case = timeStage(lambda: extraction.readCase(image_file_in,mask_file_in,load=True),repeats_in)
+    image_array,mask_array,geometry,mask_geometry = case
+    stages['region_split'],(label_map_array,settings) = timeStage(lambda: extraction.getRegions(image_array,mask_array),repeats_in)
+    # the intensity range of every region back from its bin width
+    stages['getSettings'],_ = timeStage(lambda: [extraction.getSettings(settings[region_class]['binWidth']*64,64) for region_class in settings],repeats_in)
+    image = metaImage.toImage(image_array,geometry)
+    mask = metaImage.toImage(mask_array,mask_geometry)
+    label_map = sitk.GetImageFromArray(label_map_array)
+    label_map.CopyInformation(mask)
+    classes = {}
+    for region_class in extraction.region_classes:
+        region_mask = mask if region_class == 'wholeprostate' else label_map
+        for feature_class in extraction.feature_classes:
+            classes['%s/%s' % (region_class,feature_class)],_ = timeStage(
+                lambda: extraction.extractRegion(image,region_mask,settings[region_class],[feature_class],True,extraction.region_labels.get(region_class,1)),repeats_in)
+    stages['classes'] = classes
+    stages['extraction'],results = timeStage(lambda: extraction.extractCase(case),repeats_in)
+    serialization = {}
+    for output_format in featureWriter.output_formats:
+        try:
+            serialization[output_format],_ = timeStage(lambda: extraction.writeResults(results_dir_in,'Bench',results,output_format),repeats_in)
+        except ImportError:
+            # the mat format needs scipy
+            pass
+    stages['serialization'] = serialization
+    stages['hash'],_ = timeStage(lambda: featureCache.imageHash(image_array,geometry),repeats_in)
+    try:
+        import qualityScore
+        stages['model_load'],model = timeStage(qualityScore.loadModel,1)
+        stages['scoring'],_ = timeStage(lambda: model.scoreResults(results),repeats_in)
+    except (ImportError,OSError):
+        # no scipy or no trainedModel.mat
+        pass
+    return stages
+
+# Batch throughput on nr_cases_in cases for every worker count
+def benchmarkWorkers(image_file_in,mask_file_in,results_dir_in,workers_in,nr_cases_in):
+    curve = []
+    for nr_workers in workers_in:
+        jobs = [{'image': image_file_in, 'mask': mask_file_in, 'case': 'Bench%03d' % ii, 'results': results_dir_in}
+                for ii in range(nr_cases_in)]
+        _,summary = pyradiomicsBatch.runBatch(jobs,nr_workers,verbose=False)
+        curve.append({'workers': nr_workers, 'cases': nr_cases_in, 'wall_seconds': summary['wall_seconds'],
+                      'cases_per_minute': summary['cases_per_minute'], 'failed': summary['failed']})
+    return curve
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__, 'SimpleITK': sitk.Version_VersionString(), 'pyradiomics': featureCache.radiomicsVersion()}
+
+def runBenchmark(sizes_in,slices_in,spacing_in,errors_in,workers_in,repeats_in,nr_cases_in):
+    report = {'environment': environment(),
+              'config': {'sizes': sizes_in, 'slices': slices_in, 'spacing': spacing_in, 'errors': errors_in,
+                         'workers': workers_in, 'repeats': repeats_in, 'cases': nr_cases_in},
+              'cases': [], 'scaling': {'size': [], 'workers': []}}
+    with tempfile.TemporaryDirectory() as folder:
+        for size in sizes_in:
+            for error in errors_in:
+                image,mask,dice = makePhantom((slices_in,size,size),spacing_in,error)
+                name = 'size%d_error%g' % (size,error)
+                image_file,mask_file = writePhantom(folder,name,image,mask,spacing_in)
+                del image,mask
+                print('%s (dice %.3f)' % (name,dice))
+                sys.stdout.flush()
+                stages = benchmarkCase(image_file,mask_file,folder,repeats_in)
+                report['cases'].append({'name': name, 'size': [slices_in,size,size], 'error': error, 'dice': dice, 'stages': stages})
+                if error == errors_in[0]:
+                    report['scaling']['size'].append({'size': [slices_in,size,size], 'voxels': slices_in*size*size,
+                                                      'read': stages['read']['median'],
+                                                      'extraction': stages['extraction']['median']})
+        if workers_in:
+            image,mask,_ = makePhantom((slices_in,sizes_in[0],sizes_in[0]),spacing_in,errors_in[0])
+            image_file,mask_file = writePhantom(folder,'workers',image,mask,spacing_in)
+            report['scaling']['workers'] = benchmarkWorkers(image_file,mask_file,folder,workers_in,nr_cases_in or 2*max(workers_in))
+    return report
+
+# Stage name -> median seconds of a case, with the classes as <region>/<class>
+def flattenStages(stages_in,prefix=''):
+    flat = {}
+    for name,value in stages_in.items():
+        if 'median' in value:
+            flat[prefix+name] = value['median']
+        else:
+            flat.update(flattenStages(value,prefix+name+':'))
+    return flat
+
+def printReport(report_in,baseline_in=None):
+    baseline = {case['name']: flattenStages(case['stages']) for case in (baseline_in or {}).get('cases',[])}
+    for case in report_in['cases']:
+        print('\n%s, %d x %d x %d voxels, dice %.3f' % tuple([case['name']]+case['size']+[case['dice']]))
+        old = baseline.get(case['name'],{})
+        for name,seconds in flattenStages(case['stages']).items():
+            ratio = '  x%.2f' % (seconds/old[name]) if old.get(name) else ''
+            print('  %-32s %9.4f s%s' % (name,seconds,ratio))
+    if report_in['scaling']['size']:
+        print('\nvoxels          read s  extraction s')
+        for point in report_in['scaling']['size']:
+            print('%-12d %9.3f %13.3f' % (point['voxels'],point['read'],point['extraction']))
+    if report_in['scaling']['workers']:
+        print('\nworkers  cases/min')
+        for point in report_in['scaling']['workers']:
+            print('%-8d %9.1f' % (point['workers'],point['cases_per_minute']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark feature extraction and scoring on synthetic phantoms')
+    parser.add_argument('--sizes',type=int,nargs='+',default=[128,256,512],help='in-plane sizes of the phantoms in voxels')
+    parser.add_argument('--slices',type=int,default=24,help='number of slices of the phantoms')
+    parser.add_argument('--spacing',type=float,nargs=3,default=[0.5,0.5,3.0],metavar=('X','Y','Z'),help='voxel spacing in mm')
+    parser.add_argument('--errors',type=float,nargs='+',default=[0.0,0.2],help='segmentation error levels (0 is a perfect segmentation)')
+    parser.add_argument('--workers',type=int,nargs='*',default=[1,2,4],help='worker counts of the batch throughput curve')
+    parser.add_argument('--cases',type=int,help='cases per point of the throughput curve (default: twice the largest worker count)')
+    parser.add_argument('--repeats',type=int,default=3,help='runs per stage, the median is reported')
+    parser.add_argument('--quick',action='store_true',help='one small phantom, one repeat, one worker')
+    parser.add_argument('--output',help='save the results to this JSON file')
+    parser.add_argument('--compare',help='JSON results of an earlier run to compare the stages with')
+    args = parser.parse_args()
+    if args.quick:
+        args.sizes,args.errors,args.workers,args.repeats = [128],[0.0],[1],1
+    # radiomics sets its log level when it is imported
+    import radiomics
+    logging.getLogger('radiomics').setLevel(logging.ERROR)
+    report = runBenchmark(args.sizes,args.slices,args.spacing,args.errors,args.workers,args.repeats,args.cases)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    printReport(report,baseline)
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(report,f,indent=1)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Content addressed on-disk cache of the extracted features of a case
+
+The key of a case is a hash of the image and mask voxels (with their
+geometry), the effective extractor settings of every region (binWidth,
+correctMask, ...), the features to extract and the pyradiomics version. An
+entry holds the feature vectors per region and feature class as JSON. Entries
+are written atomically, a hit marks the entry as recently used, and when the
+cache grows beyond max_bytes the least recently used entries are removed.
+Nothing here imports radiomics, so a hit does not load it.
+
+Usage:
+    python featureCache.py CACHE stats
+    python featureCache.py CACHE clear
+"""
+
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import featureWriter
+
+# bump when the layout of an entry changes
+cache_format = 1
+
+def radiomicsVersion():
+    try:
+        from importlib import metadata
+        return metadata.version('pyradiomics')
+    except Exception:
+        return 'unknown'
+
+# Hash of the voxels of an image array and its geometry (see metaImage.py)
+def imageHash(array_in,geometry_in):
+    digest = hashlib.blake2b(digest_size = 16)
+    geometry = [str(array_in.dtype),array_in.shape,geometry_in['spacing'],geometry_in['origin'],geometry_in['direction']]
+    digest.update(json.dumps(geometry).encode('utf-8'))
+    digest.update(np.ascontiguousarray(array_in).data)
+    return digest.hexdigest()
+
+# Key of a case from the image and mask hashes, the settings per region and the
+# features per region (a plan as taken by runCase)
+def caseKey(image_hash_in,mask_hash_in,settings_in,plan_in):
+    description = [cache_format,radiomicsVersion(),image_hash_in,mask_hash_in,
+                   json.dumps(settings_in,sort_keys = True),json.dumps(plan_in)]
+    return hashlib.blake2b(json.dumps(description).encode('utf-8'),digest_size = 16).hexdigest()
+
+def writeEntry(entry_file_in,entry_in):
+    with open(entry_file_in,'w') as f:
+        json.dump(entry_in,f)
+
+class FeatureCache:
+    def __init__(self,path_in,max_bytes=1024**3):
+        self.path = path_in
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(path_in,exist_ok=True)
+
+    def entryFile(self,key_in):
+        return os.path.join(self.path,key_in+'.json')
+
+    # Feature vectors per region and feature class, None on a miss
+    def get(self,key_in):
+        entry_file = self.entryFile(key_in)
+        try:
+            with open(entry_file) as f:
+                results = json.load(f)
+            # the modification time is the last use for the eviction
+            os.utime(entry_file)
+        except (OSError,ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return results
+
+    def put(self,key_in,results_in):
+        entry = {region_class: {feature_class: featureWriter.toNative(featureVector) for feature_class,featureVector in featureVectors.items()}
+                 for region_class,featureVectors in results_in.items()}
+        # a put that fails or is interrupted leaves neither a partial entry nor its temporary file
+        featureWriter.writeAtomic(self.entryFile(key_in),writeEntry,entry)
+        self.evict()
+
+    # (last use, size, file) of every entry, oldest first
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                try:
+                    status = os.stat(os.path.join(self.path,name))
+                except FileNotFoundError:
+                    continue
+                entries.append((status.st_mtime,status.st_size,name))
+        return sorted(entries)
+
+    # Remove the least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _,size,_ in entries)
+        for _,size,name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path,name))
+                self.evictions += 1
+            except FileNotFoundError:
+                # removed by another process sharing the cache
+                pass
+            total -= size
+
+    def stats(self):
+        entries = self.entries()
+        lookups = self.hits+self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits/lookups if lookups else None,
+                'evictions': self.evictions, 'entries': len(entries), 'bytes': sum(size for _,size,_ in entries),
+                'max_bytes': self.max_bytes}
+
+    def clear(self):
+        for _,_,name in self.entries():
+            os.remove(os.path.join(self.path,name))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Content addressed feature cache')
+    parser.add_argument('cache',help='folder of the feature cache')
+    parser.add_argument('command',choices=['stats','clear'])
+    args = parser.parse_args()
+    cache = FeatureCache(args.cache)
+    if args.command == 'stats':
+        stats = cache.stats()
+        print('%d entries, %.1f MB' % (stats['entries'],stats['bytes']/1024**2))
+    else:
+        cache.clear()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar feature store for a cohort
+
+The radiomics features of a cohort are kept in chunked npz files with one
+array per feature, keyed by (case, method, region). Every upsert appends one
+chunk and one line to an append-only index log, and the newest row of a key
+wins, so re-running a few cases only writes those cases. Reading one feature
+across the cohort only loads that feature's array from every chunk. When more
+than max_dead_fraction of the rows in the chunks are replaced ones, the live
+rows are compacted into one chunk; a batch compacts its store once at the end.
+
+Usage:
+    python featureStore.py STORE import FOLDER --method Manual
+    python featureStore.py STORE column original_shape_MeshVolume --method Manual --region wholeprostate
+    python featureStore.py STORE compact
+"""
+
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+
+keys_member = '__keys__'
+
+# <case>_<region>_<feature class>.json as written by pyradiomicsFeatureExtraction.py
+json_name_regex = re.compile(r'^(?P<case>.+)_(?P<region>[^_]+)_(?P<feature_class>[^_]+)\.json$')
+
+# Merge the feature vectors of the feature classes of one region into one
+# dictionary of numeric features, the diagnostics are not stored
+def numericFeatures(featureVectors_in):
+    features = {}
+    for featureVector in featureVectors_in:
+        for key,value in featureVector.items():
+            if not key.startswith('diagnostics_'):
+                features[key] = float(value)
+    return features
+
+class FeatureStore:
+    def __init__(self,path_in,max_dead_fraction=0.5):
+        self.path = path_in
+        self.max_dead_fraction = max_dead_fraction
+        self.index_file = os.path.join(path_in,'index.log')
+        os.makedirs(path_in,exist_ok=True)
+        self.rows = {}
+        self.chunks = []
+        # rows in all chunks, the live rows and the ones replaced since
+        self.nr_chunk_rows = 0
+        self.readIndex()
+        chunk_nrs = [int(name[6:12]) for name in os.listdir(path_in) if re.match(r'^chunk-\d{6}\.npz',name)]
+        self.next_chunk = max(chunk_nrs,default=0)+1
+
+    def readIndex(self):
+        self.rows = {}
+        self.chunks = []
+        self.nr_chunk_rows = 0
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash, its chunk is ignored
+                    continue
+                self.chunks.append(entry['chunk'])
+                self.nr_chunk_rows += len(entry['keys'])
+                for row,key in enumerate(entry['keys']):
+                    self.rows[tuple(key)] = (entry['chunk'],row)
+
+    def keys(self,method=None,region=None):
+        return sorted(key for key in self.rows if (method is None or key[1] == method) and (region is None or key[2] == region))
+
+    def writeChunk(self,keys_in,names_in,values_in):
+        chunk = 'chunk-%06d.npz' % self.next_chunk
+        self.next_chunk += 1
+        temp_file = os.path.join(self.path,chunk+'.tmp')
+        columns = {name: values_in[:,ii] for ii,name in enumerate(names_in)}
+        with open(temp_file,'wb') as f:
+            np.savez(f,**{keys_member: np.array(keys_in,dtype=str).reshape(-1,3)},**columns)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file,os.path.join(self.path,chunk))
+        return chunk
+
+    # Insert or replace rows, records are (case, method, region, {feature name: value})
+    def upsert(self,records_in):
+        records = list(records_in)
+        if not records:
+            return
+        keys = [(str(case),str(method),str(region)) for case,method,region,_ in records]
+        names = sorted(set().union(*[features.keys() for _,_,_,features in records]))
+        values = np.full((len(records),len(names)),np.nan)
+        columns = {name: ii for ii,name in enumerate(names)}
+        for row,(_,_,_,features) in enumerate(records):
+            for name,value in features.items():
+                values[row,columns[name]] = value
+        chunk = self.writeChunk(keys,names,values)
+        with open(self.index_file,'a') as f:
+            f.write(json.dumps({'chunk': chunk, 'keys': keys})+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.chunks.append(chunk)
+        self.nr_chunk_rows += len(keys)
+        for row,key in enumerate(keys):
+            self.rows[key] = (chunk,row)
+        # with more replaced rows than live ones, the upserts since the last
+        # compaction wrote more rows than it rewrites, so compacting stays linear
+        if self.nr_chunk_rows-len(self.rows) > self.max_dead_fraction*self.nr_chunk_rows:
+            self.compact()
+
+    # Live rows of the selected keys grouped per chunk: {chunk: (positions, rows)}
+    def locate(self,keys_in):
+        located = {}
+        for position,key in enumerate(keys_in):
+            chunk,row = self.rows[key]
+            positions,rows = located.setdefault(chunk,([],[]))
+            positions.append(position)
+            rows.append(row)
+        return located
+
+    # One feature across the cohort, returns the keys and a value per key (nan if not extracted)
+    def column(self,feature_in,method=None,region=None):
+        keys = self.keys(method,region)
+        values = np.full(len(keys),np.nan)
+        for chunk,(positions,rows) in self.locate(keys).items():
+            with np.load(os.path.join(self.path,chunk)) as data:
+                if feature_in in data.files:
+                    values[positions] = data[feature_in][rows]
+        return keys,values
+
+    # Features of the selected keys as a matrix, returns the keys, feature names and values
+    def table(self,keys_in=None,features=None):
+        keys = self.keys() if keys_in is None else [tuple(key) for key in keys_in]
+        located = self.locate(keys)
+        if features is None:
+            names = set()
+            for chunk in located:
+                with np.load(os.path.join(self.path,chunk)) as data:
+                    names.update(name for name in data.files if name != keys_member)
+            features = sorted(names)
+        values = np.full((len(keys),len(features)),np.nan)
+        for chunk,(positions,rows) in located.items():
+            with np.load(os.path.join(self.path,chunk)) as data:
+                for ii,name in enumerate(features):
+                    if name in data.files:
+                        values[positions,ii] = data[name][rows]
+        return keys,list(features),values
+
+    def case(self,case_in,method_in,region_in):
+        _,names,values = self.table([(case_in,method_in,region_in)])
+        return {name: value for name,value in zip(names,values[0]) if not np.isnan(value)}
+
+    # Rewrite the live rows into one chunk and drop the old chunks
+    def compact(self):
+        old_chunks = list(self.chunks)
+        keys,names,values = self.table()
+        chunk = self.writeChunk(keys,names,values)
+        temp_file = self.index_file+'.tmp'
+        with open(temp_file,'w') as f:
+            f.write(json.dumps({'chunk': chunk, 'keys': [list(key) for key in keys]})+'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file,self.index_file)
+        self.chunks = [chunk]
+        self.nr_chunk_rows = len(keys)
+        self.rows = {key: (chunk,row) for row,key in enumerate(keys)}
+        for old_chunk in old_chunks:
+            os.remove(os.path.join(self.path,old_chunk))
+
+    # Upsert a folder of <case>_<region>_<feature class>.json files
+    def importFolder(self,folder_in,method_in):
+        features = {}
+        for name in sorted(os.listdir(folder_in)):
+            match = json_name_regex.match(name)
+            if match:
+                with open(os.path.join(folder_in,name)) as f:
+                    featureVector = json.load(f)
+                key = (match.group('case'),method_in,match.group('region'))
+                features.setdefault(key,{}).update(numericFeatures([featureVector]))
+        self.upsert((case,method,region,values) for (case,method,region),values in features.items())
+        return len(features)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Columnar cohort feature store')
+    parser.add_argument('store',help='folder of the feature store')
+    commands = parser.add_subparsers(dest='command',required=True)
+    command = commands.add_parser('import',help='upsert a folder of per case JSON feature files')
+    command.add_argument('folder')
+    command.add_argument('--method',default='',help='segmentation method of the folder')
+    command = commands.add_parser('column',help='print one feature across the cohort')
+    command.add_argument('feature')
+    command.add_argument('--method')
+    command.add_argument('--region')
+    commands.add_parser('compact',help='rewrite the live rows into one chunk')
+    args = parser.parse_args()
+    store = FeatureStore(args.store)
+    if args.command == 'import':
+        print('%d (case, method, region) rows upserted' % store.importFolder(args.folder,args.method))
+    elif args.command == 'column':
+        keys,values = store.column(args.feature,args.method,args.region)
+        for key,value in zip(keys,values):
+            print('%s\t%s\t%s\t%r' % (key+(float(value),)))
+    else:
+        store.compact()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Consolidated per case output of the extracted features
+
+Instead of one JSON file per region and feature class, all regions and
+classes of a case go into one record <case>_features.<ext>:
+    ndjson: one JSON line with the full feature vectors, for streaming
+    npz:    the feature names and values as arrays, for numeric work
+    mat:    a MAT v5 file with the features as a row in the column order of
+            trainedModel.coef, which SQC.m reads with a single load
+            (requires scipy)
+Every file is written under a temporary name and renamed into place, so a
+file with the final name is always complete.
+"""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+
+output_formats = ['json','ndjson','npz','mat']
+
+# variable name suffix of every region class in the feature tables of SQC.m and featureExtraction.m
+region_suffixes = {'wholeprostate':'WP','apex':'Apex','middle':'Middle','base':'Base'}
+
+# Python value of a diagnostic, numpy values in dictionaries, lists and tuples
+# (such as the settings in diagnostics_Configuration_Settings) included
+def nativeValue(value_in):
+    if isinstance(value_in,dict):
+        return {key: nativeValue(value) for key,value in value_in.items()}
+    if isinstance(value_in,(list,tuple)):
+        return type(value_in)(nativeValue(value) for value in value_in)
+    if isinstance(value_in,np.ndarray):
+        return float(value_in) if value_in.size == 1 else value_in.tolist()
+    if isinstance(value_in,np.generic):
+        return value_in.item()
+    return value_in
+
+# Convert the numpy values of a featureVector to python types. The feature
+# values are converted in one array operation, the diagnostics one by one.
+def toNative(featureVector_in):
+    feature_keys = [key for key in featureVector_in if not key.startswith('diagnostics_')]
+    feature_values = dict(zip(feature_keys,np.asarray([featureVector_in[key] for key in feature_keys],dtype = np.float64).tolist()))
+    featureVector = {}
+    for key,value in featureVector_in.items():
+        if key in feature_values:
+            featureVector[key] = feature_values[key]
+        else:
+            featureVector[key] = nativeValue(value)
+    return featureVector
+
+# Feature names and values of a case in the column order of trainedModel.coef:
+# regions, then feature classes in extraction order, then features in pyradiomics order.
+# A name is <feature class>_<feature>_<region suffix>, as in the tables of SQC.m.
+def modelColumns(results_in):
+    names = []
+    values = []
+    for region_class,featureVectors in results_in.items():
+        for feature_class,featureVector in featureVectors.items():
+            prefix = 'original_'+feature_class+'_'
+            for key,value in featureVector.items():
+                if key.startswith(prefix):
+                    names.append(key[len('original_'):]+'_'+region_suffixes[region_class])
+                    values.append(value)
+    return names,np.asarray(values,dtype = np.float64)
+
+# Write file_in with writer_in(temporary file,*args) and rename it into place,
+# an interrupted write leaves only a hidden .tmp file behind
+def writeAtomic(file_in,writer_in,*args):
+    fd,temp_file = tempfile.mkstemp(prefix='.'+os.path.basename(file_in)+'.',suffix='.tmp',dir=os.path.dirname(file_in) or '.')
+    os.close(fd)
+    try:
+        writer_in(temp_file,*args)
+        os.replace(temp_file,file_in)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+def writeNdjson(results_file_in,patient_nr_in,results_in):
+    record = {'case': patient_nr_in,
+              'regions': {region_class: {feature_class: toNative(featureVector) for feature_class,featureVector in featureVectors.items()}
+                          for region_class,featureVectors in results_in.items()}}
+    with open(results_file_in,'w') as f:
+        f.write(json.dumps(record)+'\n')
+
+def writeNpz(results_file_in,patient_nr_in,results_in):
+    names,values = modelColumns(results_in)
+    with open(results_file_in,'wb') as f:
+        np.savez(f,case = np.array(patient_nr_in),names = np.array(names),values = values)
+
+def writeMat(results_file_in,patient_nr_in,results_in):
+    import scipy.io
+    names,values = modelColumns(results_in)
+    scipy.io.savemat(results_file_in,{'case': patient_nr_in,
+                                      'featureNames': np.array(names,dtype = object),
+                                      'features': values.reshape(1,-1)},
+                     format = '5',oned_as = 'row',appendmat = False)
+
+# Write all regions and feature classes of a case as one record, returns the file name
+def writeCase(results_dir_in,patient_nr_in,results_in,output_format_in):
+    writers = {'ndjson': writeNdjson, 'npz': writeNpz, 'mat': writeMat}
+    results_file = os.path.join(results_dir_in,patient_nr_in+'_features.'+output_format_in)
+    writeAtomic(results_file,writers[output_format_in],patient_nr_in,results_in)
+    return results_file
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint ledger of a batch extraction, to resume it after a crash
+
+A batch job writes a (region, feature class) unit of a case as one file,
+under a temporary name that is renamed into place (see featureWriter.py).
+Once all units of a job are written, the worker appends one line to the
+ledger: the case, its method, the units, the output format and a stamp
+(size and modification time) of the scan and the mask. The ledger is an
+append-only JSON lines file; every line is a single write on an O_APPEND
+descriptor followed by fsync, so the worker processes of a batch can share
+it, and a line cut short by a crash is skipped when the ledger is read.
+
+On a restart a unit is complete when the ledger has it for the same stamp
+and output options and its file is there. Jobs with all units complete are
+skipped, jobs with some are run for the missing units only. Reading the
+ledger and checking the files costs a stat per unit, not an extraction.
+
+Usage:
+    python pyradiomicsBatch.py manifest.csv --results FOLDER --ledger batch.ledger
+    python jobLedger.py batch.ledger
+"""
+
+import argparse
+import json
+import os
+
+# output options that change the written files, a unit is redone when they change
+option_keys = ['format','prune']
+
+# (size, modification time) of the scan and mask of a job, None when one is missing
+def jobStamp(job_in):
+    try:
+        return [value for file in (job_in['image'],job_in['mask']) for value in (os.path.getsize(file),os.stat(file).st_mtime_ns)]
+    except OSError:
+        return None
+
+def jobOptions(job_in):
+    return {key: job_in.get(key) or None for key in option_keys}
+
+# File a unit of a job is written to: one JSON file per region and feature
+# class, or the record of the whole case for the other formats
+def unitFile(job_in,region_class_in,feature_class_in):
+    output_format = job_in.get('format') or 'json'
+    if output_format == 'json':
+        return os.path.join(job_in['results'],job_in['case']+'_'+region_class_in+'_'+feature_class_in+'.json')
+    return os.path.join(job_in['results'],job_in['case']+'_features.'+output_format)
+
+def jobKey(job_in):
+    return (job_in.get('method',''),job_in['case'],os.path.abspath(job_in['results']))
+
+# Entries of a ledger as {(method, case, results): entry}, the units of the
+# lines of a job with the same stamp and options are put together
+def readLedger(ledger_file_in):
+    entries = {}
+    if not os.path.exists(ledger_file_in):
+        return entries
+    with open(ledger_file_in) as f:
+        for line in f:
+            try:
+                line_entry = json.loads(line)
+                key = (line_entry['method'],line_entry['case'],line_entry['results'])
+            except (ValueError,KeyError,TypeError):
+                # a line cut short by a crash, its job is done again
+                continue
+            entry = entries.get(key)
+            if entry is None or entry['stamp'] != line_entry['stamp'] or entry['options'] != line_entry['options']:
+                entries[key] = dict(line_entry,units = [tuple(unit) for unit in line_entry['units']])
+            else:
+                entry['units'] = sorted(set(entry['units']).union(tuple(unit) for unit in line_entry['units']))
+    return entries
+
+# Append the completed units of a job, called by the process that wrote them
+def recordJob(ledger_file_in,job_in,units_in):
+    line_entry = {'method': job_in.get('method',''), 'case': job_in['case'], 'results': os.path.abspath(job_in['results']),
+                  'stamp': jobStamp(job_in), 'options': jobOptions(job_in),
+                  'units': [[region_class,feature_class] for region_class,feature_classes in units_in.items() for feature_class in feature_classes]}
+    fd = os.open(ledger_file_in,os.O_WRONLY | os.O_APPEND | os.O_CREAT,0o644)
+    try:
+        os.write(fd,(json.dumps(line_entry)+'\n').encode('utf-8'))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class JobLedger:
+    # With resume False the ledger is started anew and every job runs
+    def __init__(self,ledger_file_in,resume=True):
+        self.path = os.path.abspath(ledger_file_in)
+        folder = os.path.dirname(self.path)
+        os.makedirs(folder,exist_ok=True)
+        if not resume and os.path.exists(self.path):
+            os.remove(self.path)
+        self.entries = readLedger(self.path)
+
+    # Units of units_in {region class: [feature class]} that a job still needs, in the same order
+    def missingUnits(self,job_in,units_in):
+        entry = self.entries.get(jobKey(job_in))
+        stamp = jobStamp(job_in)
+        if entry is None or stamp is None or entry['stamp'] != stamp or entry['options'] != jobOptions(job_in):
+            return units_in
+        done = set(entry['units'])
+        missing = {}
+        for region_class,feature_classes in units_in.items():
+            for feature_class in feature_classes:
+                if (region_class,feature_class) not in done or not os.path.exists(unitFile(job_in,region_class,feature_class)):
+                    missing.setdefault(region_class,[]).append(feature_class)
+        return missing
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Completed jobs and units of a batch extraction ledger')
+    parser.add_argument('ledger',help='ledger file of pyradiomicsBatch.py --ledger')
+    args = parser.parse_args()
+    entries = readLedger(args.ledger)
+    print('%d jobs with %d completed units' % (len(entries),sum(len(entry['units']) for entry in entries.values())))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Job specification of a QC case
+
+A job names the scan and mask of one case, the folder its features are
+written to and the name of the case in them, with a job id that is unique
+on the machine. It is given on the command line (--image, --mask, ...), as
+a JSON object in a file or on stdin, or as the paths.txt file older versions
+of SQC.m wrote. A job without a results folder gets its own scratch folder,
+so any number of jobs can run at the same time without sharing a file.
+Only the standard library is imported here.
+
+Usage:
+    python pyradiomicsWorker.py --submit --image Case001_normalized.mhd --mask Case001_segmentation.mhd --format mat
+    python pyradiomicsWorker.py --submit job.json
+    echo '{"image": "...", "mask": "..."}' | python pyradiomicsWorker.py --submit -
+    python jobSpec.py --image Case001_normalized.mhd --mask Case001_segmentation.mhd > job.json
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+# arguments of a job that name files or folders, made absolute so the job can run in another working directory
+path_keys = ['image','mask','results','cache']
+
+# Unique on the machine and sortable by start time: date, time, process id and a random part
+def newJobId():
+    return '%s-%d-%s' % (time.strftime('%Y%m%d-%H%M%S'),os.getpid(),uuid.uuid4().hex[:8])
+
+# Job from a JSON file, JSON on stdin ('-') or a paths.txt file (image, mask,
+# results folder and case on the first four lines)
+def readSpec(source_in):
+    if source_in == '-':
+        text = sys.stdin.read()
+    else:
+        with open(source_in) as f:
+            text = f.read()
+    if text.lstrip().startswith('{'):
+        return json.loads(text)
+    flines = text.splitlines()
+    return {'image': flines[0].strip(), 'mask': flines[1].strip(),
+            'results': flines[2].strip(), 'case': flines[3].strip()}
+
+# Complete a job: a new job id, absolute paths, a scratch folder of its own as
+# results folder when it has none, and the job id as case name when it has none
+def prepareJob(job_in,scratch_root=None):
+    job = dict(job_in)
+    for key in ('image','mask'):
+        if not job.get(key):
+            raise ValueError('job without %s' % key)
+    job['job_id'] = job.get('job_id') or newJobId()
+    for key in path_keys:
+        if job.get(key):
+            job[key] = os.path.abspath(job[key])
+    if not job.get('results'):
+        job['results'] = tempfile.mkdtemp(prefix='sqc-%s-' % job['job_id'],dir=scratch_root)
+        job['scratch'] = job['results']
+    else:
+        os.makedirs(job['results'],exist_ok=True)
+    job['case'] = job.get('case') or job['job_id']
+    return job
+
+# Remove the scratch folder prepareJob made for a job, a results folder given with the job is kept
+def removeScratch(job_in):
+    if job_in.get('scratch'):
+        shutil.rmtree(job_in['scratch'],ignore_errors=True)
+
+def addJobArguments(parser_in):
+    group = parser_in.add_argument_group('job')
+    group.add_argument('--image',help='scan of the case')
+    group.add_argument('--mask',help='segmentation of the case')
+    group.add_argument('--results',help='folder the features are written to (default: a new scratch folder)')
+    group.add_argument('--case',help='name of the case in the results (default: the job id)')
+    group.add_argument('--job-id',help='id of the job (default: a new unique id)')
+    group.add_argument('--scratch-root',help='folder the scratch folders are made in (default: the temporary folder)')
+    return group
+
+# Job of the --image, --mask, ... arguments, None when no image is given
+def jobFromArguments(args_in):
+    if not args_in.image:
+        return None
+    job = {'image': args_in.image, 'mask': args_in.mask, 'results': args_in.results, 'case': args_in.case, 'job_id': args_in.job_id}
+    return {key: value for key,value in job.items() if value}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the prepared specification of a QC job as JSON')
+    parser.add_argument('spec',nargs='?',help='job JSON file, - for stdin or a paths.txt file (instead of --image and --mask)')
+    addJobArguments(parser)
+    args = parser.parse_args()
+    job = readSpec(args.spec) if args.spec else jobFromArguments(args)
+    if job is None:
+        parser.error('give a job specification or --image and --mask')
+    json.dump(prepareJob(job,args.scratch_root),sys.stdout,indent=1)
+    sys.stdout.write('\n')
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Memory mapped reader for uncompressed MetaIO images (.mhd/.raw and .mha)
+
+SQC.m writes the normalized scan and the prepared segmentation as
+uncompressed MetaIO files. Instead of reading them into a SimpleITK image and
+copying that into a numpy array, the header is parsed here and the pixel data
+is memory mapped as a read-only (z,y,x) array. Only the pages that are used
+are read, and processes that map the same file share them in the page cache.
+A SimpleITK image is made from the array (or a crop of it) only when
+pyradiomics needs one. Compressed, multi-file and multi-channel images are
+left to SimpleITK.
+"""
+
+import os
+
+import numpy as np
+
+# MetaIO element types that map onto one numpy type, as SimpleITK reads them
+element_types = {'MET_CHAR': np.int8, 'MET_UCHAR': np.uint8,
+                 'MET_SHORT': np.int16, 'MET_USHORT': np.uint16,
+                 'MET_INT': np.int32, 'MET_UINT': np.uint32,
+                 'MET_LONG_LONG': np.int64, 'MET_ULONG_LONG': np.uint64,
+                 'MET_FLOAT': np.float32, 'MET_DOUBLE': np.float64}
+
+# Read the 'Key = Value' lines of a MetaIO header. ElementDataFile is the last
+# key, for LOCAL data the pixels start right after it. Returns the header and
+# the offset of the line after it.
+def readHeader(file_in):
+    header = {}
+    with open(file_in,'rb') as f:
+        for line in f:
+            key,sep,value = line.decode('latin-1').partition('=')
+            if not sep:
+                continue
+            header[key.strip()] = value.strip()
+            if key.strip() == 'ElementDataFile':
+                break
+        return header,f.tell()
+
+def numbers(value_in):
+    return tuple(float(value) for value in value_in.split())
+
+# Geometry of a MetaIO header as SimpleITK has it: spacing, origin and the
+# direction matrix in row-major order (MetaIO stores it column by column)
+def headerGeometry(header_in):
+    nr_dims = int(header_in['NDims'])
+    spacing = numbers(header_in.get('ElementSpacing') or header_in.get('ElementSize') or ' '.join(['1']*nr_dims))
+    origin = numbers(header_in.get('Offset') or header_in.get('Origin') or header_in.get('Position') or ' '.join(['0']*nr_dims))
+    matrix = header_in.get('TransformMatrix') or header_in.get('Rotation') or header_in.get('Orientation')
+    if matrix:
+        direction = tuple(np.reshape(numbers(matrix),(nr_dims,nr_dims)).T.ravel().tolist())
+    else:
+        direction = tuple(np.eye(nr_dims).ravel().tolist())
+    return {'spacing': spacing, 'origin': origin, 'direction': direction}
+
+def imageGeometry(image_in):
+    return {'spacing': image_in.GetSpacing(), 'origin': image_in.GetOrigin(), 'direction': image_in.GetDirection()}
+
+# Memory map the pixel data of an uncompressed MetaIO image.
+# Returns the read-only (z,y,x) array and the geometry, raises ValueError for
+# images this reader does not map.
+def mapArray(file_in):
+    if os.path.splitext(file_in)[1].lower() not in ('.mhd','.mha'):
+        raise ValueError('%s is not a MetaIO image' % file_in)
+    header,data_offset = readHeader(file_in)
+    data_file = header.get('ElementDataFile','')
+    if header.get('CompressedData','False').lower() == 'true':
+        raise ValueError('%s is compressed' % file_in)
+    if header.get('ElementType') not in element_types:
+        raise ValueError('%s has element type %s' % (file_in,header.get('ElementType')))
+    if int(header.get('ElementNumberOfChannels','1')) != 1:
+        raise ValueError('%s has more than one channel' % file_in)
+    if not data_file or data_file.split()[0] == 'LIST' or '%' in data_file:
+        raise ValueError('%s stores its data in more than one file' % file_in)
+    # numpy axes are z,y,x and MetaIO sizes x,y,z
+    shape = tuple(int(size) for size in header['DimSize'].split())[::-1]
+    big_endian = header.get('BinaryDataByteOrderMSB',header.get('ElementByteOrderMSB','False')).lower() == 'true'
+    dtype = np.dtype(element_types[header['ElementType']]).newbyteorder('>' if big_endian else '<')
+    if data_file != 'LOCAL':
+        data_file = os.path.join(os.path.dirname(file_in),data_file)
+        header_size = int(header.get('HeaderSize','0'))
+        data_offset = os.path.getsize(data_file)-int(np.prod(shape))*dtype.itemsize if header_size == -1 else header_size
+    array = np.memmap(data_file if data_file != 'LOCAL' else file_in,dtype = dtype,mode = 'r',offset = data_offset,shape = shape)
+    return array,headerGeometry(header)
+
+# SimpleITK image of an array and its geometry, the array is copied
+def toImage(array_in,geometry_in):
+    import SimpleITK as sitk
+    image = sitk.GetImageFromArray(np.ascontiguousarray(array_in,dtype = array_in.dtype.newbyteorder('=')))
+    image.SetSpacing(geometry_in['spacing'])
+    image.SetOrigin(geometry_in['origin'])
+    image.SetDirection(geometry_in['direction'])
+    return image
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Time saved by reading NIfTI predictions directly
+
+Retrain/Codes/niigztomhdnnUNet2D.py and niigztomhdnnUNet3D.py decompress
+every nnU-Net .nii.gz prediction and write it again as .mhd before the
+features are extracted. The extraction reads .nii.gz masks directly (see
+readCase in pyradiomicsFeatureExtraction.py), so that pass can be skipped.
+For a folder of predictions this measures per case the conversion as those
+scripts do it, the read of the converted .mhd and the direct read of the
+.nii.gz, checks that both give the same mask on the same grid, and reports
+the time and the disk writes that are saved.
+
+Usage:
+    python niftiIngestion.py /data/nnUNet_3D/predictions --images /data/Cases/Normalized --report nifti.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+import pyradiomicsFeatureExtraction as extraction
+
+def timed(function_in,*args):
+    start = time.perf_counter()
+    result = function_in(*args)
+    return result,time.perf_counter()-start
+
+# Read a mask as the extraction does, with its geometry reconciled with the scan if there is one
+def readMask(mask_file_in,image_file_in=None):
+    mask_array,mask_geometry = extraction.readVolume(mask_file_in)
+    mask_array = np.array(mask_array,dtype = np.uint8)
+    if image_file_in:
+        image_array,geometry = extraction.readVolume(image_file_in)
+        mask_geometry = extraction.reconcileGeometry(image_array.shape,geometry,mask_array.shape,mask_geometry)
+    return mask_array,mask_geometry
+
+def compareCase(nifti_file_in,image_file_in=None):
+    with tempfile.TemporaryDirectory() as folder:
+        mhd_file = os.path.join(folder,'mask.mhd')
+        # as niigztomhdnnUNet*.py: read the prediction and write it as MetaIO
+        _,convert_seconds = timed(lambda: sitk.WriteImage(sitk.ReadImage(nifti_file_in),mhd_file))
+        written_bytes = sum(os.path.getsize(os.path.join(folder,name)) for name in os.listdir(folder))
+        (mhd_array,mhd_geometry),mhd_seconds = timed(readMask,mhd_file,image_file_in)
+    (nifti_array,nifti_geometry),nifti_seconds = timed(readMask,nifti_file_in,image_file_in)
+    same_geometry = all(np.allclose(mhd_geometry[key],nifti_geometry[key],rtol = 1e-6,atol = 1e-6) for key in ('spacing','origin','direction'))
+    return {'mask': nifti_file_in, 'image': image_file_in, 'convert_seconds': convert_seconds, 'written_bytes': written_bytes,
+            'read_mhd_seconds': mhd_seconds, 'read_nifti_seconds': nifti_seconds,
+            'saved_seconds': convert_seconds+mhd_seconds-nifti_seconds,
+            'same_mask': bool(np.array_equal(mhd_array,nifti_array)) and same_geometry}
+
+def compareFolder(folder_in,pattern='*.nii.gz',images=None,image_template='{case}_normalized.mhd'):
+    records = []
+    for nifti_file in sorted(glob.glob(os.path.join(folder_in,pattern))):
+        image_file = None
+        if images:
+            case = os.path.basename(nifti_file)
+            case = case[:-len('.nii.gz')] if case.endswith('.nii.gz') else os.path.splitext(case)[0]
+            image_file = os.path.join(images,image_template.format(case = case))
+            if not os.path.exists(image_file):
+                image_file = None
+        records.append(compareCase(nifti_file,image_file))
+    summary = {'cases': len(records),
+               'same_mask': sum(1 for record in records if record['same_mask'])}
+    for key in ('convert_seconds','read_mhd_seconds','read_nifti_seconds','saved_seconds','written_bytes'):
+        summary[key] = sum(record[key] for record in records)
+    return records,summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time saved by reading NIfTI predictions without converting them to MetaIO')
+    parser.add_argument('folder',help='folder with the .nii.gz predictions')
+    parser.add_argument('--pattern',default='*.nii.gz',help='file pattern of the predictions (default *.nii.gz)')
+    parser.add_argument('--images',help='folder of the scans, to check the masks on the grid of their scan')
+    parser.add_argument('--image-template',default='{case}_normalized.mhd',help='file name of the scan of a case (default {case}_normalized.mhd)')
+    parser.add_argument('--report',help='write the per case timing and the summary to this JSON file')
+    args = parser.parse_args()
+    records,summary = compareFolder(args.folder,args.pattern,args.images,args.image_template)
+    for record in records:
+        print('%s: convert %.2f s, read .mhd %.2f s, read .nii.gz %.2f s, saved %.2f s%s'
+              % (os.path.basename(record['mask']),record['convert_seconds'],record['read_mhd_seconds'],record['read_nifti_seconds'],
+                 record['saved_seconds'],'' if record['same_mask'] else ', MASKS DIFFER'))
+    print('%d cases (%d identical masks): conversion pass %.1f s and %.1f MB written, reads %.1f s (.mhd) vs %.1f s (.nii.gz), %.1f s saved'
+          % (summary['cases'],summary['same_mask'],summary['convert_seconds'],summary['written_bytes']/1024**2,
+             summary['read_mhd_seconds'],summary['read_nifti_seconds'],summary['saved_seconds']))
+    if args.report:
+        with open(args.report,'w') as f:
+            json.dump({'summary': summary, 'cases': records},f,indent=1)
+    sys.exit(0 if summary['same_mask'] == summary['cases'] else 1)
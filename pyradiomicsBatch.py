@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Cohort batch mode for pyradiomicsFeatureExtraction.py
+
+Extracts the features of every case in a manifest on a pool of processes.
+The manifest is a CSV file with the columns image, mask and case, or a JSON
+list of objects with the same keys. An optional results column/key overrides
+the output folder of a case and an optional method column/key names the
+segmentation method the case is stored under in a feature store (--store).
+By default every case is written exactly as by the single case script:
+<case>_<region>_<feature class>.json in its output folder. With --format
+ndjson, npz or mat every case is written as one record
+<case>_features.<ext> instead (see featureWriter.py).
+
+With --shard k/n only the cases of shard k of n are extracted, for array
+jobs on a cluster (see cohortShards.py). With --ledger the completed
+(region, feature class) units are recorded, and a run that is started again
+after a crash extracts only the units that are missing (see jobLedger.py).
+
+Usage:
+    python pyradiomicsBatch.py manifest.csv --results FOLDER --workers 8 --report timing.json
+    python pyradiomicsBatch.py manifest.csv --results FOLDER --store STORE --shard $SLURM_ARRAY_TASK_ID/8
+    python pyradiomicsBatch.py manifest.csv --results FOLDER --ledger FOLDER/batch.ledger
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+import SimpleITK as sitk
+
+import casePipeline
+import cohortShards
+import featureCache
+import featureStore
+import featureWriter
+import jobLedger
+import pyradiomicsFeatureExtraction as extraction
+import qualityScore
+import stageTrace
+
+def readManifest(manifest_in,results_dir_in=None):
+    if manifest_in.lower().endswith('.json'):
+        with open(manifest_in) as f:
+            rows = json.load(f)
+    else:
+        with open(manifest_in,newline='') as f:
+            rows = list(csv.DictReader(f))
+    jobs = []
+    for row_nr,row in enumerate(rows,1):
+        job = {key: str(row.get(key) or '').strip() for key in ('image','mask','case','results')}
+        if row.get('method'):
+            job['method'] = str(row['method']).strip()
+        if not job['results']:
+            job['results'] = results_dir_in or ''
+        missing = [key for key in ('image','mask','case','results') if not job[key]]
+        if missing:
+            raise ValueError('Manifest row %d has no %s' % (row_nr,', '.join(missing)))
+        jobs.append(job)
+    return jobs
+
+# queues of the pipelined workers, set by initWorker
+job_queue = None
+record_queue = None
+
+# Share the cores between the workers instead of every worker using all of them
+def initWorker(nr_threads_in,job_queue_in=None,record_queue_in=None):
+    global job_queue,record_queue
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(nr_threads_in)
+    job_queue = job_queue_in
+    record_queue = record_queue_in
+
+# Extraction plan and feature cache of a job
+def jobOptions(job_in):
+    plan = None
+    if job_in.get('prune'):
+        # loaded once per worker process, and again only when the model changes
+        plan = qualityScore.extractionPlan()
+    if job_in.get('partial'):
+        # only the units a resumed job is missing
+        plan = {region_class: {feature_class: plan[region_class][feature_class] for feature_class in feature_classes} if plan else
+                list(feature_classes) for region_class,feature_classes in job_in['units'].items()}
+    cache = None
+    if job_in.get('cache'):
+        cache = featureCache.FeatureCache(job_in['cache'],job_in.get('cache_bytes') or 1024**3)
+    return plan,cache
+
+def jobRecord(job_in,seconds_in,error_in,cache_in=None):
+    record = {'case': job_in['case'], 'seconds': seconds_in, 'error': error_in, 'pid': os.getpid(),
+              'peak_memory_mb': extraction.peakMemoryMB()}
+    if 'method' in job_in:
+        record['method'] = job_in['method']
+    if cache_in is not None and cache_in.hits+cache_in.misses:
+        record['cache'] = 'hit' if cache_in.hits else 'miss'
+    return record
+
+# (region, feature class) units of a job as {region class: [feature class]}
+def jobUnits(job_in):
+    if job_in.get('prune'):
+        return {region_class: list(feature_classes) for region_class,feature_classes in qualityScore.extractionPlan().items()}
+    return {region_class: list(extraction.feature_classes) for region_class in job_in.get('regions') or extraction.region_classes}
+
+# Jobs that still have units to extract after the units in the ledger. A job
+# with some units done extracts only the others, where they are separate files.
+# With whole_regions a region is extracted again as a whole, as the rows of a
+# feature store hold a whole region.
+# Returns the jobs to run and the number of complete and partly done jobs.
+def resumeJobs(jobs_in,ledger_in,whole_regions=False):
+    jobs = []
+    nr_complete = 0
+    nr_partial = 0
+    for job in jobs_in:
+        units = jobUnits(job)
+        missing = ledger_in.missingUnits(job,units)
+        if not missing:
+            nr_complete += 1
+            continue
+        if whole_regions:
+            missing = {region_class: units[region_class] for region_class in missing}
+        job = dict(job,ledger = ledger_in.path,units = units)
+        if missing != units and (job.get('format') or 'json') == 'json':
+            job['units'] = missing
+            job['partial'] = True
+            nr_partial += 1
+        jobs.append(job)
+    return jobs,nr_complete,nr_partial
+
+# Record the units of a job in its ledger once they are written. With a
+# feature store the parent records them after the upsert, so a crash in
+# between leaves the case to be extracted again instead of out of the store.
+def recordUnits(job_in):
+    if job_in.get('ledger'):
+        jobLedger.recordJob(job_in['ledger'],job_in,job_in['units'])
+
+def jobFeatures(results_in):
+    return {region_class: featureStore.numericFeatures(featureVectors.values()) for region_class,featureVectors in results_in.items()}
+
+# Extract one job, with return_features the numeric features per region are
+# returned as well and the units are left to the caller to record
+def runJob(job_in,single_pass=True,return_features=False):
+    start = time.perf_counter()
+    error = None
+    features = None
+    cache = None
+    try:
+        os.makedirs(job_in['results'],exist_ok=True)
+        plan,cache = jobOptions(job_in)
+        results = extraction.runCase(job_in['image'],job_in['mask'],job_in['results'],job_in['case'],single_pass,
+                                     extraction.feature_classes,job_in.get('regions') or extraction.region_classes,
+                                     job_in.get('format','json'),job_in.get('crop',False),plan,cache,diagnostics = not job_in.get('prune'))
+        if return_features:
+            features = jobFeatures(results)
+        else:
+            recordUnits(job_in)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__,e)
+    return jobRecord(job_in,time.perf_counter()-start,error,cache),features
+
+# Pipelined worker: takes jobs from the shared job queue until None, reads the
+# next prefetch jobs ahead and writes behind (see casePipeline.py). Sends
+# (job, record, features) per job to the record queue, returns the pipeline statistics.
+def runPipelineWorker(single_pass=True,return_features=False,prefetch=2,write_depth=8):
+    caches = {}
+    def read(job):
+        os.makedirs(job['results'],exist_ok=True)
+        with stageTrace.span('read case',case = job['case']):
+            return extraction.readCase(job['image'],job['mask'],job.get('crop',False),load=True)
+    def extract(job,case):
+        plan,caches[id(job)] = jobOptions(job)
+        with stageTrace.span('extract case',case = job['case']):
+            return extraction.extractCase(case,single_pass,extraction.feature_classes,job.get('regions') or extraction.region_classes,
+                                          plan,caches[id(job)],diagnostics = not job.get('prune'))
+    def write(job,results):
+        extraction.writeResults(job['results'],job['case'],results,job.get('format','json'))
+        if not return_features:
+            recordUnits(job)
+    def done(job,results,error,seconds):
+        features = jobFeatures(results) if return_features and error is None else None
+        record_queue.put((job,jobRecord(job,seconds,error,caches.pop(id(job),None)),features))
+    pipeline = casePipeline.CasePipeline(read,extract,write,done,prefetch,write_depth)
+    return pipeline.run(iter(job_queue.get,None))
+
+# Extract all jobs on a pool of processes, returns the per case records and a summary.
+# With a store the features of every case are upserted into it as the case completes.
+# With prefetch every worker reads that many cases ahead and writes behind.
+def runBatch(jobs_in,nr_workers=None,single_pass=True,verbose=True,store=None,prefetch=0,write_depth=8):
+    nr_workers = nr_workers or os.cpu_count() or 1
+    nr_threads = max(1,(os.cpu_count() or 1)//nr_workers)
+    records = []
+    def collect(job,record,features):
+        records.append(record)
+        if features is not None:
+            store.upsert((record['case'],record.get('method',''),region_class,region_features)
+                         for region_class,region_features in features.items())
+            recordUnits(job)
+        if verbose:
+            status = 'failed (%s)' % record['error'] if record['error'] else 'done'
+            name = '/'.join(filter(None,(record.get('method'),record['case'])))
+            print('[%d/%d] %s %s in %.2f s' % (len(records),len(jobs_in),name,status,record['seconds']))
+            sys.stdout.flush()
+    pipeline_stats = None
+    start = time.perf_counter()
+    if prefetch:
+        pipeline_queues = (multiprocessing.Queue(),multiprocessing.Queue())
+        with concurrent.futures.ProcessPoolExecutor(nr_workers,initializer=initWorker,initargs=(nr_threads,)+pipeline_queues) as pool:
+            futures = [pool.submit(runPipelineWorker,single_pass,store is not None,prefetch,write_depth) for _ in range(nr_workers)]
+            for job in jobs_in:
+                pipeline_queues[0].put(job)
+            for _ in futures:
+                pipeline_queues[0].put(None)
+            while len(records) < len(jobs_in):
+                try:
+                    collect(*pipeline_queues[1].get(timeout=1))
+                except queue.Empty:
+                    # a worker that died would otherwise leave this waiting for ever
+                    for future in futures:
+                        if future.done() and future.exception() is not None:
+                            raise future.exception()
+            pipeline_stats = casePipeline.mergeStats([future.result() for future in futures])
+    else:
+        with concurrent.futures.ProcessPoolExecutor(nr_workers,initializer=initWorker,initargs=(nr_threads,)) as pool:
+            futures = {pool.submit(runJob,job,single_pass,store is not None): job for job in jobs_in}
+            for future in concurrent.futures.as_completed(futures):
+                collect(futures[future],*future.result())
+    if store is not None and len(store.chunks) > 1:
+        # one chunk per case was upserted, reading a feature opens one file again
+        store.compact()
+    wall_seconds = time.perf_counter()-start
+    case_seconds = sorted(record['seconds'] for record in records)
+    summary = {'cases': len(records),
+               'failed': sum(1 for record in records if record['error']),
+               'workers': nr_workers,
+               'wall_seconds': wall_seconds,
+               'cases_per_minute': 60*len(records)/wall_seconds if wall_seconds > 0 else 0.0,
+               'mean_case_seconds': sum(case_seconds)/len(case_seconds) if case_seconds else 0.0,
+               'median_case_seconds': case_seconds[len(case_seconds)//2] if case_seconds else 0.0,
+               'max_peak_memory_mb': max([record['peak_memory_mb'] or 0.0 for record in records],default=0.0)}
+    if any('cache' in record for record in records):
+        summary['cache_hits'] = sum(1 for record in records if record.get('cache') == 'hit')
+        summary['cache_misses'] = sum(1 for record in records if record.get('cache') == 'miss')
+    if pipeline_stats:
+        summary['pipeline'] = pipeline_stats
+    return records,summary
+
+def printSummary(summary_in):
+    print('%d cases (%d failed) on %d workers in %.1f s: %.1f cases/min, median %.2f s per case, peak memory %.0f MB per worker'
+          % (summary_in['cases'],summary_in['failed'],summary_in['workers'],summary_in['wall_seconds'],
+             summary_in['cases_per_minute'],summary_in['median_case_seconds'],summary_in['max_peak_memory_mb']))
+    if 'cache_hits' in summary_in:
+        print('feature cache: %d hits, %d misses' % (summary_in['cache_hits'],summary_in['cache_misses']))
+    if 'pipeline' in summary_in:
+        pipeline = summary_in['pipeline']
+        print('pipeline: prefetch %d, %d read stalls (%.1f s), %.1f cases ready ahead, write queue max %d of %d, write stalls %.1f s'
+              % (pipeline['prefetch'],pipeline['read_stalls'],pipeline['read_stall_seconds'],pipeline['mean_ready_ahead'],
+                 pipeline['max_write_queue'],pipeline['write_depth'],pipeline['write_stall_seconds']))
+
+def writeReport(report_file_in,records_in,summary_in):
+    with open(report_file_in,'w') as f:
+        json.dump({'summary': summary_in, 'cases': records_in},f,indent=1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the features of every case in a manifest on a process pool')
+    parser.add_argument('manifest',help='CSV or JSON manifest with image, mask and case (and optionally results)')
+    parser.add_argument('--results',help='output folder for cases without a results entry')
+    parser.add_argument('--workers',type=int,help='number of worker processes (default: number of cores)')
+    parser.add_argument('--report',help='write the per case timing and the summary to this JSON file')
+    parser.add_argument('--per-class',action='store_true',help='one extraction per feature class, as before single pass extraction')
+    parser.add_argument('--format',default='json',choices=featureWriter.output_formats,
+                        help='one JSON file per region and feature class (default), or one ndjson/npz/mat record per case')
+    parser.add_argument('--crop',action='store_true',help='crop the volumes to the padded bounding box of the mask to lower the peak memory')
+    parser.add_argument('--prune',action='store_true',help='extract only the features with a nonzero coefficient in trainedModel.mat')
+    parser.add_argument('--cache',help='take the features of cases seen before from this feature cache folder')
+    parser.add_argument('--cache-size',type=float,default=1024,help='size limit of the feature cache in MB (default 1024)')
+    parser.add_argument('--prefetch',type=int,default=0,help='cases every worker reads ahead, with writes behind on a queue (default 0: no overlap)')
+    parser.add_argument('--write-queue',type=int,default=8,help='cases a worker may have waiting to be written with --prefetch (default 8)')
+    parser.add_argument('--store',help='also upsert the features into this feature store folder')
+    parser.add_argument('--method',help='segmentation method the cases are stored under (default: method column, else empty)')
+    parser.add_argument('--trace',help='write a per stage timing trace of every case to this Chrome trace JSON file (see stageTrace.py)')
+    parser.add_argument('--shard',help='extract only shard k of n (k/n, k from 0), into a store and report of the shard (see cohortShards.py)')
+    parser.add_argument('--ledger',help='record the completed units in this ledger file and skip the units it has (see jobLedger.py)')
+    parser.add_argument('--restart',action='store_true',help='start the ledger anew and extract every case')
+    args = parser.parse_args()
+    if args.trace:
+        stageTrace.startTrace(args.trace)
+    jobs = readManifest(args.manifest,args.results)
+    for job in jobs:
+        job['format'] = args.format
+        job['crop'] = args.crop
+        job['prune'] = args.prune
+        job['cache'] = args.cache
+        job['cache_bytes'] = int(args.cache_size*1024**2)
+        if args.method:
+            job['method'] = args.method
+    if args.shard:
+        shard,nr_shards = cohortShards.parseShard(args.shard)
+        nr_cases = len(jobs)
+        try:
+            jobs,shard_voxels = cohortShards.shardJobs(jobs,shard,nr_shards)
+        except ValueError as e:
+            # no case is extracted when a task cannot compute the same shards as the others
+            sys.exit(str(e))
+        print('%s: %d of %d cases, %d voxels' % (cohortShards.shardName(shard,nr_shards),len(jobs),nr_cases,shard_voxels))
+        if args.store:
+            args.store = cohortShards.shardStore(args.store,shard,nr_shards)
+        if args.report:
+            args.report = cohortShards.shardReport(args.report,shard,nr_shards)
+        if args.ledger:
+            args.ledger = cohortShards.shardReport(args.ledger,shard,nr_shards)
+    if args.ledger:
+        nr_cases = len(jobs)
+        jobs,nr_complete,nr_partial = resumeJobs(jobs,jobLedger.JobLedger(args.ledger,not args.restart),args.store is not None)
+        print('ledger: %d of %d cases complete, %d partly done, %d to extract' % (nr_complete,nr_cases,nr_partial,len(jobs)-nr_partial))
+    store = featureStore.FeatureStore(args.store) if args.store else None
+    records,summary = runBatch(jobs,args.workers,not args.per_class,store=store,prefetch=args.prefetch,write_depth=args.write_queue)
+    printSummary(summary)
+    if args.report:
+        writeReport(args.report,records,summary)
+    sys.exit(1 if summary['failed'] else 0)
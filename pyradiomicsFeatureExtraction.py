@@ -1,387 +1,426 @@
-# -*- coding: utf-8 -*-
-"""
-Created on Mon Mar 12 15:55:07 2018
-
-@author: mattjise
-Modified by Mohammed Sunoqrot March 2020
-"""
-
-import radiomics
-import SimpleITK as sitk
-import numpy as np
-import math
-import json
-import os
-import sys
-
-def getSettings(image_array_in,mask_array_in,nr_bins):
-    intensity_range = np.max(image_array_in[mask_array_in == 1])-np.min(image_array_in[mask_array_in == 1])
-    settings = {} 
-    settings['binWidth'] = intensity_range/64
-    settings['correctMask'] = True
-    return settings
-
-def getSliceFromMask(mask_in,slice_nr_in):
-    mask_array = sitk.GetArrayFromImage(mask_in)
-    new_mask_array = np.zeros_like(mask_array)
-    new_mask_array[:,:,:] = 0
-    new_mask_array[slice_nr_in,:,:] = mask_array[slice_nr_in,:,:]
-    new_mask = sitk.GetImageFromArray(new_mask_array)
-    new_mask.CopyInformation(mask)
-    return new_mask
-
-# Get paths
-with open(os.path.join(os.path.dirname(sys.argv[0]),'paths.txt')) as f: 
-    flines = f.readlines()
-    image_dir = flines[0].strip()
-    mask_dir = flines[1].strip()
-    results_dir = flines[2].strip()
-    patient_nr = flines[3].strip()
-
-
-  # read in data
-image = sitk.ReadImage(image_dir)
-mask = sitk.ReadImage(mask_dir)
-mask = sitk.Cast( mask, sitk.sitkUInt8)
-
-mask.SetDirection(image.GetDirection())
-mask.SetOrigin(image.GetOrigin())
-mask_array = sitk.GetArrayFromImage(mask)
-image_array = sitk.GetArrayFromImage(image)
-
-# get slices
-slice = mask_array.sum(axis = (1,2)) > 0
-index = np.where(slice==1)
-
-   #---Whole prostate---# 
-
-   # whole prostate - firstorder
-region_class = 'wholeprostate'
-feature_class = 'firstorder'
-settings = getSettings(image_array,mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-
-# whole prostate - shape 3d
-region_class = 'wholeprostate'
-feature_class = 'shape'
-settings = getSettings(image_array,mask_array,64)       
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-   # whole prostate - glcm
-region_class = 'wholeprostate'
-feature_class = 'glcm'
-settings = getSettings(image_array,mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-# whole prostate - glrlm
-region_class = 'wholeprostate'
-feature_class = 'glrlm'
-settings = getSettings(image_array,mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)      
-featureVector = extractor.execute(image,mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-# whole prostate - glszm
-region_class = 'wholeprostate'
-feature_class = 'glszm'
-settings = getSettings(image_array,mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)      
-featureVector = extractor.execute(image,mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-
-# whole prostate - ngtdm
-region_class = 'wholeprostate'
-feature_class = 'ngtdm'
-settings = getSettings(image_array,mask_array,64)     
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-# whole prostate - gldm
-region_class = 'wholeprostate'
-feature_class = 'gldm'
-settings = getSettings(image_array,mask_array,64)      
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)       
-featureVector = extractor.execute(image,mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-              
-#---Apex---# 
-
-# prepare input
-slice_nr = index[0][0:math.floor(np.size(index)/3)]
-new_mask = getSliceFromMask(mask,slice_nr)
-new_mask_array = sitk.GetArrayFromImage(new_mask)
-
-# apex- firstorder
-region_class = 'apex'
-feature_class = 'firstorder'
-settings = getSettings(image_array,new_mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-            
-# apex - shape 3d
-region_class = 'apex'
-feature_class = 'shape'
-settings = getSettings(image_array,new_mask_array,64)       
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-   # apex - glcm
-region_class = 'apex'
-feature_class = 'glcm'
-settings = getSettings(image_array,new_mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-# apex - glrlm
-region_class = 'apex'
-feature_class = 'glrlm'
-settings = getSettings(image_array,new_mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)      
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-# apex - glszm
-region_class = 'apex'
-feature_class = 'glszm'
-settings = getSettings(image_array,new_mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)      
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-
-# apex - ngtdm
-region_class = 'apex'
-feature_class = 'ngtdm'
-settings = getSettings(image_array,new_mask_array,64)     
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-# apex - gldm
-region_class = 'apex'
-feature_class = 'gldm'
-settings = getSettings(image_array,new_mask_array,64)      
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)       
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-
-#---Base---# 
-
-# prepare input
-slice_nr = index[0][np.size(index)-math.floor(np.size(index)/3):]  
-new_mask = getSliceFromMask(mask,slice_nr)
-new_mask_array = sitk.GetArrayFromImage(new_mask)
-
-# base - firstorder
-region_class = 'base'
-feature_class = 'firstorder'
-settings = getSettings(image_array,new_mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-            
-# base - shape 3d
-region_class = 'base'
-feature_class = 'shape'
-settings = getSettings(image_array,new_mask_array,64)       
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-   # base - glcm
-region_class = 'base'
-feature_class = 'glcm'
-settings = getSettings(image_array,new_mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-# base - glrlm
-region_class = 'base'
-feature_class = 'glrlm'
-settings = getSettings(image_array,new_mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)      
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-# base - glszm
-region_class = 'base'
-feature_class = 'glszm'
-settings = getSettings(image_array,new_mask_array,64)
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)      
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-
-# base - ngtdm
-region_class = 'base'
-feature_class = 'ngtdm'
-settings = getSettings(image_array,new_mask_array,64)     
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-    
-# base - gldm
-region_class = 'base'
-feature_class = 'gldm'
-settings = getSettings(image_array,new_mask_array,64)      
-extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings)
-extractor.disableAllFeatures()
-extractor.enableFeatureClassByName(feature_class)       
-featureVector = extractor.execute(image,new_mask)
-for key in featureVector.keys():
-    if type(featureVector[key]) == type(np.array(1)):
-        featureVector[key] = float(featureVector[key])        
-results_name = patient_nr+'_'+region_class+'_'+feature_class+'.json'
-with open(os.path.join(results_dir,results_name), 'w') as f:
-    f.write(json.dumps(featureVector))
-        
-                    
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Mar 12 15:55:07 2018
+
+@author: mattjise
+Modified by Mohammed Sunoqrot March 2020
+
+The features of a case can be extracted from files (runCase, as the script
+does for a job of SQC.m) or from images in memory, e.g. right after the
+segmentation, without writing anything to disk:
+
+    import pyradiomicsFeatureExtraction as extraction
+    import qualityScore
+    results = extraction.extractFromImages(image,mask,regions = ['wholeprostate','apex','base'],classes = ['shape','glcm'])
+    score = qualityScore.loadModel().scoreResults(extraction.extractFromImages(image,mask,plan = qualityScore.extractionPlan()))
+"""
+
+import SimpleITK as sitk
+import numpy as np
+import math
+import json
+import multiprocessing
+import os
+import sys
+import concurrent.futures
+
+import featureCache
+import featureWriter
+import metaImage
+import stageTrace
+
+# feature classes, in the order they are written and read back by SQC.m
+feature_classes = ['firstorder','shape','glcm','glrlm','glszm','ngtdm','gldm']
+
+# region classes written for a case by SQC.m, the Retrain features add 'middle'
+region_classes = ['wholeprostate','apex','base']
+
+# region classes with their label in the region label map
+region_labels = {'apex':1,'middle':2,'base':3}
+
+# feature classes from the most to the least expensive to extract (the shape
+# mesh by far), the order in which the (region, feature class) units of a case are started
+unit_cost_order = ['shape','glcm','glszm','glrlm','ngtdm','gldm','firstorder']
+
+# binWidth as a python float: the range of a float32 scan is a numpy float32,
+# which neither the cache key nor the JSON output can serialize
+def getSettings(intensity_range_in,nr_bins):
+    settings = {}
+    settings['binWidth'] = float(intensity_range_in/64)
+    settings['correctMask'] = True
+    return settings
+
+# Partition the mask into apex/middle/base thirds of its slices in one pass.
+# Returns a label map (apex=1, middle=2, base=3) and the extractor settings of
+# every region, with the intensity ranges taken from the same pass.
+def getRegions(image_array_in,mask_array_in):
+    # slice labels
+    index = np.flatnonzero(mask_array_in.any(axis = (1,2)))
+    nr_slices = np.size(index)
+    nr_third = math.floor(nr_slices/3)
+    slice_labels = np.zeros(mask_array_in.shape[0],dtype = np.uint8)
+    slice_labels[index[nr_third:nr_slices-nr_third]] = region_labels['middle']
+    slice_labels[index[0:nr_third]] = region_labels['apex']
+    slice_labels[index[nr_slices-nr_third:]] = region_labels['base']
+    # label map
+    prostate = mask_array_in == 1
+    label_map = np.multiply(prostate,slice_labels[:,None,None],dtype = np.uint8)
+    # per slice intensity range, the voxels of each slice are contiguous in C order
+    values = image_array_in[prostate]
+    counts = np.count_nonzero(prostate,axis = (1,2))
+    filled = np.flatnonzero(counts)
+    if np.size(filled) == 0:
+        raise ValueError('The mask has no voxels with label 1')
+    starts = np.concatenate(([0],np.cumsum(counts[filled])[:-1]))
+    slice_min = np.minimum.reduceat(values,starts)
+    slice_max = np.maximum.reduceat(values,starts)
+    # settings per region
+    with stageTrace.span('getSettings',region = 'wholeprostate'):
+        settings = {'wholeprostate': getSettings(np.max(slice_max)-np.min(slice_min),64)}
+    for region_class,label in region_labels.items():
+        in_region = slice_labels[filled] == label
+        if not np.any(in_region):
+            raise ValueError('The %s region of the mask is empty' % region_class)
+        with stageTrace.span('getSettings',region = region_class):
+            settings[region_class] = getSettings(np.max(slice_max[in_region])-np.min(slice_min[in_region]),64)
+    return label_map,settings
+
+# Split one multi-class featureVector into one featureVector per feature class.
+# Every class keeps the shared diagnostics, so the output equals a run with
+# only that class enabled.
+def splitFeatureVector(featureVector_in,feature_classes_in):
+    diagnostics = [(key,value) for key,value in featureVector_in.items() if key.startswith('diagnostics_')]
+    featureVectors = {feature_class: dict(diagnostics) for feature_class in feature_classes_in}
+    for key,value in featureVector_in.items():
+        feature_class = key.split('_')[1]
+        if not key.startswith('diagnostics_') and feature_class in featureVectors:
+            featureVectors[feature_class][key] = value
+    return featureVectors
+
+# Enable the requested features of an extractor. feature_classes_in is a list
+# of feature classes, or {feature class: [feature]} to enable single features
+# (an empty list enables the whole class).
+def enableFeatures(extractor_in,feature_classes_in):
+    extractor_in.disableAllFeatures()
+    if isinstance(feature_classes_in,dict):
+        extractor_in.enableFeaturesByName(**{feature_class: list(features) for feature_class,features in feature_classes_in.items()})
+    else:
+        for feature_class in feature_classes_in:
+            extractor_in.enableFeatureClassByName(feature_class)
+
+# Extract the requested feature classes (see enableFeatures) for one region.
+# With single_pass the mask validation, correctMask resampling, cropping and
+# discretization run once for all classes instead of once per class.
+# The label selects the region when mask_in is the region label map, the
+# region class only names the region in the trace (see stageTrace.py).
+def extractRegion(image_in,mask_in,settings_in,feature_classes_in,single_pass=True,label_in=1,region_class=None):
+    # imported on first use, a case served from the feature cache never loads radiomics
+    import radiomics.featureextractor
+    if not single_pass:
+        featureVectors = {}
+        for feature_class in feature_classes_in:
+            extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings_in)
+            if isinstance(feature_classes_in,dict):
+                enableFeatures(extractor,{feature_class: feature_classes_in[feature_class]})
+            else:
+                enableFeatures(extractor,[feature_class])
+            with stageTrace.span('execute',region = region_class,classes = [feature_class],label = label_in):
+                featureVectors[feature_class] = extractor.execute(image_in,mask_in,label=label_in)
+        return featureVectors
+    extractor = radiomics.featureextractor.RadiomicsFeatureExtractor(**settings_in)
+    enableFeatures(extractor,feature_classes_in)
+    with stageTrace.span('execute',region = region_class,classes = list(feature_classes_in),label = label_in):
+        featureVector = extractor.execute(image_in,mask_in,label=label_in)
+    return splitFeatureVector(featureVector,feature_classes_in)
+
+def writeJson(file_in,featureVector):
+    with open(file_in,'w') as f:
+        f.write(json.dumps(featureWriter.toNative(featureVector)))
+
+# Written under a temporary name and renamed, a partly written file never has the final name
+def writeFeatureVector(featureVector,results_dir_in,patient_nr_in,region_class_in,feature_class_in):
+    results_name = patient_nr_in+'_'+region_class_in+'_'+feature_class_in+'.json'
+    featureWriter.writeAtomic(os.path.join(results_dir_in,results_name),writeJson,featureVector)
+
+# Read a volume as a (z,y,x) array and its geometry. Uncompressed MetaIO files
+# are memory mapped (see metaImage.py), anything else is read with SimpleITK.
+def readVolume(file_in):
+    with stageTrace.span('read',file = file_in) as span:
+        try:
+            array,geometry = metaImage.mapArray(file_in)
+            span.set(mapped = True)
+        except ValueError:
+            image = sitk.ReadImage(file_in)
+            array,geometry = sitk.GetArrayFromImage(image),metaImage.imageGeometry(image)
+            span.set(mapped = False)
+        span.set(voxels = int(array.size))
+        return array,geometry
+
+# Crop image and mask arrays to the bounding box of the mask, padded by pad_in
+# voxels, returns the cropped arrays and their geometry.
+# Masks that are not on the image grid are left to correctMask.
+def cropToMask(image_array_in,mask_array_in,geometry_in,mask_geometry_in,pad_in=5):
+    if image_array_in.shape != mask_array_in.shape or geometry_in['spacing'] != mask_geometry_in['spacing']:
+        return image_array_in,mask_array_in,geometry_in,mask_geometry_in
+    bounds = []
+    for axis in range(mask_array_in.ndim):
+        nonzero = np.flatnonzero(mask_array_in.any(axis = tuple(a for a in range(mask_array_in.ndim) if a != axis)))
+        if np.size(nonzero) == 0:
+            return image_array_in,mask_array_in,geometry_in,mask_geometry_in
+        bounds.append((max(nonzero[0]-pad_in,0),min(nonzero[-1]+pad_in+1,mask_array_in.shape[axis])))
+    crop = tuple(slice(lower,upper) for lower,upper in bounds)
+    # numpy axes are z,y,x and SimpleITK indices x,y,z
+    index = [int(lower) for lower,_ in bounds[::-1]]
+    nr_dims = len(index)
+    # summed as in ITK's TransformIndexToPhysicalPoint, for the same rounding
+    origin = []
+    for ii in range(nr_dims):
+        offset = 0.0
+        for jj in range(nr_dims):
+            offset += geometry_in['direction'][ii*nr_dims+jj]*geometry_in['spacing'][jj]*index[jj]
+        origin.append(geometry_in['origin'][ii]+offset)
+    geometry = dict(geometry_in,origin = tuple(origin))
+    return image_array_in[crop],mask_array_in[crop],geometry,dict(mask_geometry_in,origin = geometry['origin'])
+
+# Peak resident memory of this process in MB, None where it cannot be read
+def peakMemoryMB():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024**2 if sys.platform == 'darwin' else peak/1024
+
+# Geometry of the mask on the grid of the image: the direction and origin of
+# the image, as SQC.m sets them, and also its spacing where the two differ only
+# by the single precision NIfTI (.nii/.nii.gz) keeps it in
+def reconcileGeometry(image_shape_in,geometry_in,mask_shape_in,mask_geometry_in):
+    mask_geometry = dict(mask_geometry_in,direction = geometry_in['direction'],origin = geometry_in['origin'])
+    if tuple(mask_shape_in) == tuple(image_shape_in) and np.allclose(mask_geometry_in['spacing'],geometry_in['spacing'],rtol = 1e-6,atol = 0):
+        mask_geometry['spacing'] = geometry_in['spacing']
+    return mask_geometry
+
+# Cast the mask of a case to uint8 on the grid of the image, and crop both to
+# the padded bounding box of the mask with crop
+def prepareCase(image_array_in,mask_array_in,geometry_in,mask_geometry_in,crop=False):
+    with stageTrace.span('cast mask',voxels = int(mask_array_in.size)):
+        mask_array = mask_array_in.astype(np.uint8,copy = False)
+    mask_geometry = reconcileGeometry(image_array_in.shape,geometry_in,mask_array.shape,mask_geometry_in)
+    # only the cropped part of the volumes is ever copied
+    if crop:
+        with stageTrace.span('crop') as span:
+            image_array_in,mask_array,geometry_in,mask_geometry = cropToMask(image_array_in,mask_array,geometry_in,mask_geometry)
+            span.set(voxels = int(image_array_in.size))
+    return image_array_in,mask_array,geometry_in,mask_geometry
+
+# Read the image and mask of a case as arrays with their geometry, cropped to
+# the padded bounding box of the mask with crop. Scans and masks can be MetaIO,
+# NIfTI or any other format SimpleITK reads. The arrays are memory mapped
+# where possible; with load the voxels are read now, as by a read-ahead thread.
+def readCase(image_dir,mask_dir,crop=False,load=False):
+    image_array,geometry = readVolume(image_dir)
+    mask_array,mask_geometry = readVolume(mask_dir)
+    image_array,mask_array,geometry,mask_geometry = prepareCase(image_array,mask_array,geometry,mask_geometry,crop)
+    if load:
+        with stageTrace.span('load',voxels = int(image_array.size)):
+            image_array = np.array(image_array)
+            mask_array = np.array(mask_array)
+    return image_array,mask_array,geometry,mask_geometry
+
+# A case as readCase returns it from images in memory: SimpleITK images, or
+# (z,y,x) numpy arrays with the spacing, origin and direction in SimpleITK
+# (x,y,z) order (default 1 mm voxels, zero origin, identity direction).
+# A mask array is taken to be on the grid of the image.
+def caseFromImages(image_in,mask_in,spacing=None,origin=None,direction=None,crop=False):
+    if isinstance(image_in,sitk.Image):
+        image_array,geometry = sitk.GetArrayFromImage(image_in),metaImage.imageGeometry(image_in)
+    else:
+        image_array = np.asarray(image_in)
+        nr_dims = image_array.ndim
+        geometry = {'spacing': tuple(float(value) for value in (spacing if spacing is not None else [1.0]*nr_dims)),
+                    'origin': tuple(float(value) for value in (origin if origin is not None else [0.0]*nr_dims)),
+                    'direction': tuple(float(value) for value in (np.ravel(direction) if direction is not None else np.eye(nr_dims).ravel()))}
+    if isinstance(mask_in,sitk.Image):
+        mask_array,mask_geometry = sitk.GetArrayFromImage(mask_in),metaImage.imageGeometry(mask_in)
+    else:
+        mask_array,mask_geometry = np.asarray(mask_in),geometry
+        if mask_array.shape != image_array.shape:
+            raise ValueError('mask of size %s, the image is %s' % (mask_array.shape,image_array.shape))
+    return prepareCase(image_array,mask_array,geometry,mask_geometry,crop)
+
+# Extract the features of an image and mask in memory, nothing is read from or
+# written to disk. Returns {region class: {feature class: feature vector}}.
+# regions and classes select what is extracted (regions can include 'middle'),
+# see caseFromImages for the images and extractCase for the other options.
+def extractFromImages(image_in,mask_in,spacing=None,origin=None,direction=None,regions=region_classes,classes=feature_classes,
+                      plan=None,cache=None,crop=False,single_pass=True,unit_workers=0):
+    unknown = [region_class for region_class in (plan or regions) if region_class != 'wholeprostate' and region_class not in region_labels]
+    unknown += [feature_class for feature_class in classes if feature_class not in feature_classes]
+    if unknown:
+        raise ValueError('Unknown regions or feature classes: %s' % ', '.join(unknown))
+    case = caseFromImages(image_in,mask_in,spacing,origin,direction,crop)
+    return extractCase(case,single_pass,classes,regions,plan,cache,unit_workers)
+
+# Extract the features of a case read by readCase, returns them per region and feature class.
+# A plan {region class: {feature class: [feature]}} (see qualityScore.extractionPlan)
+# replaces the region and feature classes, only the planned features are extracted.
+# With a featureCache.FeatureCache the features of a case seen before are
+# taken from the cache instead of being extracted again. With unit_workers the
+# (region, feature class) units run in parallel (see extractUnits).
+# The diagnostics are left out of a planned extraction unless diagnostics is set.
+def extractCase(case_in,single_pass=True,feature_classes_in=feature_classes,region_classes_in=region_classes,plan=None,cache=None,
+                unit_workers=0,diagnostics=None):
+    image_array,mask_array,geometry,mask_geometry = case_in
+    if diagnostics is None:
+        diagnostics = plan is None
+    if plan is None:
+        plan = {region_class: feature_classes_in for region_class in region_classes_in}
+
+    # get regions
+    with stageTrace.span('region split',voxels = int(mask_array.size)):
+        label_map_array,settings = getRegions(image_array,mask_array)
+    # a planned extraction only feeds the model, which does not use the
+    # diagnostics (image and mask hashes, label statistics)
+    if not diagnostics:
+        for region_settings in settings.values():
+            region_settings['additionalInfo'] = False
+
+    if cache is not None:
+        with stageTrace.span('cache lookup') as span:
+            cache_key = featureCache.caseKey(featureCache.imageHash(image_array,geometry),featureCache.imageHash(mask_array,mask_geometry),
+                                             {region_class: settings[region_class] for region_class in plan},plan)
+            results = cache.get(cache_key)
+            span.set(hit = results is not None)
+        if results is not None:
+            return results
+    if unit_workers > 1:
+        with stageTrace.span('units',workers = unit_workers):
+            results = extractUnits(case_in,label_map_array,settings,plan,unit_workers)
+        if cache is not None:
+            cache.put(cache_key,results)
+        return results
+    with stageTrace.span('images',voxels = int(image_array.size)):
+        image = metaImage.toImage(image_array,geometry)
+        mask = metaImage.toImage(mask_array,mask_geometry)
+        label_map = sitk.GetImageFromArray(label_map_array)
+        label_map.CopyInformation(mask)
+    # voxels per region, only counted for the trace
+    region_voxels = regionVoxels(mask_array,label_map_array,plan) if stageTrace.enabled() else {}
+    del case_in,mask_array,image_array,label_map_array
+    # whole prostate from the mask, the other regions from the label map
+    results = {}
+    for region_class,region_feature_classes in plan.items():
+        with stageTrace.span('region',region = region_class,voxels = region_voxels.get(region_class)):
+            if region_class == 'wholeprostate':
+                results[region_class] = extractRegion(image,mask,settings[region_class],region_feature_classes,single_pass,
+                                                      region_class = region_class)
+            else:
+                results[region_class] = extractRegion(image,label_map,settings[region_class],region_feature_classes,single_pass,
+                                                      region_labels[region_class],region_class)
+    if cache is not None:
+        cache.put(cache_key,results)
+    return results
+
+def regionVoxels(mask_array_in,label_map_array_in,region_classes_in):
+    return {region_class: int(np.count_nonzero(mask_array_in == 1) if region_class == 'wholeprostate' else
+                              np.count_nonzero(label_map_array_in == region_labels[region_class])) for region_class in region_classes_in}
+
+# images of the case in a unit worker, set by initUnitWorker
+unit_images = None
+
+def initUnitWorker(case_in,label_map_array_in):
+    global unit_images
+    image_array,mask_array,geometry,mask_geometry = case_in
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1)
+    mask = metaImage.toImage(mask_array,mask_geometry)
+    label_map = sitk.GetImageFromArray(label_map_array_in)
+    label_map.CopyInformation(mask)
+    unit_images = (metaImage.toImage(image_array,geometry),mask,label_map)
+
+# Extract one feature class of one region in a unit worker
+def extractUnit(region_class_in,feature_class_in,features_in,settings_in):
+    image,mask,label_map = unit_images
+    feature_classes = [feature_class_in] if features_in is None else {feature_class_in: features_in}
+    with stageTrace.span('unit',region = region_class_in,classes = [feature_class_in]):
+        if region_class_in == 'wholeprostate':
+            return extractRegion(image,mask,settings_in,feature_classes,region_class = region_class_in)[feature_class_in]
+        return extractRegion(image,label_map,settings_in,feature_classes,True,region_labels[region_class_in],region_class_in)[feature_class_in]
+
+# Extract the (region, feature class) units of a case on unit_workers_in processes.
+# The workers get the case once (shared, not copied, where processes are forked),
+# the most expensive units are started first and the results are put together
+# in the order of the plan, so the output is the same as a sequential run.
+def extractUnits(case_in,label_map_array_in,settings_in,plan_in,unit_workers_in):
+    units = [(region_class,feature_class) for region_class,region_feature_classes in plan_in.items() for feature_class in region_feature_classes]
+    units.sort(key = lambda unit: (unit_cost_order.index(unit[1]),unit[0] != 'wholeprostate'))
+    # imported before the workers are forked, so they do not import it each
+    import radiomics.featureextractor
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with concurrent.futures.ProcessPoolExecutor(min(unit_workers_in,len(units)),mp_context = context,initializer = initUnitWorker,
+                                                initargs = (case_in,label_map_array_in)) as pool:
+        futures = {}
+        for region_class,feature_class in units:
+            region_feature_classes = plan_in[region_class]
+            features = region_feature_classes[feature_class] if isinstance(region_feature_classes,dict) else None
+            futures[(region_class,feature_class)] = pool.submit(extractUnit,region_class,feature_class,features,settings_in[region_class])
+        return {region_class: {feature_class: futures[(region_class,feature_class)].result() for feature_class in region_feature_classes}
+                for region_class,region_feature_classes in plan_in.items()}
+
+# The output_format 'json' writes one file per region and feature class, the
+# other formats of featureWriter one record per case.
+def writeResults(results_dir,patient_nr,results_in,output_format='json'):
+    with stageTrace.span('write',case = patient_nr,format = output_format):
+        if output_format == 'json':
+            for region_class,featureVectors in results_in.items():
+                for feature_class,featureVector in featureVectors.items():
+                    writeFeatureVector(featureVector,results_dir,patient_nr,region_class,feature_class)
+        else:
+            featureWriter.writeCase(results_dir,patient_nr,results_in,output_format)
+
+# Extract and write the features of one case, returns them per region and feature class.
+# See readCase, extractCase and writeResults for the options.
+def runCase(image_dir,mask_dir,results_dir,patient_nr,single_pass=True,feature_classes_in=feature_classes,region_classes_in=region_classes,
+            output_format='json',crop=False,plan=None,cache=None,unit_workers=0,diagnostics=None):
+    # no reference to the read case is kept here, extractCase releases the arrays once the images exist
+    with stageTrace.span('case',case = patient_nr):
+        results = extractCase(readCase(image_dir,mask_dir,crop),single_pass,feature_classes_in,region_classes_in,plan,cache,unit_workers,
+                              diagnostics)
+        writeResults(results_dir,patient_nr,results,output_format)
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    import jobSpec
+    parser = argparse.ArgumentParser(description='Extract the radiomics features of a case of SQC.m')
+    parser.add_argument('--job',help='job JSON file, - for stdin or a paths.txt file (default: --image, --mask, ... '
+                                     'or the paths.txt next to this script)')
+    jobSpec.addJobArguments(parser)
+    parser.add_argument('--format',default='json',choices=['json','ndjson','npz','mat'],
+                        help='one JSON file per region and class, or one record per case')
+    parser.add_argument('--per-class',action='store_true',help='run pyradiomics once per feature class instead of once per region')
+    parser.add_argument('--crop',action='store_true',help='crop the volumes to the padded bounding box of the mask')
+    parser.add_argument('--prune',action='store_true',help='extract only the features with a nonzero coefficient in trainedModel.mat')
+    parser.add_argument('--cache',help='feature cache folder (see featureCache.py)')
+    parser.add_argument('--unit-workers',type=int,default=0,
+                        help='extract the (region, feature class) units of the case on this many processes')
+    parser.add_argument('--trace',help='Chrome trace JSON file of the stage timings (see stageTrace.py)')
+    parser.add_argument('--memory',action='store_true',help='print the peak memory of the process')
+    args = parser.parse_args()
+    if args.trace:
+        stageTrace.startTrace(args.trace)
+    if args.job:
+        job = jobSpec.readSpec(args.job)
+    else:
+        job = jobSpec.jobFromArguments(args) or jobSpec.readSpec(os.path.join(os.path.dirname(sys.argv[0]),'paths.txt'))
+    job = jobSpec.prepareJob(job,args.scratch_root)
+    image_dir,mask_dir,results_dir,patient_nr = job['image'],job['mask'],job['results'],job['case']
+    plan = None
+    if args.prune:
+        import qualityScore
+        plan = qualityScore.extractionPlan()
+    cache = featureCache.FeatureCache(args.cache) if args.cache else None
+    runCase(image_dir,mask_dir,results_dir,patient_nr,not args.per_class,output_format = args.format,crop = args.crop,plan = plan,
+            cache = cache,unit_workers = args.unit_workers)
+    print(json.dumps({'job_id': job['job_id'], 'results': results_dir}))
+    if args.memory:
+        print('peak memory %.1f MB' % peakMemoryMB())
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+Long-lived feature extraction worker for SQC.m
+
+The worker imports radiomics, SimpleITK and numpy once, warms the enabled
+feature classes on a small synthetic case and then serves extraction jobs
+over a local socket. Every job runs in a fork of the warmed process (or in a
+thread where fork is not available), so a job pays neither interpreter start
+nor imports. The client side only imports the standard library; the
+extraction modules are imported when there is no worker to send the job to.
+
+A job is one case with a unique job id and its own results folder (see
+jobSpec.py), so several SQC.m sessions can submit cases at the same time.
+
+Start the worker once:
+    python pyradiomicsWorker.py --serve
+Send a case:
+    python pyradiomicsWorker.py --submit --image Case001_normalized.mhd --mask Case001_segmentation.mhd --results FOLDER --format mat
+    python pyradiomicsWorker.py --submit job.json
+Compare a cold python process with the worker on a case:
+    python pyradiomicsWorker.py --measure --image Case001_normalized.mhd --mask Case001_segmentation.mhd
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import jobSpec
+
+base_path = os.path.dirname(os.path.abspath(__file__))
+
+# Folder of the default sockets, one per user so no other user can reach them
+def socketFolder():
+    if hasattr(os,'getuid'):
+        return os.path.join(tempfile.gettempdir(),'sqc-%d' % os.getuid())
+    return tempfile.gettempdir()
+
+def defaultAddress():
+    if 'SQC_WORKER_ADDRESS' in os.environ:
+        return os.environ['SQC_WORKER_ADDRESS']
+    if hasattr(socket,'AF_UNIX'):
+        return os.path.join(socketFolder(),'sqc-worker.sock')
+    return '127.0.0.1:50507'
+
+# 'host:port' is a TCP address on this machine, anything else a Unix socket path
+def parseAddress(address_in):
+    host,sep,port = address_in.rpartition(':')
+    if sep and port.isdigit():
+        return (host or '127.0.0.1',int(port))
+    return address_in
+
+# Job of a specification file ('-' for stdin) or of the --image, --mask, ... arguments
+def readJob(spec_in,args_in):
+    job = jobSpec.readSpec(spec_in) if spec_in else jobSpec.jobFromArguments(args_in)
+    if job is None:
+        raise ValueError('give a job specification or --image and --mask')
+    return jobSpec.prepareJob(job,args_in.scratch_root)
+
+# Feature cache of a job, the worker's own cache unless the job names one
+def jobCache(job_in,cache_dir_in=None):
+    cache_dir = job_in.get('cache') or cache_dir_in
+    if not cache_dir:
+        return None
+    import featureCache
+    return featureCache.FeatureCache(cache_dir)
+
+# Extraction plan of trainedModel.mat for a job with prune set, None extracts all features
+def jobPlan(job_in):
+    if not job_in.get('prune'):
+        return None
+    import qualityScore
+    return qualityScore.extractionPlan()
+
+#---Server---#
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        start = time.perf_counter()
+        try:
+            job = json.loads(self.rfile.readline().decode('utf-8'))
+            if job.get('command') == 'stats':
+                response = dict(self.server.stats)
+            else:
+                self.server.extraction.runCase(job['image'],job['mask'],job['results'],job['case'],
+                                               job.get('single_pass',True),self.server.extraction.feature_classes,
+                                               self.server.extraction.region_classes,job.get('format','json'),
+                                               plan = jobPlan(job),cache = jobCache(job,self.server.cache_dir),
+                                               unit_workers = job.get('unit_workers',0))
+                response = {'job_id': job.get('job_id'), 'results': job['results']}
+            response['status'] = 'ok'
+        except Exception as e:
+            response = {'status': 'error', 'message': '%s: %s' % (type(e).__name__,e)}
+        response['seconds'] = time.perf_counter()-start
+        self.wfile.write((json.dumps(response)+'\n').encode('utf-8'))
+
+# Make the socket folder of the default address, only accessible to this user
+def privateFolder(folder_in):
+    os.makedirs(folder_in,mode=0o700,exist_ok=True)
+    if hasattr(os,'getuid'):
+        folder_stat = os.stat(folder_in)
+        if folder_stat.st_uid != os.getuid() or folder_stat.st_mode & 0o077:
+            raise PermissionError('%s is not a folder of this user only' % folder_in)
+
+# Prepare the path of a Unix socket to bind: a socket left by a server that is
+# gone is removed, a path with a server listening on it or that is not a
+# socket is refused
+def clearSocket(path_in):
+    if os.path.dirname(os.path.abspath(path_in)) == socketFolder():
+        privateFolder(socketFolder())
+    if not os.path.lexists(path_in):
+        return
+    if not stat.S_ISSOCK(os.lstat(path_in).st_mode):
+        raise FileExistsError('%s exists and is not a socket' % path_in)
+    with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path_in)
+        except ConnectionRefusedError:
+            os.remove(path_in)
+            return
+    raise FileExistsError('a server is already listening on %s' % path_in)
+
+def makeServer(address_in):
+    address = parseAddress(address_in)
+    if isinstance(address,str):
+        clearSocket(address)
+        server_base = socketserver.UnixStreamServer
+    else:
+        server_base = socketserver.TCPServer
+    if hasattr(os,'fork'):
+        server_mixin = socketserver.ForkingMixIn
+    else:
+        server_mixin = socketserver.ThreadingMixIn
+    server_class = type('WorkerServer',(server_mixin,server_base),{'allow_reuse_address': True,'daemon_threads': True})
+    server = server_class(address,JobHandler)
+    if isinstance(address,str):
+        # only this user may send jobs, whatever folder the socket is in
+        os.chmod(address,0o600)
+    return server
+
+# Run the enabled feature classes once on a small synthetic case
+def warmUp(extraction_in,feature_classes_in):
+    import numpy as np
+    import SimpleITK as sitk
+    zz,yy,xx = np.mgrid[:6,:24,:24]
+    mask_array = ((((zz-2.5)/3)**2+((yy-11.5)/9)**2+((xx-11.5)/9)**2) <= 1).astype(np.uint8)
+    image_array = np.random.default_rng(0).normal(100,10,mask_array.shape)+50*mask_array
+    image = sitk.GetImageFromArray(image_array)
+    mask = sitk.GetImageFromArray(mask_array)
+    label_map_array,settings = extraction_in.getRegions(image_array,mask_array)
+    label_map = sitk.GetImageFromArray(label_map_array)
+    label_map.CopyInformation(mask)
+    extraction_in.extractRegion(image,mask,settings['wholeprostate'],feature_classes_in)
+    extraction_in.extractRegion(image,label_map,settings['apex'],feature_classes_in,True,extraction_in.region_labels['apex'])
+
+# feature_classes_in only limits the warm-up, every job gets all feature classes
+# (or the --prune plan), the same as when it is extracted without the worker
+def serve(address_in,feature_classes_in=None,cache_dir_in=None,trace_file_in=None):
+    import logging
+    start = time.perf_counter()
+    import SimpleITK as sitk
+    import radiomics.featureextractor
+    import pyradiomicsFeatureExtraction as extraction
+    import_seconds = time.perf_counter()-start
+    # forked jobs must not inherit a thread pool whose threads only exist in the parent
+    sitk.ProcessObject.SetGlobalDefaultThreader('PLATFORM')
+    logging.getLogger('radiomics').setLevel(logging.ERROR)
+    if feature_classes_in is None:
+        feature_classes_in = extraction.feature_classes
+    start = time.perf_counter()
+    warmUp(extraction,feature_classes_in)
+    # the forked jobs inherit the loaded model
+    import qualityScore
+    if os.path.exists(qualityScore.default_model):
+        qualityScore.loadModel()
+    warmup_seconds = time.perf_counter()-start
+    # started after the warm-up, the forked jobs write into the same trace
+    if trace_file_in:
+        import stageTrace
+        stageTrace.startTrace(trace_file_in)
+
+    server = makeServer(address_in)
+    server.extraction = extraction
+    server.cache_dir = cache_dir_in
+    server.stats = {'pid': os.getpid(), 'import_seconds': import_seconds, 'warmup_seconds': warmup_seconds,
+                    'warmup_classes': feature_classes_in}
+    # stop cleanly on kill so the socket file is removed
+    signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0))
+    print('SQC worker on %s (import %.2f s, warm-up %.2f s)' % (address_in,import_seconds,warmup_seconds))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if isinstance(server.server_address,str) and os.path.exists(server.server_address):
+            os.remove(server.server_address)
+
+#---Client---#
+
+def submit(job_in,address_in):
+    address = parseAddress(address_in)
+    if isinstance(address,str):
+        client = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    else:
+        client = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    with client:
+        client.connect(address)
+        client.sendall((json.dumps(job_in)+'\n').encode('utf-8'))
+        with client.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        # the worker (or the fork of the job) died before it answered
+        raise ConnectionError('no answer from the worker on %s' % address_in)
+    return json.loads(line.decode('utf-8'))
+
+# Send the job to the worker, or extract it in this process if no worker is
+# listening or the worker does not give a valid answer
+def runJob(job_in,address_in):
+    try:
+        response = submit(job_in,address_in)
+    except (OSError,ValueError):
+        import pyradiomicsFeatureExtraction as extraction
+        extraction.runCase(job_in['image'],job_in['mask'],job_in['results'],job_in['case'],job_in.get('single_pass',True),
+                           extraction.feature_classes,extraction.region_classes,job_in.get('format','json'),
+                           plan = jobPlan(job_in),cache = jobCache(job_in),unit_workers = job_in.get('unit_workers',0))
+        return {'status': 'ok', 'worker': False, 'job_id': job_in.get('job_id'), 'results': job_in['results']}
+    response['worker'] = True
+    return response
+
+# Time a cold python process (interpreter start, imports, first case) against the worker
+def measure(job_in,address_in):
+    code = ('import json,sys,time\n'
+            't0 = time.perf_counter()\n'
+            'import pyradiomicsFeatureExtraction as extraction\n'
+            't1 = time.perf_counter()\n'
+            'extraction.runCase(*sys.argv[1:5])\n'
+            't2 = time.perf_counter()\n'
+            'print(json.dumps({"import_seconds": t1-t0, "case_seconds": t2-t1}))\n')
+    start = time.perf_counter()
+    cold = subprocess.run([sys.executable,'-c',code,job_in['image'],job_in['mask'],job_in['results'],job_in['case']],
+                          cwd=base_path,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL,check=True)
+    cold_total = time.perf_counter()-start
+    cold = json.loads(cold.stdout.decode('utf-8').strip().splitlines()[-1])
+    print('cold process: interpreter %.2f s, import %.2f s, first case %.2f s, total %.2f s'
+          % (cold_total-cold['import_seconds']-cold['case_seconds'],cold['import_seconds'],cold['case_seconds'],cold_total))
+    try:
+        stats = submit({'command': 'stats'},address_in)
+    except OSError:
+        print('no worker listening on %s' % address_in)
+        return
+    latencies = []
+    for ii in range(2):
+        start = time.perf_counter()
+        response = submit(job_in,address_in)
+        latencies.append(time.perf_counter()-start)
+        if response['status'] != 'ok':
+            raise RuntimeError(response['message'])
+    print('worker (import %.2f s, warm-up %.2f s once at start): first case %.2f s, next case %.2f s'
+          % (stats['import_seconds'],stats['warmup_seconds'],latencies[0],latencies[1]))
+    print('saved per case: %.2f s' % (cold_total-latencies[0]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Long-lived pyradiomics feature extraction worker for SQC.m')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--serve',action='store_true',help='start the worker')
+    mode.add_argument('--submit',metavar='SPEC',nargs='?',const='',
+                      help='extract a case: the job of a JSON file, - for JSON on stdin, a paths.txt file, or without SPEC '
+                           'the job of --image, --mask, ...')
+    mode.add_argument('--measure',metavar='SPEC',nargs='?',const='',help='compare cold start and worker latency on a case')
+    parser.add_argument('--address',default=defaultAddress(),help='Unix socket path or host:port')
+    parser.add_argument('--classes',nargs='+',help='feature classes to warm up in the worker (default all), the jobs always '
+                                                  'extract all classes')
+    parser.add_argument('--format',default='json',choices=['json','ndjson','npz','mat'],
+                        help='output of a submitted case: one JSON file per region and class, or one record per case')
+    parser.add_argument('--prune',action='store_true',
+                        help='extract only the features with a nonzero coefficient in trainedModel.mat')
+    parser.add_argument('--unit-workers',type=int,default=0,
+                        help='extract the (region, feature class) units of the submitted case on this many processes')
+    parser.add_argument('--cache',help='feature cache folder, of the worker with --serve, else of the submitted case')
+    parser.add_argument('--trace',help='Chrome trace JSON file of the stage timings: of every job with --serve, of the submitted '
+                                       'case when no worker is running (see stageTrace.py)')
+    jobSpec.addJobArguments(parser)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.address,args.classes,args.cache,args.trace)
+    elif args.submit is not None:
+        job = readJob(args.submit,args)
+        job['format'] = args.format
+        job['prune'] = args.prune
+        job['unit_workers'] = args.unit_workers
+        if args.cache:
+            job['cache'] = os.path.abspath(args.cache)
+        if args.trace:
+            import stageTrace
+            stageTrace.startTrace(args.trace)
+        response = runJob(job,args.address)
+        if response['status'] != 'ok':
+            sys.stderr.write(response['message']+'\n')
+            sys.exit(1)
+        print(json.dumps(response))
+    else:
+        job = readJob(args.measure,args)
+        try:
+            measure(job,args.address)
+        finally:
+            jobSpec.removeScratch(job)
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Local QC scoring service
+
+An asyncio HTTP service on a Unix socket or a local TCP port that takes the
+image and mask files of a case and answers with its quality score, quality
+class and timings. The features are extracted on a pool of warmed worker
+processes (only the features of the model, see qualityScore.extractionPlan),
+and the cases whose features are ready within a short window are scored
+together with one matrix product of the stored linear model. Everything runs
+on local files, nothing is downloaded.
+
+Requests (JSON bodies and answers):
+    POST /score   {"image": ..., "mask": ..., "case": ..., "threshold": 85}, or a list of those
+    GET  /stats   service counters: requests, batches, batch sizes
+    GET  /health
+
+Usage:
+    python qcService.py --serve --workers 4 --window-ms 20
+    python qcService.py --score Case10_normalized.mhd Case10_segmentation.mhd
+    curl --unix-socket /tmp/sqc-$(id -u)/sqc-service.sock -d '{"image": "...", "mask": "..."}' http://localhost/score
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from pyradiomicsWorker import clearSocket,parseAddress,socketFolder
+
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 422: 'Unprocessable Entity', 500: 'Internal Server Error'}
+
+def defaultAddress():
+    if 'SQC_SERVICE_ADDRESS' in os.environ:
+        return os.environ['SQC_SERVICE_ADDRESS']
+    if hasattr(socket,'AF_UNIX'):
+        return os.path.join(socketFolder(),'sqc-service.sock')
+    return '127.0.0.1:50508'
+
+# Problem of a case of a /score request that makes the request invalid, None when it has none
+def caseError(case_in):
+    if isinstance(case_in,dict) and 'threshold' in case_in:
+        threshold = case_in['threshold']
+        if isinstance(threshold,bool) or not isinstance(threshold,(int,float)) or not math.isfinite(threshold):
+            return 'threshold must be a number, not %s' % json.dumps(threshold)
+    return None
+
+#---Worker processes---#
+
+# A pool restarted while the service runs is forked from the event loop: the
+# workers drop its signal handlers, so a signal to a worker does not stop the service
+def initWorker(nr_threads_in):
+    import pyradiomicsBatch
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGINT,signal.default_int_handler)
+    signal.signal(signal.SIGTERM,signal.SIG_DFL)
+    pyradiomicsBatch.initWorker(nr_threads_in)
+
+# Extract the model features of a case in a pool worker, returns the feature
+# names and values in model column order and the worker timings
+def extractJob(job_in):
+    import featureCache
+    import featureWriter
+    import pyradiomicsFeatureExtraction as extraction
+    start = time.perf_counter()
+    case = extraction.readCase(job_in['image'],job_in['mask'],job_in.get('crop',False))
+    read_seconds = time.perf_counter()-start
+    cache = featureCache.FeatureCache(job_in['cache'],job_in.get('cache_bytes') or 1024**3) if job_in.get('cache') else None
+    results = extraction.extractCase(case,plan = job_in['plan'],cache = cache)
+    del case
+    names,values = featureWriter.modelColumns(results)
+    timings = {'read': read_seconds, 'extraction': time.perf_counter()-start-read_seconds, 'pid': os.getpid()}
+    if cache is not None:
+        timings['cache'] = 'hit' if cache.hits else 'miss'
+    return names,values,timings
+
+#---Service---#
+
+class QCService:
+    def __init__(self,model_file_in,nr_workers=None,window=0.02,max_batch=64,threshold=85,crop=False,cache_dir=None,cache_bytes=1024**3):
+        import qualityScore
+        self.qualityScore = qualityScore
+        self.model_file = model_file_in
+        self.model = qualityScore.loadModel(model_file_in)
+        self.plan = self.model.extractionPlan()
+        self.window = window
+        self.max_batch = max(1,max_batch)
+        self.threshold = threshold
+        self.job_options = {'crop': crop, 'cache': cache_dir, 'cache_bytes': cache_bytes}
+        self.nr_workers = nr_workers or os.cpu_count() or 1
+        # imported before the workers are forked, so they do not import it each
+        import radiomics.featureextractor
+        import logging
+        logging.getLogger('radiomics').setLevel(logging.ERROR)
+        self.nr_threads = max(1,(os.cpu_count() or 1)//self.nr_workers)
+        self.pool = self.makePool()
+        # forked now, before the event loop and its signal handlers exist
+        self.pool.submit(os.getpid).result()
+        self.stats = {'pid': os.getpid(), 'workers': self.nr_workers, 'window_ms': 1000*window, 'max_batch': self.max_batch,
+                      'requests': 0, 'cases': 0, 'failed': 0, 'batches': 0, 'batched_cases': 0, 'max_batch_size': 0,
+                      'model_reloads': 0, 'pool_restarts': 0}
+        self.started = time.time()
+
+    def makePool(self):
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        return concurrent.futures.ProcessPoolExecutor(self.nr_workers,mp_context = context,initializer = initWorker,
+                                                      initargs = (self.nr_threads,))
+
+    # Replace a broken pool, unless another case already did
+    def restartPool(self,pool_in):
+        if pool_in is self.pool:
+            pool_in.shutdown(wait = False,cancel_futures = True)
+            self.pool = self.makePool()
+            self.stats['pool_restarts'] += 1
+        return self.pool
+
+    # Follow the model file: loadModel reads it again only when its stamp
+    # changed, e.g. after retraining. A model file that cannot be read, as
+    # while it is written, keeps the current model until the next check.
+    def refreshModel(self):
+        try:
+            model = self.qualityScore.loadModel(self.model_file)
+        except Exception:
+            return
+        if model is not self.model:
+            self.model = model
+            self.plan = model.extractionPlan()
+            self.stats['model_reloads'] += 1
+
+    # Extract a case on the pool. A pool that broke before the case was sent
+    # (a worker died while idle) is replaced and takes the case; when it
+    # breaks during the case, the cases on it fail and a new pool takes the next ones.
+    async def extract(self,job_in):
+        loop = asyncio.get_running_loop()
+        pool = self.pool
+        try:
+            future = loop.run_in_executor(pool,extractJob,job_in)
+        except concurrent.futures.process.BrokenProcessPool:
+            pool = self.restartPool(pool)
+            future = loop.run_in_executor(pool,extractJob,job_in)
+        try:
+            return await future
+        except concurrent.futures.process.BrokenProcessPool:
+            self.restartPool(pool)
+            raise
+
+    async def queueScore(self,names_in,values_in):
+        scored = asyncio.get_running_loop().create_future()
+        await self.score_queue.put((names_in,values_in,scored))
+        return await scored
+
+    # Score a list of (names, values, future) with one matrix product per feature layout
+    def scoreBatch(self,batch_in):
+        layouts = {}
+        for item in batch_in:
+            layouts.setdefault(tuple(item[0]),[]).append(item)
+        for names,items in layouts.items():
+            start = time.perf_counter()
+            try:
+                scores = self.model.scoreNamedMatrix(list(names),[values for _,values,_ in items])
+            except Exception as e:
+                for _,_,future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            seconds = time.perf_counter()-start
+            for (_,_,future),score in zip(items,scores):
+                if not future.done():
+                    future.set_result((float(score),seconds,len(batch_in)))
+
+    # Collect the cases that are ready within the window after the first one and score them together
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.score_queue.get()]
+            deadline = loop.time()+self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline-loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.score_queue.get(),timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.stats['batches'] += 1
+            self.stats['batched_cases'] += len(batch)
+            self.stats['max_batch_size'] = max(self.stats['max_batch_size'],len(batch))
+            self.refreshModel()
+            self.scoreBatch(batch)
+
+    async def scoreCase(self,request_in):
+        start = time.perf_counter()
+        self.stats['cases'] += 1
+        try:
+            if not isinstance(request_in,dict) or not request_in.get('image') or not request_in.get('mask'):
+                raise ValueError('A case needs an image and a mask')
+            for key in ('image','mask'):
+                if not os.path.exists(request_in[key]):
+                    raise FileNotFoundError('No %s file %s' % (key,request_in[key]))
+            self.refreshModel()
+            job = dict(self.job_options,image = request_in['image'],mask = request_in['mask'],plan = self.plan)
+            names,values,timings = await self.extract(job)
+            extracted = time.perf_counter()
+            try:
+                score,scoring_seconds,batch_size = await self.queueScore(names,values)
+            except KeyError:
+                if job['plan'] is self.plan:
+                    raise
+                # the model changed while the case was extracted, extract the features of the new one
+                job['plan'] = self.plan
+                names,values,timings = await self.extract(job)
+                extracted = time.perf_counter()
+                score,scoring_seconds,batch_size = await self.queueScore(names,values)
+        except Exception as e:
+            self.stats['failed'] += 1
+            return {'case': request_in.get('case') if isinstance(request_in,dict) else None, 'status': 'error',
+                    'message': '%s: %s' % (type(e).__name__,e), 'seconds': time.perf_counter()-start}
+        total = time.perf_counter()-start
+        threshold = request_in.get('threshold',self.threshold)
+        timings['queue'] = max(0.0,extracted-start-timings['read']-timings['extraction'])
+        timings['batch_wait'] = time.perf_counter()-extracted-scoring_seconds
+        timings['scoring'] = scoring_seconds
+        timings['total'] = total
+        return {'case': request_in.get('case'), 'status': 'ok', 'score': score,
+                'class': self.qualityScore.qualityClass(score,threshold), 'threshold': threshold,
+                'batch_size': batch_size, 'timings': timings}
+
+    async def route(self,method_in,path_in,body_in):
+        if method_in == 'GET' and path_in == '/health':
+            return 200,{'status': 'ok'}
+        if method_in == 'GET' and path_in == '/stats':
+            stats = dict(self.stats,uptime_seconds = time.time()-self.started)
+            stats['mean_batch_size'] = stats['batched_cases']/stats['batches'] if stats['batches'] else 0.0
+            return 200,stats
+        if method_in == 'POST' and path_in == '/score':
+            try:
+                request = json.loads(body_in.decode('utf-8'))
+            except ValueError as e:
+                return 400,{'status': 'error', 'message': 'Invalid JSON: %s' % e}
+            # checked before any case is queued, so a bad field is a 400 and not an error of the scoring
+            for case in (request if isinstance(request,list) else [request]):
+                error = caseError(case)
+                if error is not None:
+                    return 400,{'status': 'error', 'message': error}
+            if isinstance(request,list):
+                # the cases of one request are extracted in parallel and batched like any others
+                responses = await asyncio.gather(*[self.scoreCase(case) for case in request])
+                return 200,responses
+            response = await self.scoreCase(request)
+            return (200 if response['status'] == 'ok' else 422),response
+        return 404,{'status': 'error', 'message': 'No %s %s' % (method_in,path_in)}
+
+    # One HTTP/1.1 request per connection
+    async def handle(self,reader,writer):
+        self.stats['requests'] += 1
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n',b'\n',b''):
+                    break
+                key,_,value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            if len(request_line) < 2:
+                status,response = 400,{'status': 'error', 'message': 'Invalid request line'}
+            else:
+                body = await reader.readexactly(int(headers.get('content-length','0')))
+                status,response = await self.route(request_line[0].upper(),request_line[1].split('?')[0],body)
+        except Exception as e:
+            status,response = 500,{'status': 'error', 'message': '%s: %s' % (type(e).__name__,e)}
+        payload = json.dumps(response).encode('utf-8')
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                      % (status,reasons.get(status,''),len(payload))).encode('latin-1')+payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self,address_in):
+        self.score_queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        address = parseAddress(address_in)
+        if isinstance(address,str):
+            clearSocket(address)
+            server = await asyncio.start_unix_server(self.handle,address)
+            # only this user may send cases, whatever folder the socket is in
+            os.chmod(address,0o600)
+        else:
+            server = await asyncio.start_server(self.handle,*address)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT,signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum,stop.set)
+            except (NotImplementedError,AttributeError):
+                # Windows: stopped with Ctrl+C through KeyboardInterrupt
+                pass
+        print('SQC service on %s (%d workers, window %.0f ms)' % (address_in,self.nr_workers,1000*self.window))
+        sys.stdout.flush()
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            batcher.cancel()
+            self.pool.shutdown(cancel_futures = True)
+            if isinstance(address,str) and os.path.exists(address):
+                os.remove(address)
+
+#---Client---#
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self,path_in,timeout=None):
+        super().__init__('localhost',timeout = timeout)
+        self.path = path_in
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+# Send a request to the service, returns the HTTP status and the decoded answer
+def request(address_in,method_in,path_in,body_in=None,timeout=None):
+    address = parseAddress(address_in)
+    if isinstance(address,str):
+        connection = UnixHTTPConnection(address,timeout)
+    else:
+        connection = http.client.HTTPConnection(*address,timeout = timeout)
+    try:
+        body = None if body_in is None else json.dumps(body_in)
+        connection.request(method_in,path_in,body,{'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        return response.status,json.loads(response.read().decode('utf-8'))
+    finally:
+        connection.close()
+
+def score(address_in,image_in,mask_in,case_in=None,threshold_in=None):
+    case = {'image': os.path.abspath(image_in), 'mask': os.path.abspath(mask_in), 'case': case_in}
+    if threshold_in is not None:
+        case['threshold'] = threshold_in
+    return request(address_in,'POST','/score',case)[1]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local QC scoring service')
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--serve',action='store_true',help='start the service')
+    mode.add_argument('--score',nargs=2,metavar=('IMAGE','MASK'),help='score one case with the running service')
+    mode.add_argument('--stats',action='store_true',help='print the counters of the running service')
+    parser.add_argument('--address',default=defaultAddress(),help='Unix socket path or host:port')
+    parser.add_argument('--workers',type=int,help='extraction processes (default: number of cores)')
+    parser.add_argument('--window-ms',type=float,default=20,help='cases ready within this time are scored together (default 20)')
+    parser.add_argument('--max-batch',type=int,default=64,help='most cases scored together (default 64)')
+    parser.add_argument('--threshold',type=float,help='quality class threshold (default 85)')
+    parser.add_argument('--model',help='trained model MAT file (default trainedModel.mat next to this script)')
+    parser.add_argument('--crop',action='store_true',help='crop the volumes to the padded bounding box of the mask')
+    parser.add_argument('--cache',help='feature cache folder (see featureCache.py)')
+    parser.add_argument('--cache-size',type=float,default=1024,help='size limit of the feature cache in MB (default 1024)')
+    parser.add_argument('--case',help='case name echoed in the answer of --score')
+    parser.add_argument('--trace',help='write a per stage timing trace of the cases to this Chrome trace JSON file')
+    args = parser.parse_args()
+    if args.serve:
+        import qualityScore
+        if args.trace:
+            import stageTrace
+            stageTrace.startTrace(args.trace)
+        service = QCService(args.model or qualityScore.default_model,args.workers,args.window_ms/1000,args.max_batch,
+                            85 if args.threshold is None else args.threshold,args.crop,args.cache and os.path.abspath(args.cache),
+                            int(args.cache_size*1024**2))
+        asyncio.run(service.serve(args.address))
+    elif args.score:
+        response = score(args.address,args.score[0],args.score[1],args.case,args.threshold)
+        print(json.dumps(response,indent=1))
+        sys.exit(0 if response.get('status') == 'ok' else 1)
+    else:
+        print(json.dumps(request(args.address,'GET','/stats')[1],indent=1))
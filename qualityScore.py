@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Quality score and quality class from the trained linear model
+
+The python counterpart of getQS and getQC in SQC.m. The model in
+trainedModel.mat is converted once into a compact artifact
+(<model>.scorer.npz next to it) that holds only the features with a nonzero
+coefficient, their coefficients and the intercept. The artifact is rebuilt
+when the MAT file changes. A case is scored from its named features, and a
+whole feature matrix with one matrix-vector product. extractionPlan lists
+the features the model uses per region, so that only those are extracted.
+
+Usage:
+    python qualityScore.py --features Case001_features.mat --threshold 85
+    python qualityScore.py --store STORE --method nnUNet_3D --threshold 85
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+import featureWriter
+
+base_path = os.path.dirname(os.path.abspath(__file__))
+default_model = os.path.join(base_path,'trainedModel.mat')
+
+def fileHash(file_in):
+    digest = hashlib.sha1()
+    with open(file_in,'rb') as f:
+        for block in iter(lambda: f.read(1 << 20),b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class QualityModel:
+    def __init__(self,names_in,coef_in,intercept_in,nr_columns_in,source_hash_in=''):
+        self.names = list(names_in)
+        self.coef = np.asarray(coef_in,dtype = np.float64)
+        self.intercept = float(intercept_in)
+        self.nr_columns = int(nr_columns_in)
+        self.source_hash = source_hash_in
+        # feature name -> position in names/coef
+        self.index = {name: ii for ii,name in enumerate(self.names)}
+
+    # Build from trainedModel.mat. The MAT file names only the features with a
+    # nonzero coefficient (chosenVariables), which is all a score needs.
+    @classmethod
+    def fromMat(cls,model_file_in):
+        import scipy.io
+        trainedModel = scipy.io.loadmat(model_file_in,squeeze_me = True,struct_as_record = False,
+                                        variable_names = ['trainedModel'])['trainedModel']
+        coef = np.atleast_1d(np.asarray(trainedModel.coef,dtype = np.float64))
+        nonzero = np.flatnonzero(coef)
+        names = [str(name) for name in np.atleast_1d(trainedModel.chosenVariables)]
+        if len(names) != np.size(nonzero):
+            raise ValueError('%s names %d chosen variables for %d nonzero coefficients'
+                             % (model_file_in,len(names),np.size(nonzero)))
+        return cls(names,coef[nonzero],trainedModel.Intercept,np.size(coef),fileHash(model_file_in))
+
+    @classmethod
+    def fromArtifact(cls,artifact_file_in):
+        with np.load(artifact_file_in) as data:
+            return cls(data['names'].tolist(),data['coef'],data['intercept'],data['nr_columns'],str(data['source_hash']))
+
+    def saveArtifact(self,artifact_file_in):
+        # a temporary file of its own, concurrent jobs may rebuild the artifact at the same time
+        fd,temp_file = tempfile.mkstemp(suffix='.tmp',dir=os.path.dirname(os.path.abspath(artifact_file_in)))
+        with os.fdopen(fd,'wb') as f:
+            np.savez(f,names = np.array(self.names),coef = self.coef,intercept = self.intercept,
+                     nr_columns = self.nr_columns,source_hash = self.source_hash)
+        os.replace(temp_file,artifact_file_in)
+
+    # Score matrix with the features of self.names as columns, one case per row
+    def scoreMatrix(self,features_in):
+        scores = np.asarray(features_in,dtype = np.float64).reshape(-1,len(self.names)) @ self.coef + self.intercept
+        return np.clip(scores,0,100)
+
+    # Score one case from a {feature name: value} dictionary
+    def scoreFeatures(self,features_in):
+        missing = [name for name in self.names if name not in features_in]
+        if missing:
+            raise KeyError('Missing model features: %s' % ', '.join(missing[:5]))
+        return float(self.scoreMatrix([features_in[name] for name in self.names])[0])
+
+    # Score rows given with their own feature names, e.g. the full feature
+    # table in the column order of trainedModel.coef
+    def scoreNamedMatrix(self,names_in,features_in):
+        columns = {name: ii for ii,name in enumerate(names_in)}
+        missing = [name for name in self.names if name not in columns]
+        if missing:
+            raise KeyError('Missing model features: %s' % ', '.join(missing[:5]))
+        features = np.asarray(features_in,dtype = np.float64).reshape(-1,len(columns))
+        return self.scoreMatrix(features[:,[columns[name] for name in self.names]])
+
+    # Score a case from the feature vectors returned by runCase
+    def scoreResults(self,results_in):
+        names,values = featureWriter.modelColumns(results_in)
+        return float(self.scoreNamedMatrix(names,values)[0])
+
+    # Features a score needs as {region class: {feature class: [feature]}}.
+    # Regions and feature classes without a chosen feature are left out.
+    def extractionPlan(self):
+        regions = {suffix: region_class for region_class,suffix in featureWriter.region_suffixes.items()}
+        plan = {}
+        for name in self.names:
+            feature_name,_,suffix = name.rpartition('_')
+            feature_class,_,feature = feature_name.partition('_')
+            plan.setdefault(regions[suffix],{}).setdefault(feature_class,[]).append(feature)
+        return plan
+
+_models = {}
+
+# Load the model once per process, from the artifact if it is up to date.
+# Within a process the model is only reloaded when the MAT file changes.
+def loadModel(model_file_in=default_model):
+    model_file = os.path.abspath(model_file_in)
+    status = os.stat(model_file)
+    stamp = (status.st_mtime_ns,status.st_size)
+    if model_file in _models and _models[model_file][0] == stamp:
+        return _models[model_file][1]
+    source_hash = fileHash(model_file)
+    artifact_file = os.path.splitext(model_file)[0]+'.scorer.npz'
+    model = None
+    if os.path.exists(artifact_file):
+        model = QualityModel.fromArtifact(artifact_file)
+        if model.source_hash != source_hash:
+            model = None
+    if model is None:
+        model = QualityModel.fromMat(model_file)
+        try:
+            model.saveArtifact(artifact_file)
+        except OSError:
+            # a read-only install scores from the MAT file every time
+            pass
+    _models[model_file] = (stamp,model)
+    return model
+
+# Extraction plan of the current model, follows the model when the MAT file changes
+def extractionPlan(model_file_in=default_model):
+    return loadModel(model_file_in).extractionPlan()
+
+# Same as getQC in SQC.m, for one score or an array of scores
+def qualityClass(quality_score_in,quality_class_thr_in):
+    classes = np.where(np.asarray(quality_score_in) < quality_class_thr_in,'NOT Acceptable','Acceptable')
+    return str(classes) if classes.ndim == 0 else classes.tolist()
+
+# Feature matrix of the cases in a feature store that have every model region
+def storeMatrix(store_in,method_in,model_in):
+    regions = {suffix: region_class for region_class,suffix in featureWriter.region_suffixes.items()}
+    needed = {}
+    for position,name in enumerate(model_in.names):
+        feature,_,suffix = name.rpartition('_')
+        needed.setdefault(regions[suffix],[]).append((position,'original_'+feature))
+    cases = None
+    for region_class in needed:
+        region_cases = set(case for case,_,_ in store_in.keys(method_in,region_class))
+        cases = region_cases if cases is None else cases & region_cases
+    cases = sorted(cases or [])
+    features = np.full((len(cases),len(model_in.names)),np.nan)
+    for region_class,columns in needed.items():
+        _,_,values = store_in.table([(case,method_in,region_class) for case in cases],[feature for _,feature in columns])
+        features[:,[position for position,_ in columns]] = values
+    return cases,features
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quality score and class from the trained linear model')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--features',nargs='+',help='per case records written by featureWriter (mat or npz)')
+    source.add_argument('--store',help='score every case of a feature store')
+    parser.add_argument('--method',default='',help='segmentation method of the cases in the store')
+    parser.add_argument('--model',default=default_model,help='trained model MAT file')
+    parser.add_argument('--threshold',type=float,default=85,help='quality class threshold')
+    args = parser.parse_args()
+    model = loadModel(args.model)
+    if args.store:
+        import featureStore
+        cases,features = storeMatrix(featureStore.FeatureStore(args.store),args.method,model)
+        scores = model.scoreMatrix(features)
+    else:
+        cases = []
+        scores = []
+        for features_file in args.features:
+            if features_file.endswith('.mat'):
+                import scipy.io
+                record = scipy.io.loadmat(features_file,squeeze_me = True)
+                names = [str(name) for name in record['featureNames']]
+                values = record['features']
+            else:
+                with np.load(features_file) as record:
+                    names = record['names'].tolist()
+                    values = record['values']
+            cases.append(str(record['case']))
+            scores.append(model.scoreNamedMatrix(names,values)[0])
+    for case,score,quality_class in zip(cases,scores,qualityClass(scores,args.threshold)):
+        print('%s\t%.2f\t%s' % (case,score,quality_class))
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Per stage timing trace of the feature extraction
+
+Every stage of a case is a span: reading a volume, casting the mask, cropping,
+the region split and the settings of every region, the extraction of every
+region (with its voxel count) and every extractor.execute in it (with its
+feature classes), and writing the results.
+The spans are written as Chrome trace JSON, an array of complete ('X')
+events with the process and thread id, one event per line appended to the
+trace file. The processes of a batch and the unit workers of a case all write
+into the same file. Open it in chrome://tracing or https://ui.perfetto.dev,
+or print the time per stage with this script.
+
+Tracing is switched on with startTrace, which also sets SQC_TRACE so that
+processes started later write into the same file. When it is off, span only
+checks a global and returns a shared no-op span, so the calls stay in
+production code.
+
+Usage:
+    python pyradiomicsBatch.py manifest.csv --results FOLDER --trace trace.json
+    python stageTrace.py trace.json
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+
+trace_variable = 'SQC_TRACE'
+
+# file descriptor of the trace file, None when tracing is off
+trace_fd = None
+
+class Span:
+    def __init__(self,name_in,args_in):
+        self.name = name_in
+        self.args = args_in
+
+    # add arguments that are only known inside the span, such as a voxel count
+    def set(self,**args):
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        # perf_counter is a monotonic clock shared by the processes of a machine
+        event = {'name': self.name, 'cat': 'sqc', 'ph': 'X', 'ts': self.start/1000, 'dur': (end-self.start)/1000,
+                 'pid': os.getpid(), 'tid': threading.get_native_id(), 'args': self.args}
+        writeEvent(event)
+        return False
+
+class NoSpan:
+    def set(self,**args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        return False
+
+no_span = NoSpan()
+
+def enabled():
+    return trace_fd is not None
+
+# Span of a stage, used as 'with stageTrace.span('read',file=...) as span:'
+def span(name_in,**args):
+    if trace_fd is None:
+        return no_span
+    return Span(name_in,args)
+
+# One event per write on an O_APPEND descriptor, so the lines of several
+# processes do not interleave
+def writeEvent(event_in):
+    try:
+        os.write(trace_fd,(json.dumps(event_in)+',\n').encode('utf-8'))
+    except (OSError,TypeError):
+        # a trace must never fail a case
+        pass
+
+def openTrace(trace_file_in):
+    global trace_fd
+    trace_fd = os.open(trace_file_in,os.O_WRONLY | os.O_APPEND | os.O_CREAT,0o644)
+
+# Start a new trace in trace_file_in (replacing an old one) for this process
+# and the processes it starts
+def startTrace(trace_file_in):
+    global trace_fd
+    trace_file_in = os.path.abspath(trace_file_in)
+    with open(trace_file_in,'w') as f:
+        # the closing bracket is optional in the trace event format
+        f.write('[\n')
+    stopTrace()
+    openTrace(trace_file_in)
+    os.environ[trace_variable] = trace_file_in
+
+def stopTrace():
+    global trace_fd
+    if trace_fd is not None:
+        os.close(trace_fd)
+        trace_fd = None
+
+# Events of a trace file, written completely or not
+def readTrace(trace_file_in):
+    with open(trace_file_in) as f:
+        text = f.read().strip()
+    if not text.endswith(']'):
+        text = text.rstrip(',')+']'
+    return [event for event in json.loads(text) if event.get('ph') == 'X']
+
+# Count, total and maximum duration in seconds per stage, region and feature classes
+def summarize(events_in):
+    stages = {}
+    for event in events_in:
+        args = event.get('args',{})
+        key = (event['name'],args.get('region') or '',','.join(args.get('classes',[])))
+        count,total,longest = stages.get(key,(0,0.0,0.0))
+        seconds = event['dur']/1e6
+        stages[key] = (count+1,total+seconds,max(longest,seconds))
+    return stages
+
+# a trace started by a parent process
+if os.environ.get(trace_variable):
+    try:
+        openTrace(os.environ[trace_variable])
+    except OSError:
+        trace_fd = None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time per stage of an extraction trace')
+    parser.add_argument('trace',help='Chrome trace JSON written with --trace')
+    args = parser.parse_args()
+    events = readTrace(args.trace)
+    stages = summarize(events)
+    print('%d spans from %d processes' % (len(events),len({event['pid'] for event in events})))
+    print('%-14s %-14s %-42s %6s %10s %10s %10s' % ('stage','region','classes','count','total s','mean s','max s'))
+    for (name,region,classes),(count,total,longest) in sorted(stages.items(),key = lambda item: -item[1][1]):
+        print('%-14s %-14s %-42s %6d %10.3f %10.4f %10.4f' % (name,region,classes,count,total,total/count,longest))
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Feature cache of a case
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import numpy as np
+import SimpleITK as sitk
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import featureCache
+import pyradiomicsFeatureExtraction as extraction
+
+# Small scan with an ellipsoid mask in it, of the pixel type dtype_in
+def writeCase(folder_in,dtype_in,extension_in='.mhd'):
+    zz,yy,xx = np.mgrid[:9,:32,:32]
+    mask_array = ((((zz-4)/4)**2+((yy-15.5)/11)**2+((xx-15.5)/11)**2) <= 1).astype(np.uint8)
+    image_array = (np.random.default_rng(0).normal(100,10,mask_array.shape)+50*mask_array).astype(dtype_in)
+    files = []
+    for array,name in ((image_array,'case_normalized'),(mask_array,'case_segmentation')):
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing((0.5,0.5,3.0))
+        files.append(os.path.join(folder_in,name+extension_in))
+        sitk.WriteImage(image,files[-1])
+    return files
+
+def runCached(tmp_path_in,dtype_in,extension_in='.mhd'):
+    image_file,mask_file = writeCase(str(tmp_path_in),dtype_in,extension_in)
+    cache = featureCache.FeatureCache(str(tmp_path_in/'cache'))
+    results_dir = str(tmp_path_in/'results')
+    os.makedirs(results_dir)
+    first = extraction.runCase(image_file,mask_file,results_dir,'case',feature_classes_in = ['firstorder'],cache = cache)
+    second = extraction.runCase(image_file,mask_file,results_dir,'case',feature_classes_in = ['firstorder'],cache = cache)
+    return cache,first,second
+
+def test_float64_scan_is_cached(tmp_path):
+    cache,first,second = runCached(tmp_path,np.float64)
+    assert (cache.misses,cache.hits) == (1,1)
+    assert second['wholeprostate']['firstorder']['original_firstorder_Mean'] == first['wholeprostate']['firstorder']['original_firstorder_Mean']
+
+# the intensity range of a float32 scan is a numpy float32, which JSON does not serialize
+def test_float32_scan_is_cached(tmp_path):
+    cache,first,second = runCached(tmp_path,np.float32)
+    assert (cache.misses,cache.hits) == (1,1)
+    assert isinstance(first['wholeprostate']['firstorder']['diagnostics_Configuration_Settings']['binWidth'],float)
+    assert second['wholeprostate']['firstorder']['original_firstorder_Mean'] == first['wholeprostate']['firstorder']['original_firstorder_Mean']
+
+# a put that fails while the entry is written leaves no temporary file behind
+def test_failed_put_leaves_no_temporary_file(tmp_path):
+    cache = featureCache.FeatureCache(str(tmp_path/'cache'))
+    try:
+        cache.put('key',{'wholeprostate': {'firstorder': {'diagnostics_Versions_Note': object()}}})
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('an object that JSON cannot write was cached')
+    assert os.listdir(str(tmp_path/'cache')) == []
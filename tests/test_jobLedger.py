@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Resuming a batch extraction into a feature store from its ledger
+
+Usage:
+    python -m pytest tests
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+base_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+sys.path.insert(0,base_path)
+import featureStore
+import jobLedger
+import pyradiomicsBatch
+from test_featureCache import writeCase
+
+# A batch that dies in the upsert of its first case, after the worker wrote the case files
+crash_code = ('import json,multiprocessing,os,sys\n'
+              'import featureStore\n'
+              'import pyradiomicsBatch\n'
+              'def crash(self,records_in):\n'
+              '    for child in multiprocessing.active_children():\n'
+              '        child.kill()\n'
+              '    os._exit(3)\n'
+              'featureStore.FeatureStore.upsert = crash\n'
+              'pyradiomicsBatch.runBatch(json.loads(sys.argv[1]),1,store = featureStore.FeatureStore(sys.argv[2]),verbose = False,\n'
+              '                          prefetch = int(sys.argv[3]))\n')
+
+def resume(jobs_in,ledger_file_in):
+    return pyradiomicsBatch.resumeJobs(jobs_in,jobLedger.JobLedger(ledger_file_in),True)
+
+@pytest.mark.parametrize('prefetch',[0,2])
+def test_crash_before_upsert_is_extracted_again(tmp_path,prefetch):
+    image_file,mask_file = writeCase(str(tmp_path),np.float64)
+    results_dir = str(tmp_path/'results')
+    store_path = str(tmp_path/'store')
+    ledger_file = str(tmp_path/'batch.ledger')
+    jobs = [{'image': image_file, 'mask': mask_file, 'case': 'case', 'results': results_dir, 'format': 'json'}]
+    pending,nr_complete,_ = resume(jobs,ledger_file)
+    crashed = subprocess.run([sys.executable,'-c',crash_code,json.dumps(pending),store_path,str(prefetch)],cwd=base_path)
+    assert crashed.returncode == 3
+    assert os.path.exists(os.path.join(results_dir,'case_wholeprostate_firstorder.json'))
+    # written but not in the store: the case is not complete in the ledger
+    pending,nr_complete,_ = resume(jobs,ledger_file)
+    assert (len(pending),nr_complete) == (1,0)
+    _,summary = pyradiomicsBatch.runBatch(pending,1,store = featureStore.FeatureStore(store_path),verbose = False,prefetch = prefetch)
+    assert summary['failed'] == 0
+    assert featureStore.FeatureStore(store_path).keys() == [('case','','apex'),('case','','base'),('case','','wholeprostate')]
+    pending,nr_complete,_ = resume(jobs,ledger_file)
+    assert (len(pending),nr_complete) == (0,1)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Direct NIfTI ingestion of float32 scans, as nnU-Net writes them
+
+Usage:
+    python -m pytest tests
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import niftiIngestion
+import pyradiomicsFeatureExtraction as extraction
+from test_featureCache import writeCase
+
+def readFeatures(results_dir_in,case_in):
+    with open(os.path.join(results_dir_in,case_in+'_wholeprostate_firstorder.json')) as f:
+        return json.load(f)
+
+# a float32 .nii.gz scan is written with the default JSON output, with the same features as the .mhd
+def test_float32_nifti_scan(tmp_path):
+    nifti_dir = tmp_path/'nifti'
+    mhd_dir = tmp_path/'mhd'
+    results_dir = tmp_path/'results'
+    for folder in (nifti_dir,mhd_dir,results_dir):
+        os.makedirs(folder)
+    nifti_files = writeCase(str(nifti_dir),np.float32,'.nii.gz')
+    mhd_files = writeCase(str(mhd_dir),np.float32,'.mhd')
+    extraction.runCase(*nifti_files,str(results_dir),'nifti',feature_classes_in = ['firstorder'])
+    extraction.runCase(*mhd_files,str(results_dir),'mhd',feature_classes_in = ['firstorder'])
+    nifti_features = readFeatures(str(results_dir),'nifti')
+    mhd_features = readFeatures(str(results_dir),'mhd')
+    assert {key: value for key,value in nifti_features.items() if not key.startswith('diagnostics_')} == \
+           {key: value for key,value in mhd_features.items() if not key.startswith('diagnostics_')}
+    assert niftiIngestion.compareCase(nifti_files[1],nifti_files[0])['same_mask']
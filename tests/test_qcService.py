@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Local QC scoring service, on a temporary Unix socket with a phantom case
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+base_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+sys.path.insert(0,base_path)
+import pyradiomicsFeatureExtraction as extraction
+import qcService
+import qualityScore
+from test_featureCache import writeCase
+
+timing_keys = ['read','extraction','queue','batch_wait','scoring','total']
+
+# The service with one worker, a window long enough to batch the cases of one request and at most 3 cases per batch
+@pytest.fixture(scope='module')
+def service(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('service')
+    address = str(folder/'service.sock')
+    process = subprocess.Popen([sys.executable,os.path.join(base_path,'qcService.py'),'--serve','--address',address,'--workers','1',
+                                '--window-ms','2000','--max-batch','3'],stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+    # the first line is printed once the service listens
+    assert process.stdout.readline().decode('utf-8').startswith('SQC service on')
+    yield address,writeCase(str(folder),np.float64)
+    process.terminate()
+    process.wait(60)
+
+def test_score_class_and_timings(service):
+    address,(image_file,mask_file) = service
+    response = qcService.score(address,image_file,mask_file,'phantom',50)
+    assert response['status'] == 'ok'
+    model = qualityScore.loadModel()
+    expected = model.scoreResults(extraction.extractCase(extraction.readCase(image_file,mask_file),plan = model.extractionPlan()))
+    assert response['score'] == pytest.approx(expected)
+    assert response['class'] == qualityScore.qualityClass(expected,50)
+    assert (response['case'],response['threshold']) == ('phantom',50)
+    assert all(response['timings'][key] >= 0 for key in timing_keys)
+
+# the cases of one request are ready within the window and scored as one batch
+def test_cases_are_batched(service):
+    address,(image_file,mask_file) = service
+    case = {'image': image_file, 'mask': mask_file}
+    status,responses = qcService.request(address,'POST','/score',[dict(case,case = str(ii)) for ii in range(3)])
+    assert status == 200
+    assert [response['status'] for response in responses] == ['ok']*3
+    assert [response['batch_size'] for response in responses] == [3]*3
+    assert len({response['score'] for response in responses}) == 1
+    stats = qcService.request(address,'GET','/stats')[1]
+    assert stats['max_batch_size'] == 3
+
+def test_missing_case_file(service):
+    address,(image_file,_) = service
+    response = qcService.score(address,image_file,image_file+'.missing')
+    assert response['status'] == 'error'
+    assert response['message'].startswith('FileNotFoundError')
+
+@pytest.mark.parametrize('threshold',['high',None,True])
+def test_invalid_threshold(service,threshold):
+    address,(image_file,mask_file) = service
+    status,response = qcService.request(address,'POST','/score',[{'image': image_file, 'mask': mask_file, 'threshold': threshold}])
+    assert status == 400
+    assert response['message'].startswith('threshold must be a number')
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Watch-folder mode: score new segmentations as they appear
+
+Watches the folder a segmentation method writes its masks into (inotify on
+Linux, polling of the folder elsewhere) and scores every new or changed mask
+once it has been left alone for --settle seconds, so half written files are
+not read. The scan of a mask is found with a naming rule: --mask-pattern is
+a regular expression with a 'case' group, --image-template names the scan in
+--images (default the watched folder). Every scored mask is appended as one
+JSON line to --output, which is also the record of the work done: masks
+already scored with the same size and modification time are not scored again,
+also not after a restart. A mask that failed is tried again after --settle
+seconds and after a restart, up to --retries times for the same file.
+
+Usage:
+    python watchFolder.py /data/predictions --output qc_scores.ndjson
+    python watchFolder.py /data/nnUNet/predictions --images /data/nnUNet/imagesTs \\
+        --mask-pattern '(?P<case>.+)\\.nii\\.gz$' --image-template '{case}_0000.nii.gz' --workers 2
+"""
+
+import argparse
+import concurrent.futures
+import concurrent.futures.process
+import ctypes
+import ctypes.util
+import json
+import os
+import re
+import select
+import struct
+import sys
+import time
+
+#---Watchers---#
+
+# inotify events of a file written in place or moved into the folder
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+class InotifyWatcher:
+    def __init__(self,folder_in):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',use_errno = True)
+        if not hasattr(libc,'inotify_init1'):
+            raise OSError('inotify is not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(),'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd,os.fsencode(folder_in),IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(),'inotify_add_watch failed on %s' % folder_in)
+        self.folder = folder_in
+
+    # Names of the files changed within timeout_in seconds, None when events
+    # were lost and the folder has to be listed once
+    def changes(self,timeout_in):
+        if not select.select([self.fd],[],[],timeout_in)[0]:
+            return []
+        try:
+            data = os.read(self.fd,65536)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset < len(data):
+            _,mask,_,length = struct.unpack_from('iIII',data,offset)
+            offset += struct.calcsize('iIII')
+            if mask & IN_Q_OVERFLOW:
+                return None
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    def __init__(self,folder_in,interval=1.0):
+        self.folder = folder_in
+        self.interval = interval
+        self.seen = self.listing()
+
+    # (modification time, size) of every file in the folder
+    def listing(self):
+        listing = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        status = entry.stat()
+                        listing[entry.name] = (status.st_mtime_ns,status.st_size)
+                except FileNotFoundError:
+                    pass
+        return listing
+
+    def changes(self,timeout_in):
+        time.sleep(min(timeout_in,self.interval))
+        listing = self.listing()
+        names = [name for name,stamp in listing.items() if self.seen.get(name) != stamp]
+        self.seen = listing
+        return names
+
+    def close(self):
+        pass
+
+def makeWatcher(folder_in,poll=False,interval=1.0):
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(folder_in)
+        except OSError as e:
+            print('inotify not available (%s), polling %s' % (e,folder_in))
+    return PollingWatcher(folder_in,interval)
+
+#---Pairing---#
+
+class PairingRule:
+    def __init__(self,mask_pattern_in,image_template_in,image_folder_in=None):
+        self.mask_pattern = re.compile(mask_pattern_in)
+        if 'case' not in self.mask_pattern.groupindex:
+            raise ValueError('The mask pattern needs a (?P<case>...) group')
+        self.image_template = image_template_in
+        self.image_folder = image_folder_in and os.path.abspath(image_folder_in)
+
+    # Case name of a mask file name, None for other files
+    def case(self,name_in):
+        match = self.mask_pattern.search(name_in)
+        return match.group('case') if match else None
+
+    def image(self,mask_file_in,case_in):
+        return os.path.join(self.image_folder or os.path.dirname(mask_file_in),self.image_template.format(case = case_in))
+
+#---Scoring---#
+
+# Record of a mask in the output, without the score
+def jobRecord(job_in):
+    return {'case': job_in['case'], 'mask': job_in['mask'], 'image': job_in['image'],
+            'mask_mtime_ns': job_in['stamp'][0], 'mask_size': job_in['stamp'][1]}
+
+# Extract the model features of a mask and its scan and score them, in a pool worker
+def scoreJob(job_in):
+    import logging
+    import radiomics
+    import pyradiomicsFeatureExtraction as extraction
+    import qualityScore
+    logging.getLogger('radiomics').setLevel(logging.ERROR)
+    start = time.perf_counter()
+    record = jobRecord(job_in)
+    try:
+        model = qualityScore.loadModel(job_in['model'])
+        cache = None
+        if job_in.get('cache'):
+            import featureCache
+            cache = featureCache.FeatureCache(job_in['cache'])
+        results = extraction.extractCase(extraction.readCase(job_in['image'],job_in['mask'],job_in.get('crop',False)),
+                                         plan = model.extractionPlan(),cache = cache)
+        score = model.scoreResults(results)
+        record['score'] = score
+        record['class'] = qualityScore.qualityClass(score,job_in['threshold'])
+        record['error'] = None
+    except Exception as e:
+        record['error'] = '%s: %s' % (type(e).__name__,e)
+    record['seconds'] = time.perf_counter()-start
+    record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    return record
+
+# Masks already scored, {mask file: (modification time, size)}, and the masks
+# that failed, {mask file: ((modification time, size), failures with that stamp)}, from the output
+def readLedger(output_file_in):
+    done = {}
+    failed = {}
+    if not os.path.exists(output_file_in):
+        return done,failed
+    with open(output_file_in) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                mask_file,record_stamp = record['mask'],(record['mask_mtime_ns'],record['mask_size'])
+            except (ValueError,KeyError):
+                # a line cut short when the watcher was killed
+                continue
+            if record.get('error'):
+                addFailure(failed,mask_file,record_stamp)
+            else:
+                done[mask_file] = record_stamp
+    return done,failed
+
+def addFailure(failed_in,mask_file_in,stamp_in):
+    last_stamp,count = failed_in.get(mask_file_in,(None,0))
+    failed_in[mask_file_in] = (stamp_in,count+1 if last_stamp == stamp_in else 1)
+
+def appendRecord(output_file_in,record_in):
+    with open(output_file_in,'a') as f:
+        f.write(json.dumps(record_in)+'\n')
+
+# (modification time, size) of a mask, of a MetaIO header and its data file together
+def stamp(file_in):
+    status = os.stat(file_in)
+    mtime,size = status.st_mtime_ns,status.st_size
+    if file_in.lower().endswith('.mhd'):
+        import metaImage
+        data_file = metaImage.readHeader(file_in)[0].get('ElementDataFile','LOCAL')
+        if data_file != 'LOCAL' and not data_file.startswith('LIST') and '%' not in data_file:
+            try:
+                status = os.stat(os.path.join(os.path.dirname(file_in),data_file))
+                mtime,size = max(mtime,status.st_mtime_ns),size+status.st_size
+            except FileNotFoundError:
+                # not written yet, the header is stamped alone until it is
+                pass
+    return (mtime,size)
+
+class FolderScorer:
+    def __init__(self,folder_in,rule_in,output_file_in,model_file_in,threshold=85,settle=2.0,nr_workers=1,crop=False,cache_dir=None,
+                 verbose=True,retries=2):
+        self.folder = os.path.abspath(folder_in)
+        self.rule = rule_in
+        self.output_file = output_file_in
+        self.settle = settle
+        self.job_options = {'model': model_file_in, 'threshold': threshold, 'crop': crop, 'cache': cache_dir}
+        self.verbose = verbose
+        self.retries = retries
+        self.done,self.failed = readLedger(output_file_in)
+        # mask file -> (case, time of the last change, stamp at that time)
+        self.pending = {}
+        # future -> (job, pool it runs on)
+        self.running = {}
+        self.waiting_for_image = set()
+        self.nr_workers = nr_workers
+        self.pool = self.makePool()
+
+    def makePool(self):
+        import pyradiomicsBatch
+        nr_threads = max(1,(os.cpu_count() or 1)//self.nr_workers)
+        return concurrent.futures.ProcessPoolExecutor(self.nr_workers,initializer = pyradiomicsBatch.initWorker,initargs = (nr_threads,))
+
+    # A mask that failed more than retries times with the same stamp is not tried again until it changes
+    def givenUp(self,mask_file_in,stamp_in):
+        last_stamp,count = self.failed.get(mask_file_in,(None,0))
+        return last_stamp == stamp_in and count > self.retries
+
+    # Replace a pool a worker died in, unless that was done already
+    def restartPool(self,pool_in):
+        if pool_in is self.pool:
+            pool_in.shutdown(wait = False,cancel_futures = True)
+            self.pool = self.makePool()
+        return self.pool
+
+    def submit(self,job_in):
+        pool = self.pool
+        try:
+            future = pool.submit(scoreJob,job_in)
+        except concurrent.futures.process.BrokenProcessPool:
+            # a worker died after the last case was collected
+            pool = self.restartPool(pool)
+            future = pool.submit(scoreJob,job_in)
+        self.running[future] = (job_in,pool)
+
+    # A file of the folder was created or changed
+    def notice(self,name_in):
+        # the data file of a MetaIO header delays the header
+        base,extension = os.path.splitext(name_in)
+        if extension.lower() in ('.raw','.zraw'):
+            name_in = base+'.mhd'
+        case = self.rule.case(name_in)
+        if case is None:
+            return
+        mask_file = os.path.join(self.folder,name_in)
+        try:
+            self.pending[mask_file] = (case,time.monotonic(),stamp(mask_file))
+        except FileNotFoundError:
+            self.pending.pop(mask_file,None)
+
+    # Submit the masks that did not change for settle seconds
+    def submitSettled(self):
+        now = time.monotonic()
+        running = {job['mask'] for job,_ in self.running.values()}
+        for mask_file,(case,changed,last_stamp) in list(self.pending.items()):
+            if now-changed < self.settle or mask_file in running:
+                continue
+            try:
+                current = stamp(mask_file)
+            except FileNotFoundError:
+                del self.pending[mask_file]
+                continue
+            if current != last_stamp:
+                self.pending[mask_file] = (case,now,current)
+                continue
+            if self.done.get(mask_file) == current or self.givenUp(mask_file,current):
+                del self.pending[mask_file]
+                continue
+            image_file = self.rule.image(mask_file,case)
+            if not os.path.exists(image_file):
+                # the scan may still be on its way, the mask stays pending
+                if mask_file not in self.waiting_for_image and self.verbose:
+                    print('%s: waiting for %s' % (case,image_file))
+                self.waiting_for_image.add(mask_file)
+                continue
+            self.waiting_for_image.discard(mask_file)
+            if len(self.running) >= self.nr_workers:
+                # no more masks on the pool than workers, so a worker that dies only fails the masks that were running
+                continue
+            del self.pending[mask_file]
+            job = dict(self.job_options,case = case,mask = mask_file,image = image_file,stamp = current)
+            self.submit(job)
+
+    # Append the records of the finished masks to the output
+    def collect(self,timeout_in=0):
+        if not self.running:
+            return
+        finished,_ = concurrent.futures.wait(self.running,timeout_in,concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+            job,pool = self.running.pop(future)
+            try:
+                record = future.result()
+            except concurrent.futures.process.BrokenProcessPool as e:
+                # a worker died (e.g. out of memory): the masks on its pool fail, a new pool takes the next ones
+                record = dict(jobRecord(job),error = '%s: %s' % (type(e).__name__,e),seconds = None,
+                              time = time.strftime('%Y-%m-%dT%H:%M:%S'))
+                self.restartPool(pool)
+            appendRecord(self.output_file,record)
+            record_stamp = (record['mask_mtime_ns'],record['mask_size'])
+            retry = False
+            if record['error']:
+                addFailure(self.failed,job['mask'],record_stamp)
+                retry = not self.givenUp(job['mask'],record_stamp)
+                if retry:
+                    # a transient failure (a worker that died, a scan still being copied) is tried again after settle seconds
+                    self.pending.setdefault(job['mask'],(job['case'],time.monotonic(),record_stamp))
+            else:
+                self.done[job['mask']] = record_stamp
+            if self.verbose:
+                if record['error']:
+                    print('%s failed (%s)%s' % (record['case'],record['error'],', tried again' if retry else ''))
+                else:
+                    print('%s\t%.2f\t%s\t%.1f s' % (record['case'],record['score'],record['class'],record['seconds']))
+                sys.stdout.flush()
+
+    # Watch until interrupted, with once only score what is in the folder now and stop
+    def run(self,watcher_in,once=False):
+        # the folder is listed once at the start, after that only changes are looked at
+        for name in os.listdir(self.folder):
+            self.notice(name)
+        if once:
+            self.pending = {mask_file: (case,-self.settle,last_stamp) for mask_file,(case,_,last_stamp) in self.pending.items()}
+        try:
+            while True:
+                if not once:
+                    names = watcher_in.changes(min(self.settle,1.0) if self.pending or self.running else 1.0)
+                    if names is None:
+                        names = os.listdir(self.folder)
+                    for name in names:
+                        self.notice(name)
+                self.submitSettled()
+                self.collect(0.5 if once else 0)
+                if once and not self.running and not (set(self.pending)-self.waiting_for_image):
+                    break
+        finally:
+            self.pool.shutdown()
+            if watcher_in is not None:
+                watcher_in.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score new segmentations in a folder as they appear')
+    parser.add_argument('folder',help='folder the segmentation masks are written into')
+    parser.add_argument('--images',help='folder of the scans (default: the watched folder)')
+    parser.add_argument('--mask-pattern',default=r'(?P<case>.+)_segmentation\.(mhd|mha|nii|nii\.gz)$',
+                        help='regular expression of the mask file names, with a (?P<case>...) group')
+    parser.add_argument('--image-template',default='{case}_normalized.mhd',help='file name of the scan of a case (default {case}_normalized.mhd)')
+    parser.add_argument('--output',default='qc_scores.ndjson',help='scores are appended to this JSON lines file (default qc_scores.ndjson)')
+    parser.add_argument('--model',help='trained model MAT file (default trainedModel.mat next to this script)')
+    parser.add_argument('--threshold',type=float,default=85,help='quality class threshold (default 85)')
+    parser.add_argument('--settle',type=float,default=2.0,help='seconds a mask must be left unchanged before it is scored (default 2)')
+    parser.add_argument('--workers',type=int,default=1,help='masks scored at the same time (default 1)')
+    parser.add_argument('--retries',type=int,default=2,help='times a mask that failed is scored again before it is left until it changes (default 2)')
+    parser.add_argument('--crop',action='store_true',help='crop the volumes to the padded bounding box of the mask')
+    parser.add_argument('--cache',help='feature cache folder (see featureCache.py)')
+    parser.add_argument('--poll',action='store_true',help='poll the folder instead of using inotify')
+    parser.add_argument('--interval',type=float,default=1.0,help='polling interval in seconds (default 1)')
+    parser.add_argument('--once',action='store_true',help='score the masks in the folder that are not in the output yet and stop')
+    args = parser.parse_args()
+    import qualityScore
+    rule = PairingRule(args.mask_pattern,args.image_template,args.images)
+    scorer = FolderScorer(args.folder,rule,args.output,args.model or qualityScore.default_model,args.threshold,args.settle,args.workers,
+                          args.crop,args.cache and os.path.abspath(args.cache),retries = args.retries)
+    watcher = None if args.once else makeWatcher(scorer.folder,args.poll,args.interval)
+    try:
+        scorer.run(watcher,args.once)
+    except KeyboardInterrupt:
+        pass